@@ -0,0 +1,80 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+import numpy as np
+
+# Vectorized operations on face boxes. Boxes are an (N, 4) array of x, y, w, h in pixels, the same
+# layout as the face 'area' dictionaries, so that all the boxes found in an image are handled at once.
+
+def boxes_are_inside(boxes: np.ndarray, image_width: int, image_height: int) -> np.ndarray:
+    # Boolean (N,) array, True for the boxes entirely inside the image
+    x, y, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    return (x >= 0) & (y >= 0) & (x + w <= image_width) & (y + h <= image_height)
+# end boxes_are_inside()
+
+def clip_boxes(boxes: np.ndarray, image_width: int, image_height: int) -> np.ndarray:
+    # Boxes cut to the part inside the image. Boxes entirely outside get a zero width or height.
+    x1 = np.clip(boxes[:, 0], 0, image_width)
+    y1 = np.clip(boxes[:, 1], 0, image_height)
+    x2 = np.clip(boxes[:, 0] + boxes[:, 2], 0, image_width)
+    y2 = np.clip(boxes[:, 1] + boxes[:, 3], 0, image_height)
+    return np.stack([x1, y1, np.maximum(x2 - x1, 0), np.maximum(y2 - y1, 0)], axis=1)
+# end clip_boxes()
+
+def non_max_suppression(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarray:
+    # Indices of the boxes to keep, most confident first: a box is dropped when its intersection over
+    # union with a more confident kept box exceeds iou_threshold. The overlaps of each kept box with
+    # all the remaining boxes are computed at once.
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    x1 = boxes[:, 0].astype(np.float64)
+    y1 = boxes[:, 1].astype(np.float64)
+    x2 = x1 + boxes[:, 2]
+    y2 = y1 + boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='stable')
+
+    keep: list[int] = []
+    while len(order) > 0:
+        best = order[0]
+        keep.append(int(best))
+        rest = order[1:]
+        overlap_w = np.maximum(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0)
+        overlap_h = np.maximum(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0)
+        intersection = overlap_w * overlap_h
+        union = areas[best] + areas[rest] - intersection
+        iou = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+# end non_max_suppression()
+
+def box_ious(boxes: np.ndarray, other_boxes: np.ndarray) -> np.ndarray:
+    # (N, M) intersection over union of every box with every other box
+    x1, y1 = boxes[:, 0:1].astype(np.float64), boxes[:, 1:2].astype(np.float64)
+    x2, y2 = x1 + boxes[:, 2:3], y1 + boxes[:, 3:4]
+    other_x1, other_y1 = other_boxes[:, 0].astype(np.float64), other_boxes[:, 1].astype(np.float64)
+    other_x2, other_y2 = other_x1 + other_boxes[:, 2], other_y1 + other_boxes[:, 3]
+    overlap_w = np.maximum(np.minimum(x2, other_x2) - np.maximum(x1, other_x1), 0)
+    overlap_h = np.maximum(np.minimum(y2, other_y2) - np.maximum(y1, other_y1), 0)
+    intersection = overlap_w * overlap_h
+    union = (x2 - x1) * (y2 - y1) + (other_x2 - other_x1) * (other_y2 - other_y1) - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+# end box_ious()
+
+def match_boxes(boxes: np.ndarray, other_boxes: np.ndarray, iou_threshold: float) -> list[tuple[int, int]]:
+    # (box, other box) index pairs, each box matched at most once: pairs are taken by decreasing
+    # intersection over union, as long as it exceeds iou_threshold
+    if len(boxes) == 0 or len(other_boxes) == 0:
+        return []
+    ious: np.ndarray = box_ious(boxes, other_boxes)
+    matches: list[tuple[int, int]] = []
+    matched_boxes: set[int] = set()
+    matched_other_boxes: set[int] = set()
+    for flat_index in np.argsort(-ious, axis=None, kind='stable').tolist():
+        box, other_box = divmod(flat_index, len(other_boxes))
+        if ious[box, other_box] <= iou_threshold:
+            break
+        if box not in matched_boxes and other_box not in matched_other_boxes:
+            matches.append((box, other_box))
+            matched_boxes.add(box)
+            matched_other_boxes.add(other_box)
+    return matches
+# end match_boxes()
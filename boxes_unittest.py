@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from boxes import box_ious, match_boxes, non_max_suppression, clip_boxes
+
+class TestBoxes(unittest.TestCase):
+
+    def test_box_ious(self) -> None:
+        boxes = np.array([[0, 0, 10, 10], [20, 20, 10, 10]])
+        other_boxes = np.array([[0, 0, 10, 10], [5, 0, 10, 10], [100, 100, 5, 5]])
+        ious = box_ious(boxes, other_boxes)
+        self.assertEqual(ious.shape, (2, 3))
+        np.testing.assert_allclose(ious[0], [1.0, 50 / 150, 0.0])
+        np.testing.assert_allclose(ious[1], [0.0, 0.0, 0.0])
+        return
+    # end test_box_ious()
+
+    def test_match_boxes(self) -> None:
+        # A detection shifted by a pixel still matches its saved face, each box at most once
+        detected = np.array([[1, 0, 40, 30], [200, 200, 20, 20], [0, 1, 40, 30]])
+        saved = np.array([[0, 0, 40, 30], [100, 100, 20, 20]])
+        self.assertEqual(match_boxes(detected, saved, 0.5), [(0, 0)])
+        self.assertEqual(match_boxes(detected, np.zeros((0, 4)), 0.5), [])
+        return
+    # end test_match_boxes()
+
+    def test_non_max_suppression(self) -> None:
+        boxes = np.array([[0, 0, 10, 10], [1, 1, 10, 10], [50, 50, 10, 10]])
+        keep = non_max_suppression(boxes, np.array([0.5, 0.9, 0.8]), iou_threshold=0.3)
+        self.assertEqual(keep.tolist(), [1, 2])
+        return
+    # end test_non_max_suppression()
+
+    def test_clip_boxes(self) -> None:
+        clipped = clip_boxes(np.array([[-5, -5, 10, 10], [95, 0, 10, 10]]), 100, 100)
+        self.assertEqual(clipped.tolist(), [[0, 0, 5, 5], [95, 0, 5, 10]])
+        return
+    # end test_clip_boxes()
+# end class TestBoxes
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+from typing import Callable, Iterator
+import json
+import sqlite3
+import threading
+import numpy as np
+
+class MetadataCatalog:
+    # SQLite database holding the face metadata of a whole library, instead of one JSON file per image.
+    #
+    #   images      one row per processed image: path and directory relative to the library root, face count
+    #   faces       one row per face: area, confidence, name, crop id and any other keys as JSON
+    #   embeddings  one row per face and embedding fingerprint: the float32 vector, or its row in the
+    #               EmbeddingStore of that fingerprint when embedding_storage is 'mmap'
+    #   no_faces    one row per image found without faces and detector fingerprint, with the size and
+    #               mtime of the image then, see NoFacesCache in faces
+    #
+    # Paths, directories, names and fingerprints are indexed. The database runs in WAL mode and saves are
+    # buffered and written batch_size images per transaction; reads see the buffered saves. flush()
+    # writes the buffer, close() also checkpoints the WAL. The on_saved callbacks given to save() are
+    # only called once the transaction holding the image has committed, by the thread that wrote it.
+    # The faces are the same dictionaries as in the JSON metadata files, so both layouts can be
+    # converted into each other.
+
+    SCHEMA: str = """
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            dir TEXT NOT NULL,
+            face_count INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS images_dir ON images (dir);
+        CREATE TABLE IF NOT EXISTS faces (
+            id INTEGER PRIMARY KEY,
+            image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+            face_index INTEGER NOT NULL,
+            x INTEGER, y INTEGER, w INTEGER, h INTEGER,
+            confidence REAL,
+            name TEXT,
+            crop_id INTEGER,
+            extra TEXT);
+        CREATE INDEX IF NOT EXISTS faces_image ON faces (image_id);
+        CREATE INDEX IF NOT EXISTS faces_name ON faces (name);
+        CREATE TABLE IF NOT EXISTS embeddings (
+            face_id INTEGER NOT NULL REFERENCES faces (id) ON DELETE CASCADE,
+            fingerprint TEXT NOT NULL,
+            vector BLOB,
+            row INTEGER,
+            PRIMARY KEY (face_id, fingerprint));
+        CREATE INDEX IF NOT EXISTS embeddings_fingerprint ON embeddings (fingerprint);
+        CREATE TABLE IF NOT EXISTS no_faces (
+            path TEXT NOT NULL,
+            dir TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            PRIMARY KEY (path, fingerprint));
+        CREATE INDEX IF NOT EXISTS no_faces_dir ON no_faces (dir, fingerprint);
+        """
+
+    FACE_KEYS: set[str] = {'name', 'area', 'confidence', 'crop_id', 'embeddings', 'embedding_rows'}
+
+    def __init__(self, db_filepath: Path, batch_size: int = 500) -> None:
+        self.db_filepath: Path = db_filepath
+        self.batch_size: int = batch_size
+        self._lock = threading.Lock()
+        db_filepath.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(db_filepath.as_posix(), check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')  # durable at checkpoints, always consistent
+        self._connection.execute('PRAGMA foreign_keys=ON')
+        self._connection.executescript(self.SCHEMA)
+        self._pending: dict[str, list[dict]] = {}  # image path -> faces, not written yet
+        self._pending_callbacks: dict[str, list[Callable[[], None]]] = {}  # image path -> on_saved callbacks
+        return
+    # end __init__()
+
+    def save(self, image_path: str, faces: list[dict], on_saved: Callable[[], None] | None = None) -> None:
+        # image_path is relative to the library root. Replaces the faces saved before for that image.
+        callbacks: list[Callable[[], None]] = []
+        with self._lock:
+            self._pending[image_path] = faces
+            if on_saved is not None:
+                self._pending_callbacks.setdefault(image_path, []).append(on_saved)
+            if len(self._pending) >= self.batch_size:
+                callbacks = self._write_pending()
+        self._call(callbacks)
+        return
+    # end save()
+
+    def _call(self, callbacks: list[Callable[[], None]]) -> None:
+        # Called without the lock, so that a callback may use the catalog
+        for on_saved in callbacks:
+            on_saved()
+        return
+    # end _call()
+
+    def _write_pending(self) -> list[Callable[[], None]]:
+        # Called with the lock held. Returns the on_saved callbacks of the images written, to be called
+        # once the lock is released.
+        if len(self._pending) == 0:
+            return []
+        cursor = self._connection.cursor()
+        cursor.execute('BEGIN')
+        try:
+            for image_path, faces in self._pending.items():
+                cursor.execute('DELETE FROM images WHERE path = ?', (image_path,))
+                cursor.execute('INSERT INTO images (path, dir, face_count) VALUES (?, ?, ?)',
+                               (image_path, Path(image_path).parent.as_posix(), len(faces)))
+                image_id: int = cursor.lastrowid
+                for face_index, face in enumerate(faces):
+                    area: dict[str, int] = face['area']
+                    extra: dict = {key: value for key, value in face.items() if key not in self.FACE_KEYS}
+                    cursor.execute('INSERT INTO faces (image_id, face_index, x, y, w, h, confidence, name, crop_id, extra) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (image_id, face_index, area['x'], area['y'], area['w'], area['h'], face['confidence'],
+                                    face.get('name'), face.get('crop_id'), json.dumps(extra) if len(extra) > 0 else None))
+                    face_id: int = cursor.lastrowid
+                    embeddings: dict[str, list[float]] = face.get('embeddings', {})
+                    rows: dict[str, int] = face.get('embedding_rows', {})
+                    cursor.executemany('INSERT INTO embeddings (face_id, fingerprint, vector, row) VALUES (?, ?, ?, ?)',
+                                       [(face_id,
+                                         fingerprint,
+                                         np.asarray(embeddings[fingerprint], dtype=np.float32).tobytes() if fingerprint in embeddings else None,
+                                         rows.get(fingerprint))
+                                        for fingerprint in set(embeddings) | set(rows)])
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        callbacks: list[Callable[[], None]] = [on_saved for image_path in self._pending
+                                               for on_saved in self._pending_callbacks.pop(image_path, [])]
+        self._pending = {}
+        return callbacks
+    # end _write_pending()
+
+    def remove(self, image_path: str) -> None:
+        with self._lock:
+            self._pending.pop(image_path, None)
+            self._pending_callbacks.pop(image_path, None)
+            self._connection.execute('DELETE FROM images WHERE path = ?', (image_path,))
+            self._connection.execute('DELETE FROM no_faces WHERE path = ?', (image_path,))
+        return
+    # end remove()
+
+    def add_no_faces(self, records: list[tuple[str, str, int, int]]) -> None:
+        # Records (image path, detector fingerprint, size, mtime_ns) of images without faces, in one transaction
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                cursor.executemany('INSERT OR REPLACE INTO no_faces (path, dir, fingerprint, size, mtime_ns) VALUES (?, ?, ?, ?, ?)',
+                                   [(image_path, Path(image_path).parent.as_posix(), fingerprint, size, mtime_ns)
+                                    for image_path, fingerprint, size, mtime_ns in records])
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+        return
+    # end add_no_faces()
+
+    def get_no_faces(self, dir_path: str, fingerprint: str) -> dict[str, list[int]]:
+        # {image name: [size, mtime_ns]} of the images of dir_path recorded without faces for fingerprint
+        with self._lock:
+            return {Path(image_path).name: [size, mtime_ns] for image_path, size, mtime_ns in self._connection.execute(
+                'SELECT path, size, mtime_ns FROM no_faces WHERE dir = ? AND fingerprint = ?', (dir_path, fingerprint))}
+    # end get_no_faces()
+
+    def get(self, image_path: str) -> list[dict] | None:
+        # The faces saved for image_path, None if it was never saved
+        with self._lock:
+            if image_path in self._pending:
+                return json.loads(json.dumps(self._pending[image_path]))  # a copy, as if read back
+            image = self._connection.execute('SELECT id FROM images WHERE path = ?', (image_path,)).fetchone()
+            if image is None:
+                return None
+            faces: list[dict] = []
+            face_ids: list[int] = []
+            for face_id, x, y, w, h, confidence, name, crop_id, extra in self._connection.execute(
+                    'SELECT id, x, y, w, h, confidence, name, crop_id, extra FROM faces WHERE image_id = ? ORDER BY face_index',
+                    (image[0],)):
+                face: dict = {'name': name, 'area': {'x': x, 'y': y, 'w': w, 'h': h}, 'confidence': confidence}
+                if crop_id is not None:
+                    face['crop_id'] = crop_id
+                if extra is not None:
+                    face.update(json.loads(extra))
+                faces.append(face)
+                face_ids.append(face_id)
+            for face, face_id in zip(faces, face_ids):
+                for fingerprint, vector, row in self._connection.execute(
+                        'SELECT fingerprint, vector, row FROM embeddings WHERE face_id = ?', (face_id,)):
+                    if vector is not None:
+                        face.setdefault('embeddings', {})[fingerprint] = np.frombuffer(vector, dtype=np.float32).tolist()
+                    if row is not None:
+                        face.setdefault('embedding_rows', {})[fingerprint] = row
+        return faces
+    # end get()
+
+    def get_image_names(self, dir_path: str) -> set[str]:
+        # Names of the images saved in dir_path, relative to the library root ('.' for the root itself)
+        with self._lock:
+            names: set[str] = set(Path(image_path).name for image_path in self._pending if Path(image_path).parent.as_posix() == dir_path)
+            names.update(Path(image_path).name for (image_path,) in
+                         self._connection.execute('SELECT path FROM images WHERE dir = ?', (dir_path,)))
+        return names
+    # end get_image_names()
+
+    def get_images_by_dir(self) -> Iterator[tuple[str, list[str]]]:
+        # Every directory with saved images, with the paths of its images
+        self.flush()
+        with self._lock:
+            rows: list[tuple[str, str]] = self._connection.execute('SELECT dir, path FROM images ORDER BY dir, path').fetchall()
+        current_dir: str | None = None
+        image_paths: list[str] = []
+        for dir_path, image_path in rows:
+            if dir_path != current_dir:
+                if current_dir is not None:
+                    yield current_dir, image_paths
+                current_dir, image_paths = dir_path, []
+            image_paths.append(image_path)
+        if current_dir is not None:
+            yield current_dir, image_paths
+        return
+    # end get_images_by_dir()
+
+    def get_images_with_name(self, name: str) -> list[str]:
+        self.flush()
+        with self._lock:
+            return [image_path for (image_path,) in self._connection.execute(
+                'SELECT DISTINCT images.path FROM faces JOIN images ON images.id = faces.image_id WHERE faces.name = ?', (name,))]
+    # end get_images_with_name()
+
+    def flush(self) -> None:
+        with self._lock:
+            callbacks: list[Callable[[], None]] = self._write_pending()
+        self._call(callbacks)
+        return
+    # end flush()
+
+    def close(self) -> None:
+        with self._lock:
+            callbacks: list[Callable[[], None]] = self._write_pending()
+            self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._connection.close()
+        self._call(callbacks)
+        return
+    # end close()
+# end class MetadataCatalog
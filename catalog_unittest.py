@@ -0,0 +1,110 @@
+from pathlib import Path
+from typing import Callable
+import sqlite3
+import tempfile
+import unittest
+from catalog import MetadataCatalog
+
+class TestMetadataCatalog(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_filepath = Path(self.temp_dir.name) / 'catalog.sqlite'
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    @staticmethod
+    def create_faces(name: str | None, embedding: list[float]) -> list[dict]:
+        return [{'name': name,
+                 'area': {'x': 1, 'y': 2, 'w': 3, 'h': 4},
+                 'confidence': 0.5,
+                 'embeddings': {'abc': embedding},
+                 'pose': 'front'}]
+    # end create_faces()
+
+    def test_save_and_get(self) -> None:
+        catalog = MetadataCatalog(self.db_filepath, batch_size=2)
+        faces = self.create_faces('alice', [0.5, 0.25])
+        catalog.save('dir/a.jpg', faces)
+        self.assertEqual(catalog.get('dir/a.jpg'), faces)  # pending
+        catalog.flush()
+        self.assertEqual(catalog.get('dir/a.jpg'), faces)  # written
+        self.assertIsNone(catalog.get('dir/b.jpg'))
+        catalog.close()
+
+        catalog = MetadataCatalog(self.db_filepath)
+        self.assertEqual(catalog.get('dir/a.jpg'), faces)
+        self.assertEqual(catalog.get_image_names('dir'), {'a.jpg'})
+        self.assertEqual(catalog.get_images_with_name('alice'), ['dir/a.jpg'])
+        catalog.close()
+        return
+    # end test_save_and_get()
+
+    def test_replace_and_remove(self) -> None:
+        catalog = MetadataCatalog(self.db_filepath)
+        catalog.save('a.jpg', self.create_faces('alice', [1.0]))
+        catalog.flush()
+        catalog.save('a.jpg', self.create_faces('bob', [2.0]))
+        catalog.save('b.jpg', self.create_faces(None, [3.0]))
+        self.assertEqual(catalog.get_image_names('.'), {'a.jpg', 'b.jpg'})
+        catalog.flush()
+        self.assertEqual(catalog.get('a.jpg')[0]['name'], 'bob')
+        catalog.remove('a.jpg')
+        self.assertIsNone(catalog.get('a.jpg'))
+        self.assertEqual(list(catalog.get_images_by_dir()), [('.', ['b.jpg'])])
+        catalog.close()
+        return
+    # end test_replace_and_remove()
+
+    def test_on_saved_after_commit(self) -> None:
+        catalog = MetadataCatalog(self.db_filepath, batch_size=2)
+        saved: list[str] = []
+
+        def on_saved(image_path: str) -> Callable[[], None]:
+            def callback() -> None:
+                connection = sqlite3.connect(self.db_filepath.as_posix())  # sees committed transactions only
+                committed: set[str] = set(path for (path,) in connection.execute('SELECT path FROM images'))
+                connection.close()
+                self.assertIn(image_path, committed)
+                saved.append(image_path)
+            return callback
+
+        catalog.save('a.jpg', self.create_faces(None, [1.0]), on_saved('a.jpg'))
+        self.assertEqual(saved, [])  # only buffered
+        catalog.save('b.jpg', self.create_faces(None, [2.0]), on_saved('b.jpg'))
+        self.assertEqual(saved, ['a.jpg', 'b.jpg'])  # the batch committed
+        catalog.save('c.jpg', self.create_faces(None, [3.0]), on_saved('c.jpg'))
+        catalog.remove('c.jpg')  # never written, so never saved
+        catalog.save('d.jpg', self.create_faces(None, [4.0]), on_saved('d.jpg'))
+        self.assertEqual(saved, ['a.jpg', 'b.jpg'])
+        catalog.close()
+        self.assertEqual(saved, ['a.jpg', 'b.jpg', 'd.jpg'])
+        return
+    # end test_on_saved_after_commit()
+
+    def test_no_faces(self) -> None:
+        catalog = MetadataCatalog(self.db_filepath)
+        catalog.add_no_faces([('a.jpg', 'detector1', 10, 100), ('dir/b.jpg', 'detector1', 20, 200), ('dir/b.jpg', 'detector2', 20, 200)])
+        catalog.add_no_faces([('dir/b.jpg', 'detector1', 30, 300)])  # changed since
+        self.assertEqual(catalog.get_no_faces('.', 'detector1'), {'a.jpg': [10, 100]})
+        self.assertEqual(catalog.get_no_faces('dir', 'detector1'), {'b.jpg': [30, 300]})
+        self.assertEqual(catalog.get_no_faces('dir', 'detector3'), {})
+        catalog.close()
+
+        catalog = MetadataCatalog(self.db_filepath)
+        self.assertEqual(catalog.get_no_faces('dir', 'detector2'), {'b.jpg': [20, 200]})
+        catalog.remove('dir/b.jpg')
+        self.assertEqual(catalog.get_no_faces('dir', 'detector1'), {})
+        self.assertEqual(list(catalog.get_images_by_dir()), [])  # faceless images are not saved images
+        catalog.close()
+        return
+    # end test_no_faces()
+# end class TestMetadataCatalog
+
+if __name__ == '__main__':
+    unittest.main()
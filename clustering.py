@@ -0,0 +1,120 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+import re
+import numpy as np
+
+# Grouping of faces into people over a sparse nearest neighbor graph, see FaceIndex.get_neighbor_graph().
+# The graph is an (N, k) array of neighbor positions, -1 where a face has fewer than k neighbors within
+# the distance threshold, and the matching distances. Faces are only ever compared with their k
+# neighbors, so the cost grows with N k instead of N^2.
+
+def chinese_whispers(neighbors: np.ndarray,
+                     distances: np.ndarray,
+                     max_distance: float,
+                     iterations: int = 20,
+                     batch_count: int = 10,
+                     seed: int = 0) -> np.ndarray:
+    # (N,) cluster labels. Every face starts in its own cluster, then repeatedly takes the label with the
+    # largest total edge weight among its neighbors, nearer neighbors weighing more (1 - distance /
+    # max_distance). Edges count in both directions. Faces are updated in batch_count random batches per
+    # iteration, each batch at once, and iterating stops early once no label changes.
+    face_count: int = len(neighbors)
+    is_edge: np.ndarray = neighbors >= 0
+    sources: np.ndarray = np.broadcast_to(np.arange(face_count)[:, np.newaxis], neighbors.shape)[is_edge]
+    targets: np.ndarray = neighbors[is_edge]
+    weights: np.ndarray = np.maximum(1.0 - distances[is_edge] / max_distance, 1e-3) if max_distance > 0 else np.ones(len(targets))
+    sources, targets = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+    weights = np.concatenate([weights, weights])
+
+    labels: np.ndarray = np.arange(face_count)
+    rng = np.random.default_rng(seed)
+    batch_of_face: np.ndarray = np.zeros(face_count, dtype=np.int64)
+    for _ in range(iterations):
+        batch_of_face[rng.permutation(face_count)] = np.arange(face_count) % batch_count
+        edge_batches: np.ndarray = batch_of_face[sources]
+        changed_count: int = 0
+        for batch in range(batch_count):
+            in_batch: np.ndarray = edge_batches == batch
+            if not np.any(in_batch):
+                continue
+            batch_sources: np.ndarray = sources[in_batch]
+            batch_labels: np.ndarray = labels[targets[in_batch]]
+            # Total weight of every (face, neighbor label) pair, then the heaviest label of every face
+            order: np.ndarray = np.lexsort((batch_labels, batch_sources))
+            batch_sources, batch_labels = batch_sources[order], batch_labels[order]
+            starts: np.ndarray = np.flatnonzero(np.concatenate([[True], (np.diff(batch_sources) != 0) | (np.diff(batch_labels) != 0)]))
+            pair_sources, pair_labels = batch_sources[starts], batch_labels[starts]
+            pair_weights: np.ndarray = np.add.reduceat(weights[in_batch][order], starts)
+            order = np.lexsort((-pair_weights, pair_sources))
+            faces, first = np.unique(pair_sources[order], return_index=True)
+            new_labels: np.ndarray = pair_labels[order][first]
+            changed_count += int(np.count_nonzero(labels[faces] != new_labels))
+            labels[faces] = new_labels
+        if changed_count == 0:
+            break
+    return labels
+# end chinese_whispers()
+
+def next_cluster_number(names: list[str | None], prefix: str, first_number: int = 1) -> int:
+    # The number of the next new cluster: first_number, or above the numbers of the cluster names in names
+    pattern = re.compile(re.escape(prefix) + r'(\d+)$')
+    matches = (pattern.match(name) for name in names if name is not None)
+    return max(first_number, 1 + max((int(match.group(1)) for match in matches if match is not None), default=0))
+# end next_cluster_number()
+
+def name_clusters(labels: np.ndarray,
+                  names: list[str | None],
+                  prefix: str,
+                  min_size: int,
+                  first_number: int = 1,
+                  is_fixed: list[bool] | None = None) -> list[str | None]:
+    # The names to save for the faces: faces named by the user keep their name, the others get the name
+    # of their cluster, prefix followed by a number, or None when the cluster has fewer than min_size faces.
+    # A cluster keeps the cluster name most of its faces already had, so the names stay the same from one
+    # run to the next as long as the clusters do not change much; new clusters get new numbers, from
+    # first_number on when the names are only part of the library.
+    # Faces where is_fixed is True keep their name, even a cluster name, and a cluster with such a face
+    # takes the name most of its fixed faces have whatever its size.
+    pattern = re.compile(re.escape(prefix) + r'(\d+)$')
+    is_fixed = [False] * len(names) if is_fixed is None else is_fixed
+    is_cluster_name: list[bool] = [name is not None and pattern.match(name) is not None and not fixed
+                                   for name, fixed in zip(names, is_fixed)]
+    next_number: int = next_cluster_number(names, prefix, first_number)
+
+    members: dict[int, list[int]] = {}
+    for face, label in enumerate(labels.tolist()):
+        members.setdefault(label, []).append(face)
+    new_names: list[str | None] = [name if name is not None and not is_cluster else None for name, is_cluster in zip(names, is_cluster_name)]
+    taken: set[str] = set()
+    for faces in sorted(members.values(), key=len, reverse=True):  # larger clusters keep their names first
+        if all(new_names[face] is not None for face in faces):
+            continue
+        fixed_votes: dict[str, int] = {}
+        for face in faces:
+            if is_fixed[face] and names[face] is not None:
+                fixed_votes[names[face]] = fixed_votes.get(names[face], 0) + 1
+        if len(fixed_votes) > 0:
+            fixed_name: str = max(fixed_votes, key=fixed_votes.get)
+            for face in faces:
+                if new_names[face] is None:
+                    new_names[face] = fixed_name
+            continue
+        if len(faces) < min_size:
+            continue
+        votes: dict[str, int] = {}
+        for face in faces:
+            if is_cluster_name[face]:
+                votes[names[face]] = votes.get(names[face], 0) + 1
+        cluster_name: str | None = None
+        if len(votes) > 0:
+            most_voted: str = max(votes, key=votes.get)
+            if most_voted not in taken and 2 * votes[most_voted] > len(faces):
+                cluster_name = most_voted
+        if cluster_name is None:
+            cluster_name = f'{prefix}{next_number}'
+            next_number += 1
+        taken.add(cluster_name)
+        for face in faces:
+            if new_names[face] is None:
+                new_names[face] = cluster_name
+    return new_names
+# end name_clusters()
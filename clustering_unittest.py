@@ -0,0 +1,52 @@
+import unittest
+import numpy as np
+from clustering import chinese_whispers, name_clusters, next_cluster_number
+
+class TestClustering(unittest.TestCase):
+
+    def test_chinese_whispers_groups(self) -> None:
+        # Two groups of three faces, every face linked to the two others of its group
+        neighbors = np.array([[1, 2], [0, 2], [0, 1], [4, 5], [3, 5], [3, 4]])
+        distances = np.full(neighbors.shape, 0.1, dtype=np.float32)
+        labels = chinese_whispers(neighbors, distances, max_distance=0.4)
+        self.assertEqual(len(set(labels[:3].tolist())), 1)
+        self.assertEqual(len(set(labels[3:].tolist())), 1)
+        self.assertNotEqual(labels[0], labels[3])
+        return
+    # end test_chinese_whispers_groups()
+
+    def test_chinese_whispers_without_edges(self) -> None:
+        neighbors = np.full((4, 2), -1)
+        distances = np.full((4, 2), np.inf, dtype=np.float32)
+        labels = chinese_whispers(neighbors, distances, max_distance=0.4)
+        self.assertEqual(labels.tolist(), [0, 1, 2, 3])
+        return
+    # end test_chinese_whispers_without_edges()
+
+    def test_name_clusters(self) -> None:
+        labels = np.array([0, 0, 0, 1, 1, 2])
+        names = ['alice', 'cluster_3', 'cluster_3', None, None, None]
+        new_names = name_clusters(labels, names, 'cluster_', min_size=2)
+        self.assertEqual(new_names, ['alice', 'cluster_3', 'cluster_3', 'cluster_4', 'cluster_4', None])
+        return
+    # end test_name_clusters()
+
+    def test_name_clusters_first_number(self) -> None:
+        new_names = name_clusters(np.array([0, 0]), [None, None], 'cluster_', min_size=2, first_number=9)
+        self.assertEqual(new_names, ['cluster_9', 'cluster_9'])
+        self.assertEqual(next_cluster_number(new_names, 'cluster_', 9), 10)
+        return
+    # end test_name_clusters_first_number()
+
+    def test_name_clusters_keeps_fixed_names(self) -> None:
+        # A face assigned cluster_5 keeps it, and lends it to its cluster whatever the cluster size
+        for min_size in [2, 3]:
+            new_names = name_clusters(np.array([1, 1]), [None, 'cluster_5'], 'cluster_', min_size=min_size,
+                                      first_number=9, is_fixed=[False, True])
+            self.assertEqual(new_names, ['cluster_5', 'cluster_5'])
+        return
+    # end test_name_clusters_keeps_fixed_names()
+# end class TestClustering
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+import os
+import threading
+import numpy as np
+
+from metadata_writer import write_files_atomically
+
+class FaceCropStore:
+    # Append only store of the aligned face crops produced by detection, so that the embeddings can be
+    # recomputed with another identification model without detecting the faces again.
+    #
+    # The crops are kept as uint8 pixels in one data file (<name>.bin), read through a memory map, and
+    # an index file (<name>.idx) holds one int64 record (offset, height, width, channels) per crop. The
+    # position of a record in the index is the crop id stored in the face metadata. The data of a crop
+    # is always written before its index record, and both are handed to the OS before add() returns its
+    # id, so that an id is never saved in the metadata before its crop. After a crash the store is cut
+    # back to the last complete record when it is opened. flush() and close() also sync them to disk.
+    #
+    # Crops of faces detected again are not removed, remove_metadata deletes the whole store.
+    #
+    # The crops are the aligned faces at the resolution they have in the image, whatever the
+    # identification model. Stores created before that kept crops resized and padded to the input size
+    # of the model of the time: <name>.unpadded holds the id of the first unpadded crop, and
+    # is_unpadded() tells the crops that can be used with any model.
+
+    RECORD_FIELDS: int = 4
+
+    def __init__(self, store_dir: Path, name: str) -> None:
+        self.data_filepath: Path = store_dir / (name + '.bin')
+        self.index_filepath: Path = store_dir / (name + '.idx')
+        self.unpadded_filepath: Path = store_dir / (name + '.unpadded')
+        self._lock = threading.Lock()
+        store_dir.mkdir(parents=True, exist_ok=True)
+        self._index: np.ndarray = self._load_index()  # preallocated, doubled when full
+        self._count: int = len(self._index)  # records in use at the start of _index
+        if not self.unpadded_filepath.exists():
+            write_files_atomically([(self.unpadded_filepath, str(self._count))])
+        self.first_unpadded_id: int = int(self.unpadded_filepath.read_text())
+        self._data_size: int = self._end_of_data()
+        with self.data_filepath.open('ab') as data_fp:
+            data_fp.truncate(self._data_size)
+        self._data_fp = self.data_filepath.open('ab')
+        self._index_fp = self.index_filepath.open('ab')
+        self._data_map: np.memmap | None = None
+        self._mapped_count: int = 0  # crops readable through _data_map
+        return
+    # end __init__()
+
+    def _load_index(self) -> np.ndarray:
+        record_size: int = self.RECORD_FIELDS * np.dtype(np.int64).itemsize
+        if not self.index_filepath.exists():
+            self.index_filepath.touch()
+        index_size: int = self.index_filepath.stat().st_size
+        complete_size: int = index_size - index_size % record_size
+        if complete_size != index_size:
+            with self.index_filepath.open('ab') as index_fp:
+                index_fp.truncate(complete_size)
+        if complete_size == 0:
+            return np.zeros((0, self.RECORD_FIELDS), dtype=np.int64)
+        return np.fromfile(self.index_filepath, dtype=np.int64).reshape(-1, self.RECORD_FIELDS)
+    # end _load_index()
+
+    def _end_of_data(self) -> int:
+        if not self.data_filepath.exists():
+            self.data_filepath.touch()
+        if self._count == 0:
+            return 0
+        offset, height, width, channels = (int(value) for value in self._index[self._count - 1])
+        end: int = offset + height * width * channels
+        if end > self.data_filepath.stat().st_size:
+            raise ValueError(f'Face crop store {self.data_filepath.as_posix()} is shorter than its index')
+        return end
+    # end _end_of_data()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count
+    # end __len__()
+
+    def add(self, crop: np.ndarray) -> int:
+        # crop is an (h, w, c) uint8 image; returns its crop id
+        crop = np.ascontiguousarray(crop, dtype=np.uint8)
+        if crop.ndim == 2:
+            crop = crop[:, :, np.newaxis]
+        height, width, channels = crop.shape
+        with self._lock:
+            record: np.ndarray = np.array([[self._data_size, height, width, channels]], dtype=np.int64)
+            self._data_fp.write(crop.tobytes())
+            self._data_fp.flush()
+            self._index_fp.write(record.tobytes())
+            self._index_fp.flush()
+            self._data_size += crop.nbytes
+            crop_id: int = self._count
+            if crop_id == len(self._index):
+                grown: np.ndarray = np.zeros((max(2 * len(self._index), 1024), self.RECORD_FIELDS), dtype=np.int64)
+                grown[:crop_id] = self._index
+                self._index = grown
+            self._index[crop_id] = record[0]
+            self._count += 1
+        return crop_id
+    # end add()
+
+    def is_unpadded(self, crop_id: int) -> bool:
+        return crop_id >= self.first_unpadded_id
+    # end is_unpadded()
+
+    def flush(self) -> None:
+        # Makes the crops added so far durable
+        with self._lock:
+            os.fsync(self._data_fp.fileno())
+            os.fsync(self._index_fp.fileno())
+        return
+    # end flush()
+
+    def get(self, crop_id: int) -> np.ndarray | None:
+        # The (h, w, c) uint8 crop, a view of the memory map, or None if crop_id is not in the store
+        with self._lock:
+            if crop_id < 0 or crop_id >= self._count:
+                return None
+            offset, height, width, channels = (int(value) for value in self._index[crop_id])
+            if crop_id >= self._mapped_count:  # the data file grew since it was mapped
+                self._data_map = np.memmap(self.data_filepath, dtype=np.uint8, mode='r', shape=(self._data_size,))
+                self._mapped_count = self._count
+            data_map: np.memmap = self._data_map
+        return data_map[offset:offset + height * width * channels].reshape(height, width, channels)
+    # end get()
+
+    def close(self) -> None:
+        self.flush()
+        self._data_fp.close()
+        self._index_fp.close()
+        self._data_map = None
+        self._mapped_count = 0
+        return
+    # end close()
+# end class FaceCropStore
@@ -0,0 +1,85 @@
+from pathlib import Path
+import tempfile
+import unittest
+import numpy as np
+from crop_store import FaceCropStore
+
+class TestFaceCropStore(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store_dir = Path(self.temp_dir.name)
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    def test_add_and_get(self) -> None:
+        rng = np.random.default_rng(0)
+        crops = [rng.integers(0, 255, (7, 5, 3), dtype=np.uint8), rng.integers(0, 255, (4, 9), dtype=np.uint8)]
+        store = FaceCropStore(self.store_dir, 'crops')
+        crop_ids = [store.add(crop) for crop in crops]
+        self.assertEqual(crop_ids, [0, 1])
+        np.testing.assert_array_equal(store.get(0), crops[0])
+        np.testing.assert_array_equal(store.get(1), crops[1][:, :, np.newaxis])
+        self.assertIsNone(store.get(2))
+        store.close()
+
+        store = FaceCropStore(self.store_dir, 'crops')
+        self.assertEqual(len(store), 2)
+        np.testing.assert_array_equal(store.get(0), crops[0])
+        store.close()
+        return
+    # end test_add_and_get()
+
+    def test_many_crops(self) -> None:
+        # More crops than the index holds at first, across a reopen
+        store = FaceCropStore(self.store_dir, 'crops')
+        for value in range(1500):
+            self.assertEqual(store.add(np.full((2, 3, 1), value % 256, dtype=np.uint8)), value)
+        store.close()
+        store = FaceCropStore(self.store_dir, 'crops')
+        for value in range(1500, 2600):
+            self.assertEqual(store.add(np.full((2, 3, 1), value % 256, dtype=np.uint8)), value)
+        self.assertEqual(len(store), 2600)
+        for crop_id in [0, 1023, 1024, 1499, 1500, 2599]:
+            np.testing.assert_array_equal(store.get(crop_id), np.full((2, 3, 1), crop_id % 256, dtype=np.uint8))
+        store.close()
+        return
+    # end test_many_crops()
+
+    def test_incomplete_record_is_dropped(self) -> None:
+        store = FaceCropStore(self.store_dir, 'crops')
+        store.add(np.ones((2, 2, 3), dtype=np.uint8))
+        store.close()
+        with (self.store_dir / 'crops.idx').open('ab') as index_fp:
+            index_fp.write(b'\x00' * 5)  # a record cut by a crash
+        store = FaceCropStore(self.store_dir, 'crops')
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.add(np.zeros((1, 1, 3), dtype=np.uint8)), 1)
+        store.close()
+        return
+    # end test_incomplete_record_is_dropped()
+
+    def test_padded_crops_of_older_stores(self) -> None:
+        store = FaceCropStore(self.store_dir, 'crops')
+        store.add(np.ones((2, 2, 3), dtype=np.uint8))
+        store.close()
+        (self.store_dir / 'crops.unpadded').unlink()  # as written before the crops were kept unpadded
+        store = FaceCropStore(self.store_dir, 'crops')
+        store.add(np.ones((3, 3, 3), dtype=np.uint8))
+        self.assertFalse(store.is_unpadded(0))
+        self.assertTrue(store.is_unpadded(1))
+        store.close()
+        store = FaceCropStore(self.store_dir, 'crops')
+        self.assertEqual([store.is_unpadded(crop_id) for crop_id in range(len(store))], [False, True])
+        store.close()
+        return
+    # end test_padded_crops_of_older_stores()
+# end class TestFaceCropStore
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from typing import Iterator, NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Vectorized distances between embeddings, for the distance metrics of deepface. Embeddings are an
+# (N, dimensions) array, compared as a query matrix against a gallery matrix in float32.
+#
+# The gallery is prepared once with prepare_embeddings(): for cosine and euclidean_l2 its rows are
+# L2-normalized, so every distance comes from one matrix product:
+#
+#   cosine        1 - q.g
+#   euclidean_l2  sqrt(2 - 2 q.g)
+#   euclidean     sqrt(|q|^2 + |g|^2 - 2 q.g), with the squared norms of the gallery kept
+#
+# Distances are computed block_size queries by block_size gallery rows at a time, so memory stays
+# bounded by block_size^2 floats whatever the size of the gallery. top_k() finds the exact nearest
+# gallery rows without ever holding the whole distance matrix.
+
+DISTANCE_METRICS: list[str] = ['cosine', 'euclidean', 'euclidean_l2']
+
+class PreparedEmbeddings(NamedTuple):
+    vectors: np.ndarray  # (N, dimensions) float32, L2-normalized unless the metric is euclidean
+    squared_norms: np.ndarray | None  # (N,) float32, only for euclidean
+    distance_metric: str
+# end class PreparedEmbeddings
+
+def prepare_embeddings(embeddings: np.ndarray | list, distance_metric: str) -> PreparedEmbeddings:
+    if distance_metric not in DISTANCE_METRICS:
+        raise ValueError(f'Invalid distance metric: {distance_metric}')
+    vectors: np.ndarray = np.array(embeddings, dtype=np.float32)  # always a copy, normalized in place below
+    if vectors.ndim == 1:  # a single embedding, or no embeddings at all
+        vectors = vectors.reshape(1, -1) if len(vectors) > 0 else vectors.reshape(0, 0)
+    if distance_metric == 'euclidean':
+        return PreparedEmbeddings(vectors, np.einsum('ij,ij->i', vectors, vectors), distance_metric)
+    norms: np.ndarray = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)  # zero vectors stay zero
+    return PreparedEmbeddings(vectors, None, distance_metric)
+# end prepare_embeddings()
+
+def distance_block(queries: PreparedEmbeddings, gallery: PreparedEmbeddings) -> np.ndarray:
+    # (len(queries), len(gallery)) float32 distances, in one go
+    assert queries.distance_metric == gallery.distance_metric, 'Queries and gallery were prepared for different metrics'
+    products: np.ndarray = queries.vectors @ gallery.vectors.T
+    if queries.distance_metric == 'cosine':
+        return np.subtract(1.0, products, out=products)
+    if queries.distance_metric == 'euclidean_l2':
+        squared: np.ndarray = np.subtract(2.0, np.multiply(products, 2.0, out=products), out=products)
+    else:
+        squared = np.multiply(products, -2.0, out=products)
+        squared += queries.squared_norms[:, np.newaxis]
+        squared += gallery.squared_norms[np.newaxis, :]
+    np.maximum(squared, 0.0, out=squared)  # rounding can make the distance of a vector to itself negative
+    return np.sqrt(squared, out=squared)
+# end distance_block()
+
+def slice_embeddings(embeddings: PreparedEmbeddings, start: int, end: int) -> PreparedEmbeddings:
+    squared_norms: np.ndarray | None = None if embeddings.squared_norms is None else embeddings.squared_norms[start:end]
+    return PreparedEmbeddings(embeddings.vectors[start:end], squared_norms, embeddings.distance_metric)
+# end slice_embeddings()
+
+def distance_blocks(queries: PreparedEmbeddings,
+                    gallery: PreparedEmbeddings,
+                    block_size: int) -> Iterator[tuple[int, int, np.ndarray]]:
+    # Yields (first query, first gallery row, distances) for every block of at most block_size x block_size
+    for query_start in range(0, len(queries.vectors), block_size):
+        query_block: PreparedEmbeddings = slice_embeddings(queries, query_start, query_start + block_size)
+        for gallery_start in range(0, len(gallery.vectors), block_size):
+            yield query_start, gallery_start, distance_block(query_block, slice_embeddings(gallery, gallery_start, gallery_start + block_size))
+    return
+# end distance_blocks()
+
+def pairwise_distances(queries: PreparedEmbeddings, gallery: PreparedEmbeddings, block_size: int) -> np.ndarray:
+    # The whole (len(queries), len(gallery)) matrix, computed block by block
+    distances: np.ndarray = np.empty((len(queries.vectors), len(gallery.vectors)), dtype=np.float32)
+    for query_start, gallery_start, block in distance_blocks(queries, gallery, block_size):
+        distances[query_start:query_start + block.shape[0], gallery_start:gallery_start + block.shape[1]] = block
+    return distances
+# end pairwise_distances()
+
+def top_k(queries: PreparedEmbeddings,
+          gallery: PreparedEmbeddings | np.ndarray,
+          k: int,
+          block_size: int,
+          num_threads: int = 1,
+          valid: np.ndarray | None = None,
+          max_distance: float | None = None) -> tuple[np.ndarray, np.ndarray]:
+    # Exact k nearest gallery rows of every query: (len(queries), k) indices and distances, nearest first,
+    # padded with -1 and inf when fewer than k rows qualify. Rows where valid is False, and distances
+    # above max_distance, never qualify.
+    #
+    # The gallery is streamed block_size rows at a time and may be a raw array, e.g. the memory map of
+    # an EmbeddingStore, in which case each block is prepared as it is read. Every block is compared
+    # with every block of queries and merged into a running top k with argpartition, so memory stays
+    # bounded by the blocks and the (queries, k) results. With num_threads > 1 the gallery is split into
+    # that many ranges searched concurrently, NumPy releases the GIL, and their top k are merged.
+    query_count: int = len(queries.vectors)
+    gallery_count: int = len(gallery.vectors) if isinstance(gallery, PreparedEmbeddings) else len(gallery)
+
+    def merge(indices: np.ndarray, distances: np.ndarray, new_indices: np.ndarray, new_distances: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        indices = np.concatenate([indices, new_indices], axis=1)
+        distances = np.concatenate([distances, new_distances], axis=1)
+        if distances.shape[1] > k:
+            nearest: np.ndarray = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            indices = np.take_along_axis(indices, nearest, axis=1)
+            distances = np.take_along_axis(distances, nearest, axis=1)
+        return indices, distances
+
+    def search_range(start: int, end: int) -> tuple[np.ndarray, np.ndarray]:
+        indices: np.ndarray = np.full((query_count, k), -1, dtype=np.int64)
+        distances: np.ndarray = np.full((query_count, k), np.inf, dtype=np.float32)
+        for gallery_start in range(start, end, block_size):
+            gallery_end: int = min(gallery_start + block_size, end)
+            if isinstance(gallery, PreparedEmbeddings):
+                gallery_block: PreparedEmbeddings = slice_embeddings(gallery, gallery_start, gallery_end)
+            else:
+                gallery_block = prepare_embeddings(gallery[gallery_start:gallery_end], queries.distance_metric)
+            block_indices: np.ndarray = np.arange(gallery_start, gallery_end, dtype=np.int64)
+            for query_start in range(0, query_count, block_size):
+                query_end: int = min(query_start + block_size, query_count)
+                block: np.ndarray = distance_block(slice_embeddings(queries, query_start, query_end), gallery_block)
+                if valid is not None:
+                    block[:, ~valid[gallery_start:gallery_end]] = np.inf
+                indices[query_start:query_end], distances[query_start:query_end] = \
+                    merge(indices[query_start:query_end],
+                          distances[query_start:query_end],
+                          np.broadcast_to(block_indices, block.shape),
+                          block)
+        return indices, distances
+
+    range_size: int = -(-gallery_count // max(num_threads, 1))
+    range_size = -(-range_size // block_size) * block_size  # whole blocks
+    ranges: list[tuple[int, int]] = [(start, min(start + range_size, gallery_count)) for start in range(0, gallery_count, max(range_size, 1))]
+    if len(ranges) <= 1:
+        results: list[tuple[np.ndarray, np.ndarray]] = [search_range(*ranges[0])] if len(ranges) == 1 else []
+    else:
+        with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix='top_k') as executor:
+            results = list(executor.map(lambda gallery_range: search_range(*gallery_range), ranges))
+
+    indices: np.ndarray = np.full((query_count, k), -1, dtype=np.int64)
+    distances: np.ndarray = np.full((query_count, k), np.inf, dtype=np.float32)
+    for range_indices, range_distances in results:
+        indices, distances = merge(indices, distances, range_indices, range_distances)
+    order: np.ndarray = np.argsort(distances, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    distances = np.take_along_axis(distances, order, axis=1)
+    if max_distance is not None:
+        distances[distances > max_distance] = np.inf
+    indices[np.isinf(distances)] = -1
+    return indices, distances
+# end top_k()
@@ -0,0 +1,133 @@
+import unittest
+import numpy as np
+from distances import DISTANCE_METRICS, prepare_embeddings, pairwise_distances, top_k
+
+class TestDistances(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(3)
+        self.queries: np.ndarray = rng.normal(size=(37, 24)).astype(np.float32)
+        self.gallery: np.ndarray = rng.normal(size=(301, 24)).astype(np.float32)
+        return
+    # end setUp()
+
+    @staticmethod
+    def brute_force(queries: np.ndarray, gallery: np.ndarray, distance_metric: str) -> np.ndarray:
+        # The distances as deepface computes them, one pair at a time, in float64
+        def normalized(vector: np.ndarray) -> np.ndarray:
+            return vector / np.linalg.norm(vector)
+        distances: np.ndarray = np.empty((len(queries), len(gallery)))
+        for i, query in enumerate(queries.astype(np.float64)):
+            for j, row in enumerate(gallery.astype(np.float64)):
+                if distance_metric == 'cosine':
+                    distances[i, j] = 1.0 - normalized(query) @ normalized(row)
+                elif distance_metric == 'euclidean':
+                    distances[i, j] = np.linalg.norm(query - row)
+                else:
+                    distances[i, j] = np.linalg.norm(normalized(query) - normalized(row))
+        return distances
+    # end brute_force()
+
+    def assert_top_k(self,
+                     indices: np.ndarray,
+                     distances: np.ndarray,
+                     expected: np.ndarray,
+                     k: int,
+                     valid: np.ndarray | None = None,
+                     max_distance: float | None = None) -> None:
+        # Checks top_k() results against the full brute force distance matrix
+        if valid is not None:
+            expected = np.where(valid[np.newaxis, :], expected, np.inf)
+        if max_distance is not None:
+            expected = np.where(expected <= max_distance, expected, np.inf)
+        expected_indices: np.ndarray = np.argsort(expected, axis=1, kind='stable')[:, :k]
+        expected_distances: np.ndarray = np.take_along_axis(expected, expected_indices, axis=1)
+        expected_indices[np.isinf(expected_distances)] = -1
+        np.testing.assert_array_equal(indices, expected_indices)
+        np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-4)
+        return
+    # end assert_top_k()
+
+    def test_pairwise_distances(self) -> None:
+        for distance_metric in DISTANCE_METRICS:
+            with self.subTest(distance_metric=distance_metric):
+                distances: np.ndarray = pairwise_distances(prepare_embeddings(self.queries, distance_metric),
+                                                           prepare_embeddings(self.gallery, distance_metric),
+                                                           block_size=16)
+                self.assertEqual(distances.dtype, np.float32)
+                np.testing.assert_allclose(distances, self.brute_force(self.queries, self.gallery, distance_metric),
+                                           rtol=1e-4, atol=1e-4)
+        return
+    # end test_pairwise_distances()
+
+    def test_distance_to_itself(self) -> None:
+        for distance_metric in DISTANCE_METRICS:
+            with self.subTest(distance_metric=distance_metric):
+                prepared = prepare_embeddings(self.queries, distance_metric)
+                distances: np.ndarray = pairwise_distances(prepared, prepared, block_size=64)
+                self.assertFalse(np.isnan(distances).any())
+                np.testing.assert_allclose(np.diag(distances), 0.0, atol=5e-3)  # the square root of a rounding error
+        return
+    # end test_distance_to_itself()
+
+    def test_invalid_metric(self) -> None:
+        with self.assertRaises(ValueError):
+            prepare_embeddings(self.queries, 'manhattan')
+        return
+    # end test_invalid_metric()
+
+    def test_top_k(self) -> None:
+        for distance_metric in DISTANCE_METRICS:
+            expected: np.ndarray = self.brute_force(self.queries, self.gallery, distance_metric)
+            queries = prepare_embeddings(self.queries, distance_metric)
+            gallery = prepare_embeddings(self.gallery, distance_metric)
+            for block_size, num_threads in [(16, 1), (16, 4), (1000, 1), (7, 3)]:
+                with self.subTest(distance_metric=distance_metric, block_size=block_size, num_threads=num_threads):
+                    indices, distances = top_k(queries, gallery, 5, block_size, num_threads)
+                    self.assert_top_k(indices, distances, expected, 5)
+        return
+    # end test_top_k()
+
+    def test_top_k_valid_and_max_distance(self) -> None:
+        valid: np.ndarray = np.arange(len(self.gallery)) % 3 != 0
+        for distance_metric in DISTANCE_METRICS:
+            expected: np.ndarray = self.brute_force(self.queries, self.gallery, distance_metric)
+            max_distance: float = float(np.quantile(expected, 0.02))
+            queries = prepare_embeddings(self.queries, distance_metric)
+            gallery = prepare_embeddings(self.gallery, distance_metric)
+            for num_threads in [1, 3]:
+                with self.subTest(distance_metric=distance_metric, num_threads=num_threads):
+                    indices, distances = top_k(queries, gallery, 8, 32, num_threads, valid=valid)
+                    self.assert_top_k(indices, distances, expected, 8, valid=valid)
+                    indices, distances = top_k(queries, gallery, 8, 32, num_threads, valid=valid, max_distance=max_distance)
+                    self.assertTrue((indices == -1).any())  # some queries have fewer than 8 rows that close
+                    self.assert_top_k(indices, distances, expected, 8, valid=valid, max_distance=max_distance)
+        return
+    # end test_top_k_valid_and_max_distance()
+
+    def test_top_k_raw_gallery(self) -> None:
+        # A raw array, e.g. the memory map of an EmbeddingStore, is prepared block by block
+        for distance_metric in DISTANCE_METRICS:
+            with self.subTest(distance_metric=distance_metric):
+                expected: np.ndarray = self.brute_force(self.queries, self.gallery, distance_metric)
+                indices, distances = top_k(prepare_embeddings(self.queries, distance_metric), self.gallery, 5, 50, 2)
+                self.assert_top_k(indices, distances, expected, 5)
+        return
+    # end test_top_k_raw_gallery()
+
+    def test_top_k_small_gallery(self) -> None:
+        # Fewer gallery rows than k are padded with -1 and inf, an empty gallery gives only padding
+        queries = prepare_embeddings(self.queries, 'cosine')
+        indices, distances = top_k(queries, prepare_embeddings(self.gallery[:3], 'cosine'), 5, 16, 2)
+        np.testing.assert_array_equal(indices[:, 3:], -1)
+        self.assertTrue(np.isinf(distances[:, 3:]).all())
+        self.assertTrue((indices[:, :3] >= 0).all())
+        indices, distances = top_k(queries, np.zeros((0, 24), dtype=np.float32), 5, 16)
+        np.testing.assert_array_equal(indices, -1)
+        self.assertTrue(np.isinf(distances).all())
+        return
+    # end test_top_k_small_gallery()
+# end class TestDistances
+
+if __name__ == '__main__':
+    unittest.main()
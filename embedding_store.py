@@ -0,0 +1,197 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+import json
+import os
+import threading
+import numpy as np
+
+from metadata_writer import write_files_atomically
+
+class EmbeddingStore:
+    # Binary store of the embeddings of one configuration (one embedding fingerprint) for a whole library.
+    #
+    #   <name>.vectors  one contiguous (rows, dimensions) float32 or float16 matrix
+    #   <name>.records  one fixed size record per row, see RECORD_DTYPE
+    #   <name>.strings  image paths, relative to the library root, and face names, one per line;
+    #                   records refer to them by line number
+    #   <name>.info     dimensions and dtype of the matrix, written atomically before the first row
+    #
+    # Every file is append only, except the name and valid fields of the records, which are updated in
+    # place. A row is written to the matrix before its record, and the number of complete records is the
+    # number of rows, so a store cut short by a crash is truncated back to its last complete row when it
+    # is opened. load() returns memory maps of the matrix and of the records, so reading every embedding
+    # of the library does not copy or parse anything.
+
+    RECORD_DTYPE = np.dtype([('path_id', np.int32),
+                             ('face_index', np.int32),
+                             ('x', np.int32),
+                             ('y', np.int32),
+                             ('w', np.int32),
+                             ('h', np.int32),
+                             ('confidence', np.float32),
+                             ('name_id', np.int32),  # -1 when the face has no name
+                             ('valid', np.uint8)])  # 0 once the face was detected again or removed
+
+    def __init__(self, store_dir: Path, name: str, dtype: str = 'float32') -> None:
+        assert dtype in ('float32', 'float16'), f'Invalid embedding dtype: {dtype}'
+        self.vectors_filepath: Path = store_dir / (name + '.vectors')
+        self.records_filepath: Path = store_dir / (name + '.records')
+        self.strings_filepath: Path = store_dir / (name + '.strings')
+        self.info_filepath: Path = store_dir / (name + '.info')
+        self._lock = threading.Lock()
+        store_dir.mkdir(parents=True, exist_ok=True)
+
+        self.dtype = np.dtype(dtype)
+        self.dimensions: int | None = None
+        if self.info_filepath.exists():
+            with self.info_filepath.open('r') as info_fp:
+                info: dict = json.load(info_fp)
+            self.dimensions = info['dimensions']
+            self.dtype = np.dtype(info['dtype'])  # the dtype the store was created with wins
+
+        for filepath in (self.vectors_filepath, self.records_filepath, self.strings_filepath):
+            filepath.touch()
+        self._row_count: int = self.records_filepath.stat().st_size // self.RECORD_DTYPE.itemsize
+        self._truncate(self.records_filepath, self._row_count * self.RECORD_DTYPE.itemsize)
+        if self.dimensions is not None:
+            self._truncate(self.vectors_filepath, self._row_count * self.dimensions * self.dtype.itemsize)
+
+        with self.strings_filepath.open('r', encoding='utf-8') as strings_fp:
+            self._strings: list[str] = strings_fp.read().split('\n')[:-1]
+        self._string_ids: dict[str, int] = {string: string_id for string_id, string in enumerate(self._strings)}
+
+        self._vectors_fp = self.vectors_filepath.open('ab')
+        self._records_fp = self.records_filepath.open('ab')
+        self._strings_fp = self.strings_filepath.open('a', encoding='utf-8')
+        self._vectors_map: np.memmap | None = None
+        self._records_map: np.memmap | None = None
+        self._mapped_rows: int = 0
+        return
+    # end __init__()
+
+    def _truncate(self, filepath: Path, size: int) -> None:
+        if filepath.stat().st_size > size:
+            with filepath.open('ab') as store_fp:
+                store_fp.truncate(size)
+        return
+    # end _truncate()
+
+    def __len__(self) -> int:
+        return self._row_count
+    # end __len__()
+
+    def _get_string_id(self, string: str) -> int:
+        # Called with the lock held. Paths and names are single lines.
+        string_id: int | None = self._string_ids.get(string)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings.append(string)
+            self._string_ids[string] = string_id
+            self._strings_fp.write(string.replace('\n', ' ') + '\n')
+            self._strings_fp.flush()
+        return string_id
+    # end _get_string_id()
+
+    def append(self,
+               image_path: str,
+               face_index: int,
+               area: dict[str, int],
+               confidence: float,
+               name: str | None,
+               embedding: list[float]) -> int:
+        # Returns the row of the embedding
+        vector: np.ndarray = np.asarray(embedding, dtype=self.dtype)
+        with self._lock:
+            if self.dimensions is None:
+                self.dimensions = len(vector)
+                write_files_atomically([(self.info_filepath, json.dumps({'dimensions': self.dimensions, 'dtype': self.dtype.name}))])
+            assert len(vector) == self.dimensions, \
+                f'Embedding of {len(vector)} dimensions in a store of {self.dimensions} dimensions'
+            record = np.zeros(1, dtype=self.RECORD_DTYPE)
+            record['path_id'] = self._get_string_id(image_path)
+            record['face_index'] = face_index
+            record['x'], record['y'], record['w'], record['h'] = area['x'], area['y'], area['w'], area['h']
+            record['confidence'] = confidence
+            record['name_id'] = -1 if name is None else self._get_string_id(name)
+            record['valid'] = 1
+            self._vectors_fp.write(vector.tobytes())
+            self._vectors_fp.flush()
+            self._records_fp.write(record.tobytes())
+            self._records_fp.flush()
+            row: int = self._row_count
+            self._row_count += 1
+        return row
+    # end append()
+
+    def _maps(self, writable_records: bool = False) -> tuple[np.memmap | None, np.memmap | None]:
+        # Called with the lock held. Maps the files again when rows were added since they were mapped.
+        if self._row_count == 0:
+            return None, None
+        if self._mapped_rows != self._row_count or (writable_records and self._records_map.mode != 'r+'):
+            self._vectors_map = np.memmap(self.vectors_filepath, dtype=self.dtype, mode='r', shape=(self._row_count, self.dimensions))
+            self._records_map = np.memmap(self.records_filepath, dtype=self.RECORD_DTYPE, mode='r+' if writable_records else 'r', shape=(self._row_count,))
+            self._mapped_rows = self._row_count
+        return self._vectors_map, self._records_map
+    # end _maps()
+
+    def get(self, row: int) -> np.ndarray | None:
+        with self._lock:
+            if row < 0 or row >= self._row_count:
+                return None
+            vectors, _ = self._maps()
+            return vectors[row]
+    # end get()
+
+    def invalidate(self, row: int) -> None:
+        with self._lock:
+            if 0 <= row < self._row_count:
+                _, records = self._maps(writable_records=True)
+                records[row]['valid'] = 0
+        return
+    # end invalidate()
+
+    def set_name(self, row: int, name: str | None) -> None:
+        with self._lock:
+            if 0 <= row < self._row_count:
+                name_id: int = -1 if name is None else self._get_string_id(name)
+                _, records = self._maps(writable_records=True)
+                records[row]['name_id'] = name_id
+        return
+    # end set_name()
+
+    def get_string(self, string_id: int) -> str | None:
+        # Image path or name of a record, None for the name_id of a face without a name
+        return None if string_id < 0 else self._strings[string_id]
+    # end get_string()
+
+    def load(self) -> tuple[np.ndarray, np.ndarray]:
+        # Zero copy views of every row: the (rows, dimensions) matrix and the records. Rows that are not
+        # valid any more must be skipped, e.g. with vectors[records['valid'] == 1].
+        with self._lock:
+            vectors, records = self._maps()
+        if vectors is None:
+            return np.zeros((0, self.dimensions or 0), dtype=self.dtype), np.zeros(0, dtype=self.RECORD_DTYPE)
+        return vectors, records
+    # end load()
+
+    def flush(self) -> None:
+        with self._lock:
+            for store_fp in (self._vectors_fp, self._records_fp, self._strings_fp):
+                store_fp.flush()
+                os.fsync(store_fp.fileno())
+            if self._records_map is not None and self._records_map.mode == 'r+':
+                self._records_map.flush()
+        return
+    # end flush()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            for store_fp in (self._vectors_fp, self._records_fp, self._strings_fp):
+                store_fp.close()
+            self._vectors_map = None
+            self._records_map = None
+            self._mapped_rows = 0
+        return
+    # end close()
+# end class EmbeddingStore
@@ -0,0 +1,90 @@
+from pathlib import Path
+import json
+import tempfile
+import unittest
+import numpy as np
+from embedding_store import EmbeddingStore
+
+class TestEmbeddingStore(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store_dir = Path(self.temp_dir.name)
+        self.area: dict[str, int] = {'x': 1, 'y': 2, 'w': 3, 'h': 4}
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    def test_append_and_load(self) -> None:
+        store = EmbeddingStore(self.store_dir, 'test')
+        self.assertEqual(len(store), 0)
+        vectors, records = store.load()
+        self.assertEqual(len(vectors), 0)
+        self.assertFalse(store.info_filepath.exists())
+
+        self.assertEqual(store.append('a.jpg', 0, self.area, 0.9, 'alice', [1.0, 2.0, 3.0]), 0)
+        self.assertEqual(store.append('a.jpg', 1, self.area, 0.8, None, [4.0, 5.0, 6.0]), 1)
+        self.assertEqual(json.loads(store.info_filepath.read_text()), {'dimensions': 3, 'dtype': 'float32'})
+        self.assertEqual(list(self.store_dir.glob('*.tmp')), [])
+        np.testing.assert_array_equal(store.get(1), [4.0, 5.0, 6.0])
+        self.assertIsNone(store.get(2))
+        with self.assertRaises(AssertionError):
+            store.append('b.jpg', 0, self.area, 0.7, None, [1.0, 2.0])
+        store.close()
+
+        store = EmbeddingStore(self.store_dir, 'test', dtype='float16')  # the dtype it was created with wins
+        self.assertEqual(store.dtype, np.float32)
+        vectors, records = store.load()
+        np.testing.assert_array_equal(vectors, [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+        self.assertEqual(records['face_index'].tolist(), [0, 1])
+        self.assertEqual(store.get_string(int(records[0]['path_id'])), 'a.jpg')
+        self.assertEqual(store.get_string(int(records[0]['name_id'])), 'alice')
+        self.assertIsNone(store.get_string(int(records[1]['name_id'])))
+        store.close()
+        return
+    # end test_append_and_load()
+
+    def test_invalidate_and_set_name(self) -> None:
+        store = EmbeddingStore(self.store_dir, 'test')
+        store.append('a.jpg', 0, self.area, 0.9, None, [1.0, 0.0])
+        store.append('b.jpg', 0, self.area, 0.9, None, [0.0, 1.0])
+        store.invalidate(0)
+        store.set_name(1, 'bob')
+        store.close()
+
+        store = EmbeddingStore(self.store_dir, 'test')
+        _, records = store.load()
+        self.assertEqual(records['valid'].tolist(), [0, 1])
+        self.assertEqual(store.get_string(int(records[1]['name_id'])), 'bob')
+        store.close()
+        return
+    # end test_invalidate_and_set_name()
+
+    def test_truncated_row(self) -> None:
+        # A crash between writing a row and its record, or in the middle of a record, loses that row only
+        store = EmbeddingStore(self.store_dir, 'test')
+        store.append('a.jpg', 0, self.area, 0.9, None, [1.0, 2.0])
+        store.append('b.jpg', 0, self.area, 0.9, None, [3.0, 4.0])
+        store.close()
+        with store.records_filepath.open('ab') as records_fp:
+            records_fp.truncate(store.records_filepath.stat().st_size - 1)
+        with store.vectors_filepath.open('ab') as vectors_fp:
+            vectors_fp.write(np.zeros(2, dtype=np.float32).tobytes())  # a row without a record
+
+        store = EmbeddingStore(self.store_dir, 'test')
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.vectors_filepath.stat().st_size, 2 * 4)
+        self.assertEqual(store.append('c.jpg', 0, self.area, 0.9, None, [5.0, 6.0]), 1)
+        vectors, _ = store.load()
+        np.testing.assert_array_equal(vectors, [[1.0, 2.0], [5.0, 6.0]])
+        store.close()
+        return
+    # end test_truncated_row()
+# end class TestEmbeddingStore
+
+if __name__ == '__main__':
+    unittest.main()
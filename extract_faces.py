@@ -1,50 +1,579 @@
 import json
+import stat
+import time
 from pathlib import Path
+from typing import Callable, Iterator
 import numpy as np
 import logging
 
 from global_logger import configure_logger
-from traverser import Traverser, FileTraverser, DirTraverser
-from faces import FacesConfigManager, FileOps, FaceFunctions
+from traverser import Traverser, FileTraverser, DirTraverser, FileInfo
+from faces import FacesConfigManager, FileOps, FaceFunctions, NoFacesCache
 from remove_metadata import remove_metadata
+from face_workers import FaceWorkerPool
+from pipeline import Pipeline
+from scan_manifest import ScanManifest
+from watcher import InotifyWatcher, PollingWatcher, Debouncer
+from image_loader import load_for_detection, ImagePrefetcher
+from crop_store import FaceCropStore
+from clustering import chinese_whispers, name_clusters, next_cluster_number
+from boxes import match_boxes
 
 debug: bool
 log: logging.Logger
 
+def images_to_process(config: FacesConfigManager,
+                      file_ops: FileOps,
+                      manifest: ScanManifest | None = None,
+                      no_faces_cache: NoFacesCache | None = None) -> Iterator[tuple[Path, Path]]:
+    # Yields (image filepath, metadata filepath) for every image that has no face metadata yet or,
+    # with a scan manifest, that was added or modified since the last run. With a manifest, directories
+    # whose mtime did not change since the last run are not even listed. Images already known to have
+    # no faces with the current detector are skipped.
+    # Each directory is listed once for its images and its metadata directory once for the existing metadata.
+    # Directories are listed concurrently when traversal_threads > 1, their order does not matter here.
+    image_batches = file_ops.get_image_batches(num_threads=config.traversal_threads,
+                                               with_stat=manifest is not None or no_faces_cache is not None,
+                                               listing_cache=manifest)
+    for dirpath, image_files in image_batches:
+        metadata_filenames: set[str] = file_ops.get_metadata_filenames(dirpath)
+        images: list[Path] = []
+        for image_file in image_files:
+            has_metadata: bool = file_ops.generate_metadata_filename(image_file.path) in metadata_filenames
+            if manifest is None:
+                must_process: bool = not has_metadata  # if the metadata already exists for that image, then skip it
+            else:
+                must_process = manifest.needs_processing(dirpath, image_file, has_metadata)
+            if must_process and no_faces_cache is not None:
+                must_process = not no_faces_cache.contains(image_file.path, image_file.size, image_file.mtime_ns)
+            if must_process:
+                images.append(image_file.path)
+        if manifest is not None:
+            manifest.begin_dir(dirpath, image_files, images)
+        for image in images:
+            yield image, file_ops.generate_metadata_filepath(image)
+    return
+# end images_to_process()
+
+def create_save_faces(file_ops: FileOps,
+                      manifest: ScanManifest | None,
+                      no_faces_cache: NoFacesCache | None) -> Callable[[Path, list[dict]], None]:
+    # Returns the callback that persists the faces of one image and updates the incremental scan records
+    # The records are only updated once the metadata is on disk, which may be later on the metadata
+    # writer thread, so that they never claim an image whose metadata was lost in a crash.
+    def save_faces(metadata_filepath: Path, faces: list[dict]) -> None:
+        image_path: Path = file_ops.get_imagepath_from_metadata(metadata_filepath)
+        def on_saved() -> None:
+            if no_faces_cache is not None and len(faces) == 0:
+                no_faces_cache.add(image_path)
+            if manifest is not None:
+                manifest.image_done(image_path)
+        file_ops.save_faces(metadata_filepath, faces, file_ops.get_crop_store(), on_saved)
+    return save_faces
+# end create_save_faces()
+
 def detect_faces_loop(config: FacesConfigManager, face_functions: FaceFunctions, file_ops: FileOps):
-    dir_traverser = DirTraverser(config.root_images_dir,
-                              ignore_hidden=True)
-    
-    for dirpath in dir_traverser:
-        for file in file_ops.get_image_files(dirpath):
-            metadata_filepath = file_ops.generate_metadata_filepath(file)
-            if not metadata_filepath.exists():  # if the metadata already exists for that image, then skip it
-                faces = face_functions.detect(file)
-                file_ops.save_faces(metadata_filepath, faces)
+    # A library without any metadata yet gets every embedding of the current configuration right away
+    if len(file_ops.get_embedding_fingerprints()) == 0 and \
+            not (config.root_images_dir / config.metadata_dirname).exists() and \
+            not any(len(metadata_files) > 0 for _, metadata_files in file_ops.get_metadata_batches()):
+        file_ops.set_embedding_fingerprint(complete=True)
+
+    manifest: ScanManifest | None = None
+    if config.use_scan_manifest:
+        manifest = ScanManifest(config.root_images_dir, file_ops.get_scan_manifest_filepath(), file_ops.get_logger())
+    no_faces_cache: NoFacesCache | None = None
+    if config.use_no_faces_cache:
+        no_faces_cache = NoFacesCache(config, file_ops)
+
+    save_faces = create_save_faces(file_ops, manifest, no_faces_cache)
+    images = images_to_process(config, file_ops, manifest, no_faces_cache)
+    if config.use_pipeline:
+        detect_faces_pipeline(config, face_functions, file_ops, images, save_faces)
+    else:
+        detect_faces_sequential(config, face_functions, images, save_faces)
+
+    file_ops.flush()  # waits for the metadata writer and the catalog, which update the no faces cache
+    if no_faces_cache is not None:
+        no_faces_cache.flush()  # before the manifest, which must never get ahead of the other records
+    file_ops.close()  # after the no faces cache, which may be kept in the catalog
+    if manifest is not None:
+        manifest.close()
+
+    # Faces saved with another configuration only get the embeddings of this one once. This may run the
+    # identification model over the whole library, so only with auto_embed_faces or must_embed_faces.
+    fingerprint: dict | None = file_ops.get_embedding_fingerprints().get(config.embedding_fingerprint())
+    if fingerprint is None or not fingerprint['complete'] or fingerprint.get('storage') != config.embedding_storage:
+        if config.auto_embed_faces:
+            embed_faces_loop(config, face_functions, file_ops)
+        else:
+            file_ops.get_logger().warning('The saved faces do not all have embeddings of the current configuration in '
+                                          f'{config.embedding_storage} storage. Set must_embed_faces or auto_embed_faces '
+                                          'to compute them.')
+
+    # Faces saved before the face index existed, or with another configuration, are added once
+    if config.use_face_index and not file_ops.get_face_index().complete:
+        index_faces_loop(config, file_ops)
+
+    # The faces just saved join the clusters of the last full clustering
+    if config.use_face_index and config.incremental_clustering:
+        assign_new_faces_loop(config, file_ops)
     return
 # end detect_faces_loop()
 
-def view_faces_loop(file_ops: FileOps, face_functions: FaceFunctions) -> None:
-    global log
+def prefetch_images(config: FacesConfigManager,
+                    images: Iterator[tuple[Path, Path]]) -> Iterator[tuple[tuple[Path, Path], tuple[np.ndarray | None, float, bytes | None]]]:
+    # Decodes the next images in the background while the current one is in inference. Without
+    # prefetch threads nothing is decoded here and find_faces() decodes each image itself.
+    if config.prefetch_threads == 0:
+        return ((item, (None, 1.0, None)) for item in images)
+    return iter(ImagePrefetcher(images,
+                                config.detection_max_pixels,
+                                config.detection_refine_faces,
+                                config.prefetch_threads,
+                                config.prefetch_max_bytes))
+# end prefetch_images()
+
+def detect_faces_sequential(config: FacesConfigManager,
+                            face_functions: FaceFunctions,
+                            images: Iterator[tuple[Path, Path]],
+                            save_faces: Callable[[Path, list[dict]], None],
+                            use_workers: bool = True) -> None:
+    # With several workers each process runs its own detector and identification model and
+    # this process only writes the results. Otherwise batch the faces of many images together
+    # so the identification model always sees full batches.
+    pool = None
+    scheduler = None
+    if use_workers and config.num_workers > 1:
+        pool = FaceWorkerPool(config, on_image_done=save_faces)
+    elif config.batch_across_images:
+        scheduler = face_functions.create_embedding_scheduler(on_image_done=save_faces)
+    
+    if pool is not None:
+        for file, metadata_filepath in images:
+            pool.submit(file, metadata_filepath)
+    else:
+        for (file, metadata_filepath), (image, scale, data) in prefetch_images(config, images):
+            if scheduler is None:
+                faces = face_functions.detect(file, image, scale, data)
+                save_faces(metadata_filepath, faces)
+            else:
+                scheduler.submit(metadata_filepath, face_functions.find_faces(file, image, scale, data))
+
+    if pool is not None:
+        pool.close()
+    if scheduler is not None:
+        scheduler.close()
+    return
+# end detect_faces_sequential()
+
+def detect_faces_pipeline(config: FacesConfigManager,
+                          face_functions: FaceFunctions,
+                          file_ops: FileOps,
+                          images: Iterator[tuple[Path, Path]],
+                          save_faces: Callable[[Path, list[dict]], None]) -> None:
+    # traverse -> decode -> detect -> embed -> persist, each stage on its own threads and connected
+    # by bounded queues so that reading images from disk overlaps with inference. The queue sizes
+    # bound the number of decoded images held in memory.
+    log = file_ops.get_logger()
+    threads: dict[str, int] = config.pipeline_threads
+    pipeline = Pipeline(queue_size=config.pipeline_queue_size, log=log)
+
+    def decode(item: tuple[Path, Path], emit: Callable) -> None:
+        # Decoded at the reduced detection resolution. The file bytes are only kept when the faces
+        # are refined at full resolution, which decodes them again for the images with faces.
+        file, metadata_filepath = item
+        image, scale, data = load_for_detection(file, config.detection_max_pixels, config.detection_refine_faces)
+        if image is None:
+            log.info(f'Unable to open image file: {file.as_posix()}')
+            return
+        emit((file, metadata_filepath, image, scale, data))
+
+    def detect(item: tuple[Path, Path, np.ndarray, float, bytes | None], emit: Callable) -> None:
+        file, metadata_filepath, image, scale, data = item
+        emit((metadata_filepath, face_functions.find_faces(file, image, scale, data)))
 
-    dir_traverser = DirTraverser(root_dir=file_ops.get_images_dir(), ignore_hidden=False)
+    pipeline.add_stage('decode', decode, concurrency=threads['decode'])
+    pipeline.add_stage('detect', detect, concurrency=threads['detect'])
+
+    if config.batch_across_images:
+        # the scheduler hands every completed image to the persist stage through the embed stage
+        scheduler = face_functions.create_embedding_scheduler(
+            on_image_done=lambda metadata_filepath, faces: embed_stage.emit((metadata_filepath, faces)))
+        embed_stage = pipeline.add_stage('embed',
+                                         lambda item, emit: scheduler.submit(*item),
+                                         concurrency=1,  # the scheduler owns the batches, so it runs on a single thread
+                                         on_idle=lambda emit: scheduler.poll(),
+                                         on_close=lambda emit: scheduler.close(),
+                                         idle_timeout=config.embedding_batch_max_wait)
+    else:
+        def embed(item: tuple[Path, list], emit: Callable) -> None:
+            metadata_filepath, faces_found = item
+            faces = face_functions.face_models.generate_embeddings(faces_found) if len(faces_found) > 0 else []
+            emit((metadata_filepath, faces))
+        pipeline.add_stage('embed', embed, concurrency=threads['embed'])
+
+    pipeline.add_stage('persist', lambda item, emit: save_faces(*item), concurrency=threads['persist'])
+
+    pipeline.run(images)
+    return
+# end detect_faces_pipeline()
+
+def watch_faces_loop(config: FacesConfigManager,
+                     face_functions: FaceFunctions,
+                     file_ops: FileOps,
+                     max_run_time: float | None = None) -> None:
+    # Long running mode: builds the models once, catches up with a normal detect_faces_loop and then
+    # processes new and modified images as soon as they appear under root_images_dir. Changes are
+    # reported by inotify on Linux, or by polling the tree every watch_poll_interval seconds, and are
+    # debounced for watch_debounce_seconds so files still being copied are not read half written.
+    # Images are processed in this process so the models stay warm, num_workers is not used here.
+    # With use_scan_manifest the images processed are recorded in the manifest, so the next run of
+    # detect_faces_loop does not process them again.
+    log = file_ops.get_logger()
+    face_functions.face_models.get_face_detector_model()
+    face_functions.face_models.get_identification_model()
+
+    detect_faces_loop(config, face_functions, file_ops)
+
+    watcher: InotifyWatcher | PollingWatcher | None = None
+    if config.watch_use_inotify:
+        try:
+            watcher = InotifyWatcher(config.root_images_dir, log)
+        except OSError as e:
+            log.warning(f'Unable to watch with inotify ({e}), falling back to polling.')
+    if watcher is None:
+        watcher = PollingWatcher(lambda: file_ops.get_image_batches(num_threads=config.traversal_threads),
+                                 config.watch_poll_interval,
+                                 log)
+
+    manifest: ScanManifest | None = None
+    if config.use_scan_manifest:  # as saved by detect_faces_loop
+        manifest = ScanManifest(config.root_images_dir, file_ops.get_scan_manifest_filepath(), log)
+    no_faces_cache: NoFacesCache | None = NoFacesCache(config, file_ops) if config.use_no_faces_cache else None
+    save_faces = create_save_faces(file_ops, manifest, no_faces_cache)
+    debouncer = Debouncer(config.watch_debounce_seconds)
+    metadata_dirname: str = file_ops.get_metadata_dirname()
+    image_file_types: set[str] = set(config.image_file_types)
+    start_time: float = time.time()
+
+    try:
+        while max_run_time is None or time.time() - start_time < max_run_time:
+            events = watcher.wait(timeout=max(config.watch_debounce_seconds / 2, 0.1))
+            if events.overflow:
+                log.warning('Watch events were lost, rescanning the whole tree.')
+                if manifest is not None:
+                    manifest.save()
+                detect_faces_loop(config, face_functions, file_ops)
+                if manifest is not None:
+                    manifest.load()  # as saved by the rescan
+            debouncer.add([path for path in events.paths
+                           if path.suffix in image_file_types and metadata_dirname not in path.parts])
+
+            ready_paths: list[Path] = debouncer.pop_ready()
+            for path in ready_paths:
+                if not path.exists():  # deleted or moved away
+                    file_ops.remove_faces(file_ops.generate_metadata_filepath(path))
+            image_files: list[FileInfo] = []
+            for path in ready_paths:
+                try:
+                    stat_result = path.stat()
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(stat_result.st_mode):
+                    image_files.append(FileInfo(path, stat_result.st_size, stat_result.st_mtime_ns))
+            images: list[tuple[Path, Path]] = [(image_file.path, file_ops.generate_metadata_filepath(image_file.path))
+                                               for image_file in image_files]
+            if manifest is not None:
+                # Records the changed images, before they are saved
+                for dir_path in sorted(set(path.parent for path in ready_paths)):
+                    if dir_path.is_dir():
+                        manifest.begin_watched_images(dir_path,
+                                                      [path for path in ready_paths if path.parent == dir_path],
+                                                      [image_file for image_file in image_files if image_file.path.parent == dir_path])
+            if len(images) > 0:
+                log.info(f'Processing {len(images)} new or modified image(s).')
+                detect_faces_sequential(config, face_functions, iter(images), save_faces, use_workers=False)
+                file_ops.flush()  # waits for the metadata writer, which updates the no faces cache
+                if no_faces_cache is not None:
+                    no_faces_cache.flush()
+    finally:
+        watcher.close()
+        file_ops.flush()
+        if no_faces_cache is not None:
+            no_faces_cache.flush()  # before the manifest, which must never get ahead of the other records
+        file_ops.close()
+        if manifest is not None:
+            manifest.close(traversal_completed=False)
+    return
+# end watch_faces_loop()
 
-    for dirpath in dir_traverser:
-        if dirpath.name == file_ops.get_metadata_dirname(): 
-            for file in file_ops.get_metadata_files(dirpath):
-                image_path = file_ops.get_imagepath_from_metadata(file)
+def face_boxes(faces: list[dict]) -> np.ndarray:
+    # (N, 4) x, y, w, h array of the areas of the faces
+    return np.array([[face['area'][key] for key in ['x', 'y', 'w', 'h']] for face in faces], dtype=np.float64).reshape(-1, 4)
+# end face_boxes()
+
+def embed_faces_loop(config: FacesConfigManager,
+                     face_functions: FaceFunctions,
+                     file_ops: FileOps,
+                     recompute: bool = False) -> None:
+    # Fills in the embeddings of the current configuration (see FacesConfigManager.embedding_fingerprint)
+    # for the saved faces that do not have one yet, e.g. after changing identification_model_name,
+    # keeping the embeddings of the other configurations, and moves them to embedding_storage if it
+    # changed. With recompute every embedding of the current configuration is computed again. The crops
+    # come from the crop store, so faces are not detected again, except in images saved before the crop
+    # store existed or whose crops were kept padded to an older model. Their faces keep their names and
+    # other embeddings when detection finds them again, in areas overlapping the saved ones by more than
+    # redetect_iou_threshold.
+    log = file_ops.get_logger()
+    crop_store: FaceCropStore | None = file_ops.get_crop_store()
+    face_models = face_functions.face_models
+    batch_size: int = config.embedding_batch_size
+    pending_files: list[tuple[Path, list[dict]]] = []
+    pending_crops: list[tuple[dict, np.ndarray]] = []
+    file_count: int = 0
+    redetect_count: int = 0
+
+    def embed_pending() -> None:
+        for batch_start in range(0, len(pending_crops), batch_size):
+            batch = pending_crops[batch_start:batch_start + batch_size]
+            embeddings = face_models.get_representations([crop for _, crop in batch])
+            for (face, _), embedding in zip(batch, embeddings):
+                face_models.set_embedding(face, embedding)
+        for metadata_filepath, faces in pending_files:
+            file_ops.save_faces(metadata_filepath, faces)
+        pending_files.clear()
+        pending_crops.clear()
+
+    def needs_storage_change(faces: list[dict]) -> bool:
+        # Saving again moves the embeddings to the configured embedding_storage
+        if config.embedding_storage == 'mmap':
+            return any(set(face.get('embeddings', {})) - set(face.get('embedding_rows', {})) for face in faces)
+        return any(set(face.get('embeddings', {})) & set(face.get('embedding_rows', {})) for face in faces)
+
+    start_time = time.time()
+    file_ops.set_embedding_fingerprint(complete=False)
+    for _, metadata_files in file_ops.get_metadata_batches(num_threads=config.traversal_threads):
+        for metadata_file in metadata_files:
+            faces: list[dict] | None = file_ops.get_saved_faces(metadata_file.path)
+            if faces is None:
+                continue
+            faces_to_embed: list[dict] = [face for face in faces if recompute or face_models.get_embedding(face) is None]
+            if len(faces_to_embed) == 0:
+                if needs_storage_change(faces):
+                    file_ops.save_faces(metadata_file.path, faces)
+                continue
+            file_count += 1
+            # Crops kept padded to the model of the time are not used, see FaceCropStore
+            crops: list[np.ndarray | None] = [crop_store.get(face['crop_id'])
+                                              if crop_store is not None and 'crop_id' in face and crop_store.is_unpadded(face['crop_id']) else None
+                                              for face in faces_to_embed]
+            if any(crop is None for crop in crops):
+                image_path: Path = file_ops.get_imagepath_from_metadata(metadata_file.path)
                 if image_path.exists():
-                    faces = file_ops.get_saved_faces(file)
-                    if faces is None:
-                        log.info(f'No faces available for image file: {file.as_posix()}')
-                    else:
-                        image = file_ops.get_image(image_path)
-                        if image is None:
-                            log.info(f'Unable to open image file: {file.as_posix()}')
-                        else:
-                            face_functions.view_faces(image, faces)
+                    detected_faces: list[dict] = face_functions.detect(image_path)
+                    for detected_index, saved_index in match_boxes(face_boxes(detected_faces), face_boxes(faces), config.redetect_iou_threshold):
+                        face, saved_face = detected_faces[detected_index], faces[saved_index]
+                        face['name'] = saved_face.get('name')
+                        face['embeddings'] = {**saved_face.get('embeddings', {}), **face['embeddings']}
+                        face['embedding_rows'] = saved_face.get('embedding_rows', {})
+                    file_ops.save_faces(metadata_file.path, detected_faces, crop_store)
+                    redetect_count += 1
+                continue
+            pending_files.append((metadata_file.path, faces))
+            pending_crops.extend(zip(faces_to_embed, crops))
+            if len(pending_crops) >= batch_size:
+                embed_pending()
+    embed_pending()
+    file_ops.close()
+    file_ops.set_embedding_fingerprint(complete=True)
+    log.info(f'Embedded the faces of {file_count} image(s), {redetect_count} of them detected again, in {time.time() - start_time} seconds.')
+    return
+# end embed_faces_loop()
+
+def index_faces_loop(config: FacesConfigManager, file_ops: FileOps) -> None:
+    # Adds every saved face with an embedding of the current configuration to the face index. Faces
+    # already in it are left as they are, so an interrupted run just starts over. This runs once, when
+    # use_face_index is first set or the embedding configuration changes, and reads every metadata file.
+    log = file_ops.get_logger()
+    start_time = time.time()
+    face_index = file_ops.get_face_index()
+    log.info(f'Indexing the saved faces once, {len(face_index)} already indexed. This reads the metadata of the whole library.')
+    for _, metadata_files in file_ops.get_metadata_batches(num_threads=config.traversal_threads):
+        for metadata_file in metadata_files:
+            faces: list[dict] | None = file_ops.get_saved_faces(metadata_file.path)
+            if faces is not None:
+                file_ops.index_faces(metadata_file.path, faces)
+    face_index.set_complete(True)
+    log.info(f'Indexed {len(face_index)} face(s) in {time.time() - start_time} seconds.')
+    file_ops.close()
+    return
+# end index_faces_loop()
+
+def cluster_faces_loop(config: FacesConfigManager, file_ops: FileOps) -> None:
+    # Groups every face of the library into people and saves the cluster names, cluster_name_prefix and
+    # a number, as the names of the faces the user has not named, see name_clusters(). The neighbor graph
+    # comes from the face index: each face is only compared with its cluster_neighbors nearest faces
+    # within distance_threshold, found through the index lists, or exhaustively with face_index_exact.
+    # Without use_face_index the index is built from the saved faces for this clustering only, which
+    # reads the metadata of the whole library each time, and is deleted afterwards.
+    log = file_ops.get_logger()
+    if not config.use_face_index:
+        file_ops.remove_face_index()  # left behind by an interrupted clustering, may be out of date
+        index_faces_loop(config, file_ops)
+    elif not file_ops.get_face_index().complete:
+        index_faces_loop(config, file_ops)
+
+    start_time = time.time()
+    keys, names, neighbors, distances = file_ops.get_face_index().get_neighbor_graph(config.cluster_neighbors,
+                                                                                     config.distance_threshold,
+                                                                                     config.face_index_exact,
+                                                                                     config.distance_threads)
+    log.info(f'Found the neighbors of {len(keys)} face(s) in {time.time() - start_time} seconds.')
+    labels: np.ndarray = chinese_whispers(neighbors, distances, config.distance_threshold, config.cluster_iterations)
+    new_names: list[str | None] = name_clusters(labels, names, config.cluster_name_prefix, config.cluster_min_size)
+
+    renamed: dict[str, dict[int, str | None]] = {}  # image path -> face index -> new name
+    for (image_path, face_index), name, new_name in zip(keys, names, new_names):
+        if new_name != name:
+            renamed.setdefault(image_path, {})[face_index] = new_name
+    save_face_names(config, file_ops, renamed)
+    # Incremental clustering starts over from here, see assign_new_faces_loop()
+    file_ops.get_face_index().clear_new()
+    file_ops.set_cluster_state({'faces': len(keys),
+                                'changed': 0,
+                                'pending': [],
+                                'next_cluster': next_cluster_number(names + new_names, config.cluster_name_prefix)})
+    if not config.use_face_index:
+        file_ops.remove_face_index()
+    file_ops.close()
+    cluster_count: int = len(set(name for name in new_names if name is not None and name.startswith(config.cluster_name_prefix)))
+    log.info(f'Clustered {len(keys)} face(s) into {cluster_count} cluster(s), renamed {sum(len(faces) for faces in renamed.values())} '
+             f'face(s) in {len(renamed)} image(s), in {time.time() - start_time} seconds.')
+    return
+# end cluster_faces_loop()
+
+def save_face_names(config: FacesConfigManager, file_ops: FileOps, renamed: dict[str, dict[int, str | None]]) -> None:
+    # Saves the new names, image path -> face index -> new name, once per image
+    for image_path, new_face_names in renamed.items():
+        metadata_filepath: Path = file_ops.generate_metadata_filepath(config.root_images_dir / image_path)
+        faces: list[dict] | None = file_ops.get_saved_faces(metadata_filepath)
+        if faces is None:
+            continue
+        for face_index, new_name in new_face_names.items():
+            if face_index < len(faces):
+                faces[face_index]['name'] = new_name
+        file_ops.save_faces(metadata_filepath, faces)
+    return
+# end save_face_names()
+
+def assign_new_faces_loop(config: FacesConfigManager, file_ops: FileOps) -> None:
+    # Names the faces added to the face index since the last clustering without clustering the library
+    # again, so the cost follows the number of new faces:
+    #   - a new unnamed face takes the name most frequent among its cluster_neighbors nearest named faces
+    #     within distance_threshold, a cluster name or a name given by the user, as in identify_faces()
+    #   - the faces that match no one wait in a pending pool, which is clustered on its own together
+    #     with the unnamed faces near it; clusters of cluster_min_size faces get new cluster names and
+    #     leave the pool
+    #   - once the faces added since the last full clustering exceed cluster_recluster_fraction of the
+    #     faces clustered then, clusters may have to split or merge, so the library is clustered again
+    # Nothing is done until the library was clustered once with cluster_faces_loop().
+    log = file_ops.get_logger()
+    state: dict | None = file_ops.get_cluster_state()
+    if state is None:
+        return
+    face_index = file_ops.get_face_index()
+    new_faces: list[tuple[str, int, str | None]] = face_index.get_new_faces()
+    if len(new_faces) == 0:
+        return
+    state['changed'] += len(new_faces)
+    if state['changed'] > config.cluster_recluster_fraction * state['faces']:
+        log.info(f'{state["changed"]} face(s) were added since the faces were clustered, clustering them again.')
+        cluster_faces_loop(config, file_ops)
+        return
+
+    start_time = time.time()
+    pending: list[tuple[str, int]] = [(image_path, index) for image_path, index in state['pending']
+                                      if index in face_index.get_face_indices(image_path)]  # not removed since
+    queries: list[tuple[str, int]] = list(dict.fromkeys(pending + [(image_path, index) for image_path, index, name in new_faces if name is None]))
+    neighbors = face_index.get_neighbors(queries,
+                                         config.cluster_neighbors,
+                                         config.distance_threshold,
+                                         config.face_index_exact,
+                                         config.distance_threads)
+    assigned: dict[tuple[str, int], str] = {}
+    unmatched: dict[tuple[str, int], list[tuple[str, int, str | None, float]]] = {}
+    for key, face_neighbors in zip(queries, neighbors):
+        votes: dict[str, int] = {}
+        for _, _, name, _ in face_neighbors:  # nearest first
+            if name is not None:
+                votes[name] = votes.get(name, 0) + 1
+        if len(votes) > 0:
+            assigned[key] = max(votes, key=votes.get)  # on a tie, the name seen first, i.e. the nearest
+        else:
+            unmatched[key] = face_neighbors
+
+    # The pending pool and its unnamed neighbors, clustered over the edges of the pool faces only. Its
+    # neighbors are all unnamed, but some may have been assigned a name just above: these keep it and
+    # lend it to the pool faces clustered with them.
+    nodes: dict[tuple[str, int], int] = {key: position for position, key in enumerate(unmatched)}
+    for face_neighbors in unmatched.values():
+        for image_path, index, _, _ in face_neighbors:
+            nodes.setdefault((image_path, index), len(nodes))
+    graph_neighbors: np.ndarray = np.full((len(nodes), config.cluster_neighbors), -1, dtype=np.int64)
+    graph_distances: np.ndarray = np.full((len(nodes), config.cluster_neighbors), np.inf, dtype=np.float32)
+    for position, face_neighbors in enumerate(unmatched.values()):
+        for column, (image_path, index, _, distance) in enumerate(face_neighbors):
+            graph_neighbors[position, column] = nodes[(image_path, index)]
+            graph_distances[position, column] = distance
+    labels: np.ndarray = chinese_whispers(graph_neighbors, graph_distances, config.distance_threshold, config.cluster_iterations)
+    names: list[str | None] = [assigned.get(key) for key in nodes]
+    new_names: list[str | None] = name_clusters(labels,
+                                                names,
+                                                config.cluster_name_prefix,
+                                                config.cluster_min_size,
+                                                state['next_cluster'],
+                                                is_fixed=[key in assigned for key in nodes])
+
+    renamed: dict[str, dict[int, str | None]] = {}  # image path -> face index -> new name
+    for (image_path, index), name in assigned.items():
+        renamed.setdefault(image_path, {})[index] = name
+    for (image_path, index), name, new_name in zip(nodes, names, new_names):
+        if (image_path, index) not in assigned and new_name != name:
+            renamed.setdefault(image_path, {})[index] = new_name
+    save_face_names(config, file_ops, renamed)
+
+    face_index.clear_new([(image_path, index) for image_path, index, _ in new_faces])
+    state['pending'] = [list(key) for key, new_name in zip(nodes, new_names) if key in unmatched and new_name is None]
+    state['next_cluster'] = next_cluster_number(new_names, config.cluster_name_prefix, state['next_cluster'])
+    file_ops.set_cluster_state(state)
+    file_ops.close()
+    log.info(f'Assigned {len(assigned)} of {len(queries)} new or pending face(s) to existing names, named '
+             f'{sum(1 for name, new_name in zip(names, new_names) if new_name != name)} face(s) after new clusters and left '
+             f'{len(state["pending"])} face(s) pending, in {time.time() - start_time} seconds.')
+    return
+# end assign_new_faces_loop()
+
+def view_faces_loop(file_ops: FileOps, face_functions: FaceFunctions) -> None:
+    global log
+
+    # Only the metadata directories are yielded, together with their metadata files
+    for _, metadata_files in file_ops.get_metadata_batches():
+        for metadata_file in metadata_files:
+            file = metadata_file.path
+            image_path = file_ops.get_imagepath_from_metadata(file)
+            if image_path.exists():
+                faces = file_ops.get_saved_faces(file)
+                if faces is None:
+                    log.info(f'No faces available for image file: {file.as_posix()}')
                 else:
-                    log.info(f'File does not exist: {image_path.as_posix()}')
+                    image = file_ops.get_image(image_path)
+                    if image is None:
+                        log.info(f'Unable to open image file: {file.as_posix()}')
+                    else:
+                        face_functions.view_faces(image, faces)
+            else:
+                log.info(f'File does not exist: {image_path.as_posix()}')
     return
 # end view_faces_loop()
 
@@ -55,6 +584,12 @@ def main() -> None:
     debug = True
     must_remove_metadata: bool = False
     must_view_faces: bool = True
+    must_watch_faces: bool = False  # Keep running and process new images as they are added
+    must_embed_faces: bool = False  # Computes the missing embeddings of the current configuration, e.g. after changing models
+    must_reembed_faces: bool = False  # Computes the embeddings of the current configuration again for every face
+    must_import_metadata_from_json: bool = False  # Loads the JSON metadata files into the catalog of the sqlite metadata_backend
+    must_export_metadata_to_json: bool = False  # Writes the catalog of the sqlite metadata_backend as JSON metadata files
+    must_cluster_faces: bool = False  # Groups the faces into people and names the unnamed faces after their group
 
     log_name: str = Path(Path(__file__).name).stem
     log_path = Path(log_name + '.log')
@@ -68,13 +603,31 @@ def main() -> None:
     face_functions: FaceFunctions = FaceFunctions(faces_config)
 
     if must_remove_metadata:  # For debugging or when needing to regenerate all face metadata
-        remove_metadata(file_ops.get_images_dir())
+        remove_metadata(file_ops.get_images_dir(), num_threads=faces_config.traversal_threads)
+
+    if must_import_metadata_from_json:
+        log.info(f'Imported the JSON metadata of {file_ops.import_metadata_from_json()} image(s) into the catalog.')
+
+    if must_reembed_faces:
+        embed_faces_loop(faces_config, face_functions, file_ops, recompute=True)
+    elif must_embed_faces:
+        embed_faces_loop(faces_config, face_functions, file_ops)
 
     # Skips images that already have face metadata files
-    detect_faces_loop(faces_config, face_functions, file_ops)
+    if must_watch_faces:
+        watch_faces_loop(faces_config, face_functions, file_ops)
+    else:
+        detect_faces_loop(faces_config, face_functions, file_ops)
+
+    if must_cluster_faces:
+        cluster_faces_loop(faces_config, file_ops)
 
     if must_view_faces:
         view_faces_loop(file_ops, face_functions)
+
+    if must_export_metadata_to_json:
+        log.info(f'Exported the metadata of {file_ops.export_metadata_to_json()} image(s) from the catalog to JSON.')
+        file_ops.close()
     return
 # end main
 
@@ -0,0 +1,525 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+import base64
+import json
+import math
+import os
+import threading
+import numpy as np
+
+from distances import PreparedEmbeddings, prepare_embeddings, distance_block, slice_embeddings, top_k
+
+def encode_strings(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    # The strings as one uint8 array of their UTF-8 bytes and the (len(strings) + 1,) offsets of each in
+    # it, so that a snapshot takes the size of the strings and not len(strings) times the longest one
+    encoded: list[bytes] = [string.encode('utf-8') for string in strings]
+    offsets: np.ndarray = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+# end encode_strings()
+
+def decode_strings(data: np.ndarray, offsets: np.ndarray) -> list[str]:
+    data_bytes: bytes = data.tobytes()
+    bounds: list[int] = offsets.tolist()
+    return [data_bytes[start:end].decode('utf-8') for start, end in zip(bounds[:-1], bounds[1:])]
+# end decode_strings()
+
+class FaceIndex:
+    # Approximate nearest neighbor index (IVF, inverted file) over the embeddings of one configuration
+    # (one embedding fingerprint) for a whole library. Faces are keyed by the image path, relative to the
+    # library root, and the index of the face in its metadata, and keep their name.
+    #
+    # The embeddings are split into lists by their nearest centroid, k-means centroids trained on the
+    # embeddings themselves. A query only computes distances to the centroids and to the faces of the
+    # num_probes nearest lists, about num_probes / lists of the library. Until train_size faces have been
+    # added the index is a single list searched exhaustively. It is trained again, with about 4 sqrt(faces)
+    # lists up to max_lists, whenever the number of faces grows fourfold since the last training.
+    #
+    #   <name>.npz      snapshot: the embeddings (prepared for the metric), their lists, keys and names,
+    #                   and the centroids, written atomically. Paths and names are kept as UTF-8 bytes
+    #                   with their offsets, see encode_strings().
+    #   <name>.journal  the changes since the snapshot, one JSON line each, replayed when the index is
+    #                   opened. A line cut short by a crash is ignored.
+    #
+    # flush() syncs the journal, or writes a new snapshot once the journal holds a quarter of the index.
+    # complete is set once every saved face has been added, see index_faces_loop() in extract_faces.
+    # Faces added, or added again with another embedding, are flagged as new until clear_new(), so the
+    # faces ingested since the last clustering are found without looking at the others.
+
+    KMEANS_ITERATIONS: int = 10
+    KMEANS_SAMPLES_PER_LIST: int = 64
+    BLOCK_SIZE: int = 4096
+
+    def __init__(self,
+                 store_dir: Path,
+                 name: str,
+                 distance_metric: str,
+                 num_probes: int = 16,
+                 train_size: int = 20000,
+                 max_lists: int = 4096) -> None:
+        self.snapshot_filepath: Path = store_dir / (name + '.npz')
+        self.journal_filepath: Path = store_dir / (name + '.journal')
+        self.distance_metric: str = distance_metric
+        self.num_probes: int = num_probes
+        self.train_size: int = train_size
+        self.max_lists: int = max_lists
+        self._lock = threading.Lock()
+        store_dir.mkdir(parents=True, exist_ok=True)
+
+        self.complete: bool = False
+        self.dimensions: int | None = None
+        self._vectors: np.ndarray = np.zeros((0, 0), dtype=np.float32)  # one row per slot, some free
+        self._squared_norms: np.ndarray = np.zeros(0, dtype=np.float32)  # only used by euclidean
+        self._slot_lists: np.ndarray = np.zeros(0, dtype=np.int32)  # list of each slot, -1 when free
+        self._slot_new: np.ndarray = np.zeros(0, dtype=bool)
+        self._slot_keys: list[tuple[str, int] | None] = []
+        self._slot_names: list[str | None] = []
+        self._free_slots: list[int] = []
+        self._slots: dict[tuple[str, int], int] = {}  # key -> slot
+        self._image_faces: dict[str, set[int]] = {}  # image path -> face indices
+        self._centroids: PreparedEmbeddings | None = None
+        self._members: list[list[int]] = [[]]  # slots of each list
+        self._member_arrays: list[np.ndarray | None] = [None]  # _members as arrays, built on demand
+        self._trained_count: int = 0
+        self._journal_count: int = 0
+
+        self._load_snapshot()
+        self._replay_journal()
+        self._journal_fp = self.journal_filepath.open('a', encoding='utf-8')
+        return
+    # end __init__()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._slots)
+    # end __len__()
+
+    def _load_snapshot(self) -> None:
+        if not self.snapshot_filepath.exists():
+            return
+        with np.load(self.snapshot_filepath, allow_pickle=False) as snapshot:
+            if str(snapshot['distance_metric']) != self.distance_metric:
+                self.journal_filepath.unlink(missing_ok=True)  # built for another metric, start over
+                return
+            self.complete = bool(snapshot['complete'])
+            self._trained_count = int(snapshot['trained_count'])
+            vectors: np.ndarray = snapshot['vectors']
+            slot_lists: np.ndarray = snapshot['lists']
+            centroids: np.ndarray = snapshot['centroids']
+            if len(vectors) == 0:
+                return
+            self._set_capacity(len(vectors), vectors.shape[1])
+            self._free_slots = []
+            self._vectors[:len(vectors)] = vectors
+            if self.distance_metric == 'euclidean':
+                self._squared_norms[:len(vectors)] = np.einsum('ij,ij->i', vectors, vectors)
+            self._slot_lists[:len(vectors)] = slot_lists
+            if 'is_new' in snapshot:
+                self._slot_new[:len(vectors)] = snapshot['is_new']
+            paths: list[str] = decode_strings(snapshot['paths'], snapshot['path_offsets'])
+            names: list[str] = decode_strings(snapshot['names'], snapshot['name_offsets'])
+            face_indices: list[int] = snapshot['face_indices'].tolist()
+            has_names: list[bool] = snapshot['has_names'].tolist()
+        self._slot_keys = [(path, face_index) for path, face_index in zip(paths, face_indices)]
+        self._slot_names = [name if has_name else None for name, has_name in zip(names, has_names)]
+        for slot, key in enumerate(self._slot_keys):
+            self._slots[key] = slot
+            self._image_faces.setdefault(key[0], set()).add(key[1])
+        list_count: int = max(len(centroids), 1)
+        if len(centroids) > 0:
+            self._centroids = PreparedEmbeddings(centroids,
+                                                 np.einsum('ij,ij->i', centroids, centroids) if self.distance_metric == 'euclidean' else None,
+                                                 self.distance_metric)
+        self._members = [[] for _ in range(list_count)]
+        for slot, list_id in enumerate(slot_lists.tolist()):
+            self._members[list_id].append(slot)
+        self._member_arrays = [None] * list_count
+        return
+    # end _load_snapshot()
+
+    def _replay_journal(self) -> None:
+        if not self.journal_filepath.exists():
+            return
+        with self.journal_filepath.open('r', encoding='utf-8') as journal_fp:
+            for line in journal_fp:
+                try:
+                    change: dict = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # the last line, cut short
+                key: tuple[str, int] = (change.get('path'), change.get('face'))
+                if change['op'] == 'add':
+                    vector: np.ndarray = np.frombuffer(base64.b64decode(change['vector']), dtype=np.float32)
+                    self._add(key, vector, change['name'])
+                elif change['op'] == 'remove':
+                    self._remove(key)
+                elif change['op'] == 'name':
+                    self._set_name(key, change['name'])
+                elif change['op'] == 'complete':
+                    self.complete = change['complete']
+                elif change['op'] == 'seen':
+                    self._clear_new([tuple(key) for key in change['keys']])
+                self._journal_count += 1
+        return
+    # end _replay_journal()
+
+    def _journal(self, change: dict) -> None:
+        # Called with the lock held
+        self._journal_fp.write(json.dumps(change, separators=(',', ':')) + '\n')
+        self._journal_count += 1
+        return
+    # end _journal()
+
+    def _set_capacity(self, capacity: int, dimensions: int) -> None:
+        # Called with the lock held. Grows the slot arrays, keeping their contents.
+        self.dimensions = dimensions
+        old_count: int = len(self._slot_lists)
+        vectors: np.ndarray = np.zeros((capacity, dimensions), dtype=np.float32)
+        if old_count > 0:
+            vectors[:old_count] = self._vectors[:old_count]
+        self._vectors = vectors
+        self._squared_norms = np.concatenate([self._squared_norms, np.zeros(capacity - old_count, dtype=np.float32)])
+        self._slot_lists = np.concatenate([self._slot_lists, np.full(capacity - old_count, -1, dtype=np.int32)])
+        self._slot_new = np.concatenate([self._slot_new, np.zeros(capacity - old_count, dtype=bool)])
+        self._free_slots.extend(range(capacity - 1, old_count - 1, -1))  # lowest slots are used first
+        self._slot_keys.extend([None] * (capacity - old_count))
+        self._slot_names.extend([None] * (capacity - old_count))
+        return
+    # end _set_capacity()
+
+    def _get_members(self, list_id: int) -> np.ndarray:
+        # Called with the lock held
+        if self._member_arrays[list_id] is None:
+            self._member_arrays[list_id] = np.array(self._members[list_id], dtype=np.int64)
+        return self._member_arrays[list_id]
+    # end _get_members()
+
+    def _nearest_lists(self, vectors: PreparedEmbeddings, count: int) -> np.ndarray:
+        # Called with the lock held. (len(vectors), count) lists nearest to each vector, nearest first.
+        if self._centroids is None:
+            return np.zeros((len(vectors.vectors), 1), dtype=np.int64)
+        count = min(count, len(self._centroids.vectors))
+        nearest: np.ndarray = np.zeros((len(vectors.vectors), count), dtype=np.int64)
+        for start in range(0, len(vectors.vectors), self.BLOCK_SIZE):
+            distances: np.ndarray = distance_block(slice_embeddings(vectors, start, start + self.BLOCK_SIZE), self._centroids)
+            if count < distances.shape[1]:
+                candidates: np.ndarray = np.argpartition(distances, count - 1, axis=1)[:, :count]
+            else:
+                candidates = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+            order: np.ndarray = np.argsort(np.take_along_axis(distances, candidates, axis=1), axis=1)
+            nearest[start:start + len(distances)] = np.take_along_axis(candidates, order, axis=1)
+        return nearest
+    # end _nearest_lists()
+
+    def _add(self, key: tuple[str, int], vector: np.ndarray, name: str | None) -> None:
+        # Called with the lock held. vector is prepared.
+        self._remove(key)
+        if self.dimensions is None:
+            self._set_capacity(0, len(vector))
+        assert len(vector) == self.dimensions, f'Embedding of {len(vector)} dimensions in an index of {self.dimensions} dimensions'
+        if len(self._free_slots) == 0:
+            self._set_capacity(max(2 * len(self._slot_lists), 1024), self.dimensions)
+        slot = self._free_slots.pop()
+        self._vectors[slot] = vector
+        if self.distance_metric == 'euclidean':
+            self._squared_norms[slot] = np.dot(vector, vector)
+        self._slot_keys[slot] = key
+        self._slot_names[slot] = name
+        self._slot_new[slot] = True
+        self._slots[key] = slot
+        self._image_faces.setdefault(key[0], set()).add(key[1])
+        list_id: int = int(self._nearest_lists(self._prepared(np.array([slot])), 1)[0, 0])
+        self._slot_lists[slot] = list_id
+        self._members[list_id].append(slot)
+        self._member_arrays[list_id] = None
+
+        if (self._centroids is None and len(self._slots) >= self.train_size) or \
+                (self._centroids is not None and len(self._slots) >= 4 * self._trained_count):
+            self._train()
+        return
+    # end _add()
+
+    def _remove(self, key: tuple[str, int]) -> bool:
+        # Called with the lock held
+        slot: int | None = self._slots.pop(key, None)
+        if slot is None:
+            return False
+        list_id: int = int(self._slot_lists[slot])
+        self._members[list_id].remove(slot)
+        self._member_arrays[list_id] = None
+        self._slot_lists[slot] = -1
+        self._slot_new[slot] = False
+        self._slot_keys[slot] = None
+        self._slot_names[slot] = None
+        self._free_slots.append(slot)
+        faces: set[int] = self._image_faces[key[0]]
+        faces.discard(key[1])
+        if len(faces) == 0:
+            del self._image_faces[key[0]]
+        return True
+    # end _remove()
+
+    def _set_name(self, key: tuple[str, int], name: str | None) -> bool:
+        # Called with the lock held
+        slot: int | None = self._slots.get(key)
+        if slot is None or self._slot_names[slot] == name:
+            return False
+        self._slot_names[slot] = name
+        return True
+    # end _set_name()
+
+    def _clear_new(self, keys: list[tuple[str, int]]) -> None:
+        # Called with the lock held
+        for key in keys:
+            slot: int | None = self._slots.get(key)
+            if slot is not None:
+                self._slot_new[slot] = False
+        return
+    # end _clear_new()
+
+    def _prepared(self, slots: np.ndarray) -> PreparedEmbeddings:
+        # Called with the lock held. The embeddings of slots, a copy.
+        squared_norms: np.ndarray | None = self._squared_norms[slots] if self.distance_metric == 'euclidean' else None
+        return PreparedEmbeddings(self._vectors[slots], squared_norms, self.distance_metric)
+    # end _prepared()
+
+    def _train(self) -> None:
+        # Called with the lock held. k-means on a sample of the faces, then every face is assigned again.
+        used_slots: np.ndarray = np.flatnonzero(self._slot_lists >= 0)
+        list_count: int = max(1, min(self.max_lists, int(4 * math.sqrt(len(used_slots))), len(used_slots)))
+        rng = np.random.default_rng(len(used_slots))
+        sample_size: int = min(len(used_slots), self.KMEANS_SAMPLES_PER_LIST * list_count)
+        samples: PreparedEmbeddings = self._prepared(np.sort(rng.choice(used_slots, sample_size, replace=False)))
+        self._centroids = self._prepare_centroids(samples.vectors[rng.choice(sample_size, list_count, replace=False)])
+        for _ in range(self.KMEANS_ITERATIONS):
+            labels: np.ndarray = self._nearest_lists(samples, 1)[:, 0]
+            order: np.ndarray = np.argsort(labels, kind='stable')
+            counts: np.ndarray = np.bincount(labels, minlength=list_count)
+            nonempty: np.ndarray = np.flatnonzero(counts)
+            starts: np.ndarray = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+            centroids: np.ndarray = self._centroids.vectors.copy()  # empty lists keep their centroid
+            centroids[nonempty] = np.add.reduceat(samples.vectors[order], starts, axis=0) / counts[nonempty, np.newaxis]
+            self._centroids = self._prepare_centroids(centroids)
+
+        self._members = [[] for _ in range(list_count)]
+        self._member_arrays = [None] * list_count
+        for start in range(0, len(used_slots), self.BLOCK_SIZE):
+            slots: np.ndarray = used_slots[start:start + self.BLOCK_SIZE]
+            labels = self._nearest_lists(self._prepared(slots), 1)[:, 0]
+            self._slot_lists[slots] = labels
+            for slot, label in zip(slots.tolist(), labels.tolist()):
+                self._members[label].append(slot)
+        self._trained_count = len(used_slots)
+        return
+    # end _train()
+
+    def _prepare_centroids(self, centroids: np.ndarray) -> PreparedEmbeddings:
+        # Means of normalized embeddings are normalized again (spherical k-means) for cosine and euclidean_l2
+        return prepare_embeddings(centroids, self.distance_metric)
+    # end _prepare_centroids()
+
+    def add(self, image_path: str, face_index: int, embedding: list[float] | np.ndarray, name: str | None) -> None:
+        # Adds a face, or replaces the one saved with the same key. A face added again with the same
+        # embedding only has its name updated.
+        vector: np.ndarray = prepare_embeddings([embedding], self.distance_metric).vectors[0]
+        key: tuple[str, int] = (image_path, face_index)
+        with self._lock:
+            slot: int | None = self._slots.get(key)
+            if slot is not None and np.array_equal(self._vectors[slot], vector):
+                if self._set_name(key, name):
+                    self._journal({'op': 'name', 'path': image_path, 'face': face_index, 'name': name})
+                return
+            self._add(key, vector, name)
+            self._journal({'op': 'add', 'path': image_path, 'face': face_index, 'name': name,
+                           'vector': base64.b64encode(vector.tobytes()).decode('ascii')})
+        return
+    # end add()
+
+    def remove(self, image_path: str, face_index: int) -> None:
+        with self._lock:
+            if self._remove((image_path, face_index)):
+                self._journal({'op': 'remove', 'path': image_path, 'face': face_index})
+        return
+    # end remove()
+
+    def remove_image(self, image_path: str) -> None:
+        # Removes every face of the image
+        with self._lock:
+            for face_index in sorted(self._image_faces.get(image_path, set())):
+                self._remove((image_path, face_index))
+                self._journal({'op': 'remove', 'path': image_path, 'face': face_index})
+        return
+    # end remove_image()
+
+    def get_face_indices(self, image_path: str) -> set[int]:
+        with self._lock:
+            return set(self._image_faces.get(image_path, set()))
+    # end get_face_indices()
+
+    def set_name(self, image_path: str, face_index: int, name: str | None) -> None:
+        with self._lock:
+            if self._set_name((image_path, face_index), name):
+                self._journal({'op': 'name', 'path': image_path, 'face': face_index, 'name': name})
+        return
+    # end set_name()
+
+    def get_new_faces(self) -> list[tuple[str, int, str | None]]:
+        # (image path, face index, name) of the faces flagged as new
+        with self._lock:
+            return [(*self._slot_keys[slot], self._slot_names[slot]) for slot in np.flatnonzero(self._slot_new).tolist()]
+    # end get_new_faces()
+
+    def clear_new(self, keys: list[tuple[str, int]] | None = None) -> None:
+        # Clears the new flag of the faces of keys, of every face when keys is None
+        with self._lock:
+            if keys is None:
+                keys = [self._slot_keys[slot] for slot in np.flatnonzero(self._slot_new).tolist()]
+            if len(keys) > 0:
+                self._clear_new(keys)
+                self._journal({'op': 'seen', 'keys': [list(key) for key in keys]})
+        return
+    # end clear_new()
+
+    def set_complete(self, complete: bool) -> None:
+        with self._lock:
+            self.complete = complete
+            self._journal({'op': 'complete', 'complete': complete})
+        return
+    # end set_complete()
+
+    def _search_slots(self, queries: PreparedEmbeddings, k: int, exact: bool, num_threads: int) -> tuple[np.ndarray, np.ndarray]:
+        # Called with the lock held. (queries, k) slots and distances, nearest first, -1 and inf past the last.
+        if exact:
+            gallery = PreparedEmbeddings(self._vectors,
+                                         self._squared_norms if self.distance_metric == 'euclidean' else None,
+                                         self.distance_metric)
+            return top_k(queries, gallery, k, self.BLOCK_SIZE, num_threads, self._slot_lists >= 0)
+        slots: np.ndarray = np.full((len(queries.vectors), k), -1, dtype=np.int64)
+        distances: np.ndarray = np.full((len(queries.vectors), k), np.inf, dtype=np.float32)
+        for start in range(0, len(queries.vectors), self.BLOCK_SIZE):
+            probes: np.ndarray = self._nearest_lists(slice_embeddings(queries, start, start + self.BLOCK_SIZE), self.num_probes)
+            for query_index, query_probes in enumerate(probes.tolist(), start):
+                candidates: np.ndarray = np.concatenate([self._get_members(list_id) for list_id in query_probes])
+                if len(candidates) == 0:
+                    continue
+                candidate_distances: np.ndarray = distance_block(slice_embeddings(queries, query_index, query_index + 1),
+                                                                 self._prepared(candidates))[0]
+                nearest: np.ndarray = np.argpartition(candidate_distances, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+                nearest = nearest[np.argsort(candidate_distances[nearest], kind='stable')]
+                slots[query_index, :len(nearest)] = candidates[nearest]
+                distances[query_index, :len(nearest)] = candidate_distances[nearest]
+        return slots, distances
+    # end _search_slots()
+
+    def search(self,
+               embeddings: list | np.ndarray,
+               k: int,
+               exact: bool = False,
+               num_threads: int = 1) -> list[list[tuple[str, int, str | None, float]]]:
+        # For every embedding, up to k nearest faces as (image path, face index, name, distance), nearest
+        # first. With exact every face is compared, see top_k(), e.g. as the ground truth of the lists.
+        queries: PreparedEmbeddings = prepare_embeddings(embeddings, self.distance_metric)
+        with self._lock:
+            if len(self._slots) == 0:
+                return [[] for _ in range(len(queries.vectors))]
+            slots, distances = self._search_slots(queries, k, exact, num_threads)
+            return [[(*self._slot_keys[slot], self._slot_names[slot], distance)
+                     for slot, distance in zip(query_slots, query_distances) if slot >= 0]
+                    for query_slots, query_distances in zip(slots.tolist(), distances.tolist())]
+    # end search()
+
+    def get_neighbors(self,
+                      keys: list[tuple[str, int]],
+                      k: int,
+                      max_distance: float,
+                      exact: bool = False,
+                      num_threads: int = 1) -> list[list[tuple[str, int, str | None, float]]]:
+        # For the faces of keys, their k nearest other faces within max_distance as in search(). Keys that
+        # are not in the index get no neighbors.
+        with self._lock:
+            slots: list[int] = [self._slots.get(key, -1) for key in keys]
+            known_slots: np.ndarray = np.array([slot for slot in slots if slot >= 0], dtype=np.int64)
+            results: dict[int, list[tuple[str, int, str | None, float]]] = {}
+            if len(known_slots) > 0:
+                neighbor_slots, distances = self._search_slots(self._prepared(known_slots), k + 1, exact, num_threads)
+                for slot, query_slots, query_distances in zip(known_slots.tolist(), neighbor_slots.tolist(), distances.tolist()):
+                    results[slot] = [(*self._slot_keys[neighbor], self._slot_names[neighbor], distance)
+                                     for neighbor, distance in zip(query_slots, query_distances)
+                                     if neighbor >= 0 and neighbor != slot and distance <= max_distance][:k]
+        return [results.get(slot, []) for slot in slots]
+    # end get_neighbors()
+
+    def get_neighbor_graph(self,
+                           k: int,
+                           max_distance: float,
+                           exact: bool = False,
+                           num_threads: int = 1) -> tuple[list[tuple[str, int]], list[str | None], np.ndarray, np.ndarray]:
+        # k nearest neighbor graph of every face in the index: their keys and names, and (faces, k) positions
+        # in those lists and distances of their nearest other faces within max_distance, -1 and inf past the last
+        with self._lock:
+            used_slots: np.ndarray = np.flatnonzero(self._slot_lists >= 0)
+            keys: list[tuple[str, int]] = [self._slot_keys[slot] for slot in used_slots.tolist()]
+            names: list[str | None] = [self._slot_names[slot] for slot in used_slots.tolist()]
+            if len(used_slots) == 0:
+                return keys, names, np.zeros((0, k), dtype=np.int64), np.zeros((0, k), dtype=np.float32)
+            slots, distances = self._search_slots(self._prepared(used_slots), k + 1, exact, num_threads)
+            positions: np.ndarray = np.full(len(self._slot_lists), -1, dtype=np.int64)
+            positions[used_slots] = np.arange(len(used_slots))
+        neighbors: np.ndarray = np.where(slots >= 0, positions[slots], -1)
+        is_self: np.ndarray = neighbors == np.arange(len(used_slots))[:, np.newaxis]
+        is_neighbor: np.ndarray = ~is_self & (neighbors >= 0) & (distances <= max_distance)
+        # Moves the neighbors kept to the front of each row, in order, then drops the extra column
+        order: np.ndarray = np.argsort(~is_neighbor, axis=1, kind='stable')
+        neighbors = np.where(np.take_along_axis(is_neighbor, order, axis=1), np.take_along_axis(neighbors, order, axis=1), -1)[:, :k]
+        distances = np.where(neighbors >= 0, np.take_along_axis(distances, order, axis=1)[:, :k], np.inf).astype(np.float32)
+        return keys, names, neighbors, distances
+    # end get_neighbor_graph()
+
+    def _write_snapshot(self) -> None:
+        # Called with the lock held. Also empties the journal, whose changes the snapshot now holds.
+        used_slots: np.ndarray = np.flatnonzero(self._slot_lists >= 0)
+        keys: list[tuple[str, int]] = [self._slot_keys[slot] for slot in used_slots.tolist()]
+        names: list[str | None] = [self._slot_names[slot] for slot in used_slots.tolist()]
+        paths, path_offsets = encode_strings([path for path, _ in keys])
+        encoded_names, name_offsets = encode_strings([name or '' for name in names])
+        temp_filepath: Path = self.snapshot_filepath.with_name(self.snapshot_filepath.name + '.tmp')
+        with temp_filepath.open('wb') as snapshot_fp:
+            np.savez(snapshot_fp,
+                     distance_metric=np.array(self.distance_metric),
+                     complete=np.array(self.complete),
+                     trained_count=np.array(self._trained_count),
+                     vectors=self._vectors[used_slots] if self.dimensions is not None else np.zeros((0, 0), dtype=np.float32),
+                     lists=self._slot_lists[used_slots],
+                     is_new=self._slot_new[used_slots],
+                     centroids=self._centroids.vectors if self._centroids is not None else np.zeros((0, self.dimensions or 0), dtype=np.float32),
+                     paths=paths,
+                     path_offsets=path_offsets,
+                     face_indices=np.array([face_index for _, face_index in keys], dtype=np.int64),
+                     names=encoded_names,
+                     name_offsets=name_offsets,
+                     has_names=np.array([name is not None for name in names], dtype=bool))
+            snapshot_fp.flush()
+            os.fsync(snapshot_fp.fileno())
+        os.replace(temp_filepath, self.snapshot_filepath)
+        self._journal_fp.truncate(0)
+        self._journal_count = 0
+        return
+    # end _write_snapshot()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._journal_fp.flush()
+            if self._journal_count > 0 and self._journal_count >= len(self._slots) // 4:
+                self._write_snapshot()
+            os.fsync(self._journal_fp.fileno())
+        return
+    # end flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._journal_fp.flush()
+            if self._journal_count > 0:
+                self._write_snapshot()
+            self._journal_fp.close()
+        return
+    # end close()
+# end class FaceIndex
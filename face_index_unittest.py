@@ -0,0 +1,185 @@
+from pathlib import Path
+import tempfile
+import unittest
+import numpy as np
+from face_index import FaceIndex, encode_strings, decode_strings
+
+class TestFaceIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store_dir = Path(self.temp_dir.name)
+        rng = np.random.default_rng(7)
+        centers: np.ndarray = rng.normal(size=(20, 16))
+        self.embeddings: np.ndarray = (centers[np.arange(600) % 20] + 0.2 * rng.normal(size=(600, 16))).astype(np.float32)
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    def create_index(self, distance_metric: str = 'cosine', train_size: int = 20000) -> FaceIndex:
+        return FaceIndex(self.store_dir, 'test', distance_metric, num_probes=4, train_size=train_size)
+    # end create_index()
+
+    def add_faces(self, index: FaceIndex, count: int) -> None:
+        # Three faces per image, every other one named
+        for i, embedding in enumerate(self.embeddings[:count]):
+            index.add(f'dir/{i // 3}.jpg', i % 3, embedding, f'name{i % 20}' if i % 2 else None)
+        return
+    # end add_faces()
+
+    def assert_same_results(self, results: list, expected: list) -> None:
+        # Same faces in the same order, and distances equal up to float32 rounding. With euclidean, the
+        # distance of a face to itself is the square root of a rounding error, up to about 1e-3.
+        self.assertEqual(len(results), len(expected))
+        for query_results, query_expected in zip(results, expected):
+            self.assertEqual([result[:3] for result in query_results], [result[:3] for result in query_expected])
+            np.testing.assert_allclose([result[3] for result in query_results],
+                                       [result[3] for result in query_expected], rtol=1e-4, atol=2e-3)
+        return
+    # end assert_same_results()
+
+    def test_encode_strings(self) -> None:
+        strings: list[str] = ['a/b.jpg', '', 'café/ñ.jpg', 'x' * 300]
+        data, offsets = encode_strings(strings)
+        self.assertEqual(data.dtype, np.uint8)
+        self.assertEqual(len(offsets), len(strings) + 1)
+        self.assertEqual(decode_strings(data, offsets), strings)
+        data, offsets = encode_strings([])
+        self.assertEqual(decode_strings(data, offsets), [])
+        return
+    # end test_encode_strings()
+
+    def test_add_and_remove(self) -> None:
+        index: FaceIndex = self.create_index()
+        self.add_faces(index, 9)
+        self.assertEqual(len(index), 9)
+        self.assertEqual(index.get_face_indices('dir/0.jpg'), {0, 1, 2})
+        index.add('dir/0.jpg', 1, self.embeddings[1], 'bob')  # same embedding, only renamed
+        self.assertEqual(len(index), 9)
+        self.assertEqual(index.search(self.embeddings[1:2], 1)[0][0][:3], ('dir/0.jpg', 1, 'bob'))
+        index.remove('dir/0.jpg', 1)
+        self.assertEqual(index.get_face_indices('dir/0.jpg'), {0, 2})
+        index.remove_image('dir/1.jpg')
+        self.assertEqual(index.get_face_indices('dir/1.jpg'), set())
+        self.assertEqual(len(index), 5)
+        index.set_name('dir/2.jpg', 0, 'carol')
+        self.assertEqual(index.search(self.embeddings[6:7], 1)[0][0][:3], ('dir/2.jpg', 0, 'carol'))
+        for results in index.search(self.embeddings[:9], 9):
+            self.assertNotIn(('dir/0.jpg', 1), [result[:2] for result in results])
+            self.assertEqual(len(results), 5)
+        index.close()
+        return
+    # end test_add_and_remove()
+
+    def test_journal_replay(self) -> None:
+        index: FaceIndex = self.create_index()
+        self.add_faces(index, 30)
+        index.remove_image('dir/0.jpg')
+        index.set_name('dir/1.jpg', 0, 'bob')
+        index.set_complete(True)
+        index._journal_fp.close()  # as if the process stopped without close(), no snapshot written
+        self.assertFalse(index.snapshot_filepath.exists())
+        with index.journal_filepath.open('a', encoding='utf-8') as journal_fp:
+            journal_fp.write('{"op":"add","pa')  # cut short by a crash
+
+        replayed: FaceIndex = self.create_index()
+        self.assertEqual(len(replayed), 27)
+        self.assertTrue(replayed.complete)
+        self.assertEqual(replayed.get_face_indices('dir/0.jpg'), set())
+        self.assertEqual(replayed.search(self.embeddings[3:4], 1)[0][0][:3], ('dir/1.jpg', 0, 'bob'))
+        replayed.close()
+        return
+    # end test_journal_replay()
+
+    def test_snapshot_reload(self) -> None:
+        for distance_metric in ['cosine', 'euclidean', 'euclidean_l2']:
+            with self.subTest(distance_metric=distance_metric):
+                for filepath in self.store_dir.iterdir():
+                    filepath.unlink()
+                index: FaceIndex = self.create_index(distance_metric, train_size=200)
+                self.add_faces(index, 300)
+                index.add('dir/é.jpg', 0, self.embeddings[300], 'zoë')
+                expected: list = index.search(self.embeddings[:20], 5)
+                index.close()
+                self.assertTrue(index.snapshot_filepath.exists())
+                self.assertEqual(index.journal_filepath.stat().st_size, 0)
+
+                reloaded: FaceIndex = self.create_index(distance_metric, train_size=200)
+                self.assertEqual(len(reloaded), 301)
+                self.assertIsNotNone(reloaded._centroids)
+                self.assert_same_results(reloaded.search(self.embeddings[:20], 5), expected)
+                self.assertEqual(reloaded.search(self.embeddings[300:301], 1)[0][0][:3], ('dir/é.jpg', 0, 'zoë'))
+                reloaded.close()
+        return
+    # end test_snapshot_reload()
+
+    def test_other_metric_starts_over(self) -> None:
+        index: FaceIndex = self.create_index('cosine')
+        self.add_faces(index, 10)
+        index.close()
+        other: FaceIndex = self.create_index('euclidean')
+        self.assertEqual(len(other), 0)
+        other.close()
+        return
+    # end test_other_metric_starts_over()
+
+    def test_new_faces(self) -> None:
+        index: FaceIndex = self.create_index()
+        self.add_faces(index, 6)
+        self.assertEqual(len(index.get_new_faces()), 6)
+        index.clear_new([('dir/0.jpg', 0), ('dir/0.jpg', 1)])
+        self.assertEqual(sorted(key[:2] for key in index.get_new_faces()),
+                         [('dir/0.jpg', 2), ('dir/1.jpg', 0), ('dir/1.jpg', 1), ('dir/1.jpg', 2)])
+        index.close()
+
+        reloaded: FaceIndex = self.create_index()
+        self.assertEqual(len(reloaded.get_new_faces()), 4)
+        reloaded.clear_new()
+        self.assertEqual(reloaded.get_new_faces(), [])
+        reloaded.add('dir/0.jpg', 0, self.embeddings[10], None)  # another embedding, new again
+        self.assertEqual(reloaded.get_new_faces(), [('dir/0.jpg', 0, None)])
+        reloaded._journal_fp.close()
+
+        replayed: FaceIndex = self.create_index()
+        self.assertEqual(replayed.get_new_faces(), [('dir/0.jpg', 0, None)])
+        replayed.close()
+        return
+    # end test_new_faces()
+
+    def test_get_neighbors(self) -> None:
+        index: FaceIndex = self.create_index()
+        self.add_faces(index, 60)
+        keys: list[tuple[str, int]] = [('dir/0.jpg', 0), ('missing.jpg', 0)]
+        neighbors: list = index.get_neighbors(keys, 2, max_distance=np.inf, exact=True)
+        self.assertEqual(len(neighbors[0]), 2)
+        self.assertEqual(neighbors[1], [])
+        # Faces 20 and 40 come from the same center as face 0, face 0 itself is left out
+        self.assertEqual(sorted(neighbor[:2] for neighbor in neighbors[0]), [('dir/13.jpg', 1), ('dir/6.jpg', 2)])
+        self.assertEqual(index.get_neighbors(keys[:1], 2, max_distance=0.0), [[]])
+        index.close()
+        return
+    # end test_get_neighbors()
+
+    def test_search_matches_exact(self) -> None:
+        for distance_metric in ['cosine', 'euclidean', 'euclidean_l2']:
+            with self.subTest(distance_metric=distance_metric):
+                for filepath in self.store_dir.iterdir():
+                    filepath.unlink()
+                index: FaceIndex = self.create_index(distance_metric, train_size=200)
+                self.add_faces(index, 600)
+                self.assertIsNotNone(index._centroids)  # trained, so the search only probes some lists
+                queries: np.ndarray = self.embeddings[::30] + 0.01
+                approximate: list = index.search(queries, 5)
+                exact: list = index.search(queries, 5, exact=True, num_threads=2)
+                self.assert_same_results(approximate, exact)
+                index.close()
+        return
+    # end test_search_matches_exact()
+# end class TestFaceIndex
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+from typing import Any, Callable
+import logging
+import multiprocessing as mp
+import queue
+import os
+
+from global_logger import configure_logger
+from faces import FacesConfigManager, FileOps, FaceFunctions
+
+def _worker_main(params_filepath: Path,
+                 log_name: str,
+                 task_queue: mp.Queue,
+                 result_queue: mp.Queue) -> None:
+    log: logging.Logger = configure_logger(log_name, log_file=Path(log_name + '.log'))
+    log.info(f'Face worker {os.getpid()} starting.')
+
+    config = FacesConfigManager(params_filepath)
+    _ = FileOps(config, logger=log)  # sets the logger used by the faces module
+    face_functions = FaceFunctions(config)
+
+    # Warm up: build both models once for the lifetime of the worker
+    face_functions.face_models.get_face_detector_model()
+    face_functions.face_models.get_identification_model()
+
+    def on_image_done(key: Any, faces: list[dict]) -> None:
+        result_queue.put((key, faces))
+
+    scheduler = None
+    if config.batch_across_images:
+        scheduler = face_functions.create_embedding_scheduler(on_image_done=on_image_done)
+
+    while True:
+        try:
+            task = task_queue.get(timeout=config.embedding_batch_max_wait if scheduler is not None else None)
+        except queue.Empty:
+            scheduler.poll()
+            continue
+        if task is None:
+            break
+        image_filepath, key = task
+        try:
+            if scheduler is None:
+                on_image_done(key, face_functions.detect(image_filepath))
+            else:
+                scheduler.submit(key, face_functions.find_faces(image_filepath))
+        except Exception:
+            log.exception(f'Face worker {os.getpid()} failed to process image: {image_filepath.as_posix()}')
+
+    if scheduler is not None:
+        scheduler.close()
+    result_queue.put(None)  # tells the writer that this worker is done
+    log.info(f'Face worker {os.getpid()} exiting.')
+    return
+# end _worker_main()
+
+class FaceWorkerPool:
+    # USAGE: pool = FaceWorkerPool(config, on_image_done=file_ops.save_faces)
+    #        then pool.submit(image_filepath, metadata_filepath) for each image and pool.close() at the end.
+    #
+    #        Each worker process builds the face detector and the identification model once and then
+    #        pulls image paths from a shared bounded queue. The faces found by the workers are sent back
+    #        to this process, which is the single writer: on_image_done(key, faces) is only ever called
+    #        from the process that owns the pool, during submit() and close().
+    #
+    #        Workers are started with the 'spawn' method since tensorflow is not fork safe. When every
+    #        worker has died, e.g. out of memory, submit() raises RuntimeError instead of waiting forever.
+
+    def __init__(self,
+                 config: FacesConfigManager,
+                 on_image_done: Callable[[Any, list[dict]], None],
+                 num_workers: int | None = None,
+                 log_name: str = 'face_workers') -> None:
+        self.config: FacesConfigManager = config
+        self.on_image_done: Callable[[Any, list[dict]], None] = on_image_done
+        self.num_workers: int = config.num_workers if num_workers is None else num_workers
+
+        context = mp.get_context('spawn')
+        self._task_queue: mp.Queue = context.Queue(maxsize=4 * self.num_workers)
+        self._result_queue: mp.Queue = context.Queue()
+        self._workers: list = []
+        for _ in range(self.num_workers):
+            worker = context.Process(target=_worker_main,
+                                     args=(config.params_filepath, log_name, self._task_queue, self._result_queue),
+                                     daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        self._running_workers: int = self.num_workers
+        return
+    # end __init__()
+
+    def submit(self, image_filepath: Path, key: Any) -> None:
+        self._put((image_filepath, key))
+        self.drain()
+        return
+    # end submit()
+
+    def _put(self, task: tuple[Path, Any] | None) -> None:
+        # Waits for room in the task queue, handing the results over meanwhile
+        while True:
+            try:
+                self._task_queue.put(task, timeout=0.1)
+                return
+            except queue.Full:
+                self.drain()
+                if not any(worker.is_alive() for worker in self._workers):
+                    exit_codes: str = ', '.join(str(worker.exitcode) for worker in self._workers)
+                    raise RuntimeError(f'Every face worker died (exit codes: {exit_codes}), no image can be processed.')
+    # end _put()
+
+    def drain(self, block: bool = False) -> None:
+        # Hands every result already returned by the workers to on_image_done
+        while self._running_workers > 0:
+            try:
+                result = self._result_queue.get(block=block, timeout=1.0 if block else None)
+            except queue.Empty:
+                if block and not any(worker.is_alive() for worker in self._workers):
+                    self._running_workers = 0  # workers died without saying goodbye
+                if not block:
+                    return
+                continue
+            if result is None:
+                self._running_workers -= 1
+                continue
+            key, faces = result
+            self.on_image_done(key, faces)
+        return
+    # end drain()
+
+    def close(self) -> None:
+        if any(worker.is_alive() for worker in self._workers):
+            for _ in self._workers:
+                self._put(None)
+        self.drain(block=True)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        return
+    # end close()
+# end class FaceWorkerPool
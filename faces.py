@@ -1,8 +1,12 @@
 # Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
 from pathlib import Path
+from typing import Any, Callable, Iterator
+import os
 import json
+import hashlib
 import time
 import logging
+import threading
 import numpy as np
 import cv2
 
@@ -10,9 +14,19 @@ from deepface import DeepFace
 from deepface.detectors import FaceDetector
 from deepface.commons import functions, distance
 from global_logger import configure_logger
+from traverser import DirBatchTraverser, DirBatch, FileInfo
+from image_loader import load_image, read_image_bytes, decode_image, decode_for_detection
+from boxes import clip_boxes, non_max_suppression
+from crop_store import FaceCropStore
+from embedding_store import EmbeddingStore
+from catalog import MetadataCatalog
+from distances import PreparedEmbeddings, prepare_embeddings, pairwise_distances, top_k
+from face_index import FaceIndex
+from metadata_writer import MetadataWriter, write_files_atomically
 
 class FacesConfigManager:
     def __init__(self, params_filepath: Path) -> None:
+        self.params_filepath: Path = params_filepath  # kept so worker processes can rebuild the same configuration
         defaults = self.load_defaults()
         self.params = defaults
         with params_filepath.open() as f:
@@ -36,6 +50,8 @@ class FacesConfigManager:
             "silent": false,
             "distance_metric": "cosine",
             "distance_threshold": null,
+            "distance_block_size": 4096,
+            "distance_threads": 1,
             "use_program_dir_for_logs": false,
             "force_early_model_build": false,
             "metadata_dirname": ".faces",
@@ -44,7 +60,64 @@ class FacesConfigManager:
             "debug": false,
             "debug_max_files_to_process": 1000000000,
             "debug_max_faces_to_process": 1000000000,
-            "debug_use_deepface_represent": false
+            "debug_use_deepface_represent": false,
+            "embedding_batch_size": 32,
+            "batch_across_images": true,
+            "embedding_batch_max_wait": 5.0,
+            "num_workers": 1,
+            "use_pipeline": false,
+            "pipeline_queue_size": 8,
+            "pipeline_threads": {"decode": 4, "detect": 1, "embed": 1, "persist": 2},
+            "traversal_threads": 1,
+            "use_scan_manifest": true,
+            "scan_manifest_filename": "scan_manifest.json.gz",
+            "use_no_faces_cache": true,
+            "no_faces_filename": "no_faces.cache",
+            "watch_use_inotify": true,
+            "watch_debounce_seconds": 2.0,
+            "watch_poll_interval": 60.0,
+            "detection_max_pixels": 2000000,
+            "detection_refine_faces": true,
+            "detection_refine_margin": 0.25,
+            "prefetch_threads": 2,
+            "prefetch_max_bytes": 536870912,
+            "cascade_detector_name": null,
+            "cascade_mode": "image",
+            "cascade_max_pixels": 300000,
+            "cascade_min_confidence": 0.0,
+            "cascade_region_margin": 0.5,
+            "tiling_min_pixels": 100000000,
+            "tile_size": 1024,
+            "tile_overlap": 0.25,
+            "tile_scales": [1.0, 0.5, 0.25],
+            "tile_nms_threshold": 0.3,
+            "use_crop_store": true,
+            "crop_store_name": "face_crops",
+            "crop_max_size": 160,
+            "embedding_fingerprints_filename": "embedding_fingerprints.info",
+            "auto_embed_faces": false,
+            "redetect_iou_threshold": 0.5,
+            "embedding_storage": "json",
+            "embedding_storage_dtype": "float32",
+            "metadata_backend": "json",
+            "catalog_filename": "faces_catalog.sqlite",
+            "catalog_batch_size": 500,
+            "use_metadata_writer": true,
+            "metadata_writer_queue_size": 256,
+            "metadata_writer_group_size": 64,
+            "use_face_index": false,
+            "face_index_neighbors": 10,
+            "face_index_probes": 16,
+            "face_index_train_size": 20000,
+            "face_index_max_lists": 4096,
+            "face_index_exact": false,
+            "cluster_neighbors": 10,
+            "cluster_iterations": 20,
+            "cluster_min_size": 2,
+            "cluster_name_prefix": "cluster_",
+            "incremental_clustering": true,
+            "cluster_state_filename": "cluster_state.info",
+            "cluster_recluster_fraction": 0.2
         } """
         self.defaults: dict = json.loads(defaults_json_string)
         return self.defaults
@@ -60,6 +133,8 @@ class FacesConfigManager:
         self.silent = self.params["silent"]
         self.distance_metric = self.params["distance_metric"]
         self.distance_threshold = self.params['distance_threshold']
+        self.distance_block_size = self.params['distance_block_size']
+        self.distance_threads = self.params['distance_threads']
         self.force_early_model_build = self.params["force_early_model_build"]
         self.metadata_dirname = self.params["metadata_dirname"]
         self.metadata_extension = self.params["metadata_extension"]
@@ -68,6 +143,63 @@ class FacesConfigManager:
         self.debug_max_files_to_process = self.params["debug_max_files_to_process"]
         self.debug_max_faces_to_process = self.params["debug_max_faces_to_process"]
         self.debug_use_deepface_represent = self.params["debug_use_deepface_represent"]
+        self.embedding_batch_size = self.params["embedding_batch_size"]
+        self.batch_across_images = self.params["batch_across_images"]
+        self.embedding_batch_max_wait = self.params["embedding_batch_max_wait"]
+        self.num_workers = self.params["num_workers"]
+        self.use_pipeline = self.params["use_pipeline"]
+        self.pipeline_queue_size = self.params["pipeline_queue_size"]
+        self.pipeline_threads = self.params["pipeline_threads"]
+        self.traversal_threads = self.params["traversal_threads"]
+        self.use_scan_manifest = self.params["use_scan_manifest"]
+        self.scan_manifest_filename = self.params["scan_manifest_filename"]
+        self.use_no_faces_cache = self.params["use_no_faces_cache"]
+        self.no_faces_filename = self.params["no_faces_filename"]
+        self.watch_use_inotify = self.params["watch_use_inotify"]
+        self.watch_debounce_seconds = self.params["watch_debounce_seconds"]
+        self.watch_poll_interval = self.params["watch_poll_interval"]
+        self.detection_max_pixels = self.params["detection_max_pixels"]  # 0 always detects at full resolution
+        self.detection_refine_faces = self.params["detection_refine_faces"]
+        self.detection_refine_margin = self.params["detection_refine_margin"]
+        self.prefetch_threads = self.params["prefetch_threads"]  # 0 decodes each image when it is needed
+        self.prefetch_max_bytes = self.params["prefetch_max_bytes"]
+        self.cascade_detector_name = self.params["cascade_detector_name"]  # None runs detector_model_name alone
+        self.cascade_mode = self.params["cascade_mode"]
+        self.cascade_max_pixels = self.params["cascade_max_pixels"]
+        self.cascade_min_confidence = self.params["cascade_min_confidence"]
+        self.cascade_region_margin = self.params["cascade_region_margin"]
+        self.tiling_min_pixels = self.params["tiling_min_pixels"]  # of the full resolution image, panoramas and scans; 0 never tiles
+        self.tile_size = self.params["tile_size"]
+        self.tile_overlap = self.params["tile_overlap"]
+        self.tile_scales = self.params["tile_scales"]
+        self.tile_nms_threshold = self.params["tile_nms_threshold"]
+        self.use_crop_store = self.params["use_crop_store"]
+        self.crop_store_name = self.params["crop_store_name"]
+        self.crop_max_size = self.params["crop_max_size"]  # longest side, up to 75KB per face on disk, about 38GB for 500k faces
+        self.embedding_fingerprints_filename = self.params["embedding_fingerprints_filename"]
+        self.auto_embed_faces = self.params["auto_embed_faces"]  # false only logs that embeddings are missing
+        self.redetect_iou_threshold = self.params["redetect_iou_threshold"]
+        self.embedding_storage = self.params["embedding_storage"]
+        self.embedding_storage_dtype = self.params["embedding_storage_dtype"]
+        self.metadata_backend = self.params["metadata_backend"]
+        self.catalog_filename = self.params["catalog_filename"]
+        self.catalog_batch_size = self.params["catalog_batch_size"]
+        self.use_metadata_writer = self.params["use_metadata_writer"]
+        self.metadata_writer_queue_size = self.params["metadata_writer_queue_size"]
+        self.metadata_writer_group_size = self.params["metadata_writer_group_size"]
+        self.use_face_index = self.params["use_face_index"]  # the first run with it reads every saved face once
+        self.face_index_neighbors = self.params["face_index_neighbors"]
+        self.face_index_probes = self.params["face_index_probes"]
+        self.face_index_train_size = self.params["face_index_train_size"]
+        self.face_index_max_lists = self.params["face_index_max_lists"]
+        self.face_index_exact = self.params["face_index_exact"]
+        self.cluster_neighbors = self.params["cluster_neighbors"]
+        self.cluster_iterations = self.params["cluster_iterations"]
+        self.cluster_min_size = self.params["cluster_min_size"]
+        self.cluster_name_prefix = self.params["cluster_name_prefix"]
+        self.incremental_clustering = self.params["incremental_clustering"]
+        self.cluster_state_filename = self.params["cluster_state_filename"]
+        self.cluster_recluster_fraction = self.params["cluster_recluster_fraction"]
 
         self.root_images_dir: Path = Path(self.root_images_dir)
         if not self.root_images_dir.is_absolute():
@@ -96,6 +228,10 @@ class FacesConfigManager:
                         
         # from DeepFace functions
         self.normalizations: list[str] = ['base', 'raw', 'Facenet', 'Facenet2018', 'VGGFace', 'VGGFace2', 'ArcFace']
+
+        # Stages of the streaming pipeline, stages missing from pipeline_threads run on a single thread
+        self.pipeline_stages: list[str] = ['decode', 'detect', 'embed', 'persist']
+        self.pipeline_threads = {stage: 1 for stage in self.pipeline_stages} | self.pipeline_threads
         
         self.target_size: tuple[int,int] = functions.find_target_size(model_name=self.identification_model_name)
 
@@ -103,6 +239,39 @@ class FacesConfigManager:
             self.distance_threshold = distance.findThreshold(self.identification_model_name,
                                                              self.distance_metric)
 
+        # Parameters that change which faces are found in an image, see detector_fingerprint()
+        self.detector_fingerprint_fields: list[str] = ['detector_model_name',
+                                                       'detection_max_pixels',
+                                                       'cascade_detector_name',
+                                                       'cascade_mode',
+                                                       'cascade_max_pixels',
+                                                       'cascade_min_confidence',
+                                                       'cascade_region_margin',
+                                                       'tiling_min_pixels',
+                                                       'tile_size',
+                                                       'tile_overlap',
+                                                       'tile_scales',
+                                                       'tile_nms_threshold']
+
+        # Parameters that change the embedding of a face, see embedding_fingerprint()
+        self.embedding_fingerprint_fields: list[str] = ['identification_model_name',
+                                                        'normalization',
+                                                        'detector_model_name',
+                                                        'align',
+                                                        'grayscale']
+
+        # Embedding storage: 'json' keeps the embeddings in the metadata file of each image, 'mmap' in one
+        # memory mapped matrix per embedding fingerprint for the whole tree, see EmbeddingStore
+        self.embedding_storages: list[str] = ['json', 'mmap']
+
+        # Metadata backends: 'json' writes one metadata file per image in the metadata directory next to
+        # it, 'sqlite' keeps the metadata of the whole tree in one database, see MetadataCatalog
+        self.metadata_backends: list[str] = ['json', 'sqlite']
+
+        # Cascade modes: 'image' runs detector_model_name on the whole image when the cascade detector
+        # finds any candidate face, 'regions' runs it only on the regions around the candidates
+        self.cascade_modes: list[str] = ['image', 'regions']
+
         self.enforce_detection: bool = False
         self.face_detector_model = None
         self.identification_model = None
@@ -131,12 +300,164 @@ class FacesConfigManager:
 
         assert isinstance(self.distance_threshold, float), \
             f'Distance threshold must be a float'
+
+        assert isinstance(self.distance_block_size, int) and self.distance_block_size > 0, \
+            f'Distance block size must be a positive integer'
+
+        assert isinstance(self.distance_threads, int) and self.distance_threads > 0, \
+            f'Distance threads must be a positive integer'
+
+        assert isinstance(self.cluster_name_prefix, str) and len(self.cluster_name_prefix) > 0, \
+            f'Cluster name prefix must be a non empty string'
+
+        assert not self.cluster_state_filename.endswith(self.metadata_extension), \
+            f'The cluster state filename must not end with the metadata extension {self.metadata_extension}'
+
+        assert isinstance(self.cluster_recluster_fraction, (int, float)) and self.cluster_recluster_fraction >= 0, \
+            f'Cluster recluster fraction must be a non-negative number'
+
+        assert isinstance(self.embedding_batch_size, int) and self.embedding_batch_size > 0, \
+            f'Embedding batch size must be a positive integer'
+
+        assert isinstance(self.embedding_batch_max_wait, (int, float)) and self.embedding_batch_max_wait >= 0, \
+            f'Embedding batch max wait must be a non-negative number of seconds'
+
+        assert isinstance(self.num_workers, int) and self.num_workers > 0, \
+            f'Number of workers must be a positive integer'
+
+        assert isinstance(self.pipeline_queue_size, int) and self.pipeline_queue_size > 0, \
+            f'Pipeline queue size must be a positive integer'
+
+        stages_string: str = ", ".join(string for string in self.pipeline_stages)
+        for stage_name, stage_threads in self.pipeline_threads.items():
+            assert stage_name in self.pipeline_stages, \
+                f'Invalid pipeline stage: {stage_name}. Valid stages are: {stages_string}'
+            assert isinstance(stage_threads, int) and stage_threads > 0, \
+                f'Pipeline stage {stage_name} must have a positive number of threads'
+
+        assert isinstance(self.traversal_threads, int) and self.traversal_threads > 0, \
+            f'Number of traversal threads must be a positive integer'
+
+        assert not self.no_faces_filename.endswith(self.metadata_extension), \
+            f'The no faces cache filename must not end with the metadata extension {self.metadata_extension}'
+
+        assert not self.embedding_fingerprints_filename.endswith(self.metadata_extension), \
+            f'The embedding fingerprints filename must not end with the metadata extension {self.metadata_extension}'
+
+        storages_string: str = ", ".join(string for string in self.embedding_storages)
+        assert self.embedding_storage in self.embedding_storages, \
+            f'Invalid embedding storage: {self.embedding_storage}. Valid values are: {storages_string}'
+
+        backends_string: str = ", ".join(string for string in self.metadata_backends)
+        assert self.metadata_backend in self.metadata_backends, \
+            f'Invalid metadata backend: {self.metadata_backend}. Valid values are: {backends_string}'
+
+        assert not self.catalog_filename.endswith(self.metadata_extension), \
+            f'The catalog filename must not end with the metadata extension {self.metadata_extension}'
+
+        assert isinstance(self.catalog_batch_size, int) and self.catalog_batch_size > 0, \
+            f'Catalog batch size must be a positive integer'
+
+        assert isinstance(self.metadata_writer_queue_size, int) and self.metadata_writer_queue_size > 0, \
+            f'Metadata writer queue size must be a positive integer'
+
+        assert isinstance(self.metadata_writer_group_size, int) and self.metadata_writer_group_size > 0, \
+            f'Metadata writer group size must be a positive integer'
+
+        for name in ['face_index_neighbors', 'face_index_probes', 'face_index_train_size', 'face_index_max_lists',
+                     'cluster_neighbors', 'cluster_iterations', 'cluster_min_size']:
+            value = getattr(self, name)
+            assert isinstance(value, int) and value > 0, f'{name} must be a positive integer'
+
+        assert self.embedding_storage_dtype in ['float32', 'float16'], \
+            f'Invalid embedding storage dtype: {self.embedding_storage_dtype}. Valid values are: float32, float16'
+
+        assert isinstance(self.watch_debounce_seconds, (int, float)) and self.watch_debounce_seconds >= 0, \
+            f'Watch debounce must be a non-negative number of seconds'
+
+        assert isinstance(self.watch_poll_interval, (int, float)) and self.watch_poll_interval > 0, \
+            f'Watch poll interval must be a positive number of seconds'
+
+        assert isinstance(self.detection_max_pixels, int) and self.detection_max_pixels >= 0, \
+            f'Detection max pixels must be a non-negative integer'
+
+        assert isinstance(self.detection_refine_margin, (int, float)) and self.detection_refine_margin >= 0, \
+            f'Detection refine margin must be a non-negative fraction of the face size'
+
+        assert isinstance(self.prefetch_threads, int) and self.prefetch_threads >= 0, \
+            f'Number of prefetch threads must be a non-negative integer'
+
+        assert isinstance(self.prefetch_max_bytes, int) and self.prefetch_max_bytes > 0, \
+            f'Prefetch max bytes must be a positive integer'
+
+        if self.cascade_detector_name is not None:
+            assert self.cascade_detector_name in self.face_detectors, \
+                f'Invalid cascade face detection model: {self.cascade_detector_name}. Valid values are {detect_string}'
+
+            assert self.cascade_detector_name != self.detector_model_name, \
+                f'The cascade face detection model must be cheaper than, so different from, {self.detector_model_name}'
+
+            modes_string: str = ", ".join(string for string in self.cascade_modes)
+            assert self.cascade_mode in self.cascade_modes, \
+                f'Invalid cascade mode: {self.cascade_mode}. Valid modes are: {modes_string}'
+
+            assert isinstance(self.cascade_max_pixels, int) and self.cascade_max_pixels > 0, \
+                f'Cascade max pixels must be a positive integer'
+
+            assert isinstance(self.cascade_min_confidence, (int, float)), \
+                f'Cascade min confidence must be a number'
+
+            assert isinstance(self.cascade_region_margin, (int, float)) and self.cascade_region_margin >= 0, \
+                f'Cascade region margin must be a non-negative fraction of the candidate size'
+
+        assert isinstance(self.tiling_min_pixels, int) and self.tiling_min_pixels >= 0, \
+            f'Tiling min pixels must be a non-negative integer'
+
+        assert isinstance(self.tile_size, int) and self.tile_size > 0, \
+            f'Tile size must be a positive integer'
+
+        assert isinstance(self.tile_overlap, (int, float)) and 0 <= self.tile_overlap < 1, \
+            f'Tile overlap must be a fraction of the tile size in [0, 1)'
+
+        assert len(self.tile_scales) > 0 and all(isinstance(tile_scale, (int, float)) and 0 < tile_scale <= 1 for tile_scale in self.tile_scales), \
+            f'Tile scales must be a non-empty list of numbers in (0, 1]'
+
+        assert isinstance(self.tile_nms_threshold, (int, float)) and 0 <= self.tile_nms_threshold <= 1, \
+            f'Tile NMS threshold must be an intersection over union in [0, 1]'
+
+        assert isinstance(self.crop_max_size, int) and self.crop_max_size > 0, \
+            f'Crop max size must be a positive integer'
+
+        assert isinstance(self.redetect_iou_threshold, (int, float)) and 0 <= self.redetect_iou_threshold < 1, \
+            f'Redetect IoU threshold must be an intersection over union in [0, 1)'
         return
     # end validate()
+
+    def fingerprint_fields(self, field_names: list[str]) -> dict:
+        return {name: self.params[name] for name in field_names}
+    # end fingerprint_fields()
+
+    def fingerprint(self, field_names: list[str]) -> str:
+        # Short hash of the given parameters
+        fields: dict = self.fingerprint_fields(field_names)
+        return hashlib.sha1(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    # end fingerprint()
+
+    def detector_fingerprint(self) -> str:
+        # Detection results recorded under another fingerprint are stale
+        return self.fingerprint(self.detector_fingerprint_fields)
+    # end detector_fingerprint()
+
+    def embedding_fingerprint(self) -> str:
+        # Key of the embeddings computed with the current configuration in each face record
+        return self.fingerprint(self.embedding_fingerprint_fields)
+    # end embedding_fingerprint()
 # end class FacesConfigManager
 
 debug: bool = True
 
+CROP_KEY: str = 'crop'  # face crop in memory, replaced by its 'crop_id' in the crop store when the face is saved
+
 class FileOps:
     def __init__(self,
                  config: FacesConfigManager,
@@ -146,6 +467,12 @@ class FileOps:
         self.config = config
         self.log = logger
         log = self.log
+        self._embedding_stores: dict[str, EmbeddingStore] = {}
+        self._catalog: MetadataCatalog | None = None
+        self._metadata_writer: MetadataWriter | None = None
+        self._face_index: FaceIndex | None = None
+        self._crop_store: FaceCropStore | None = None
+        self._embedding_stores_lock = threading.Lock()  # also guards _catalog, _metadata_writer, _face_index and _crop_store
     # end __init__()
 
     def get_logger(self):
@@ -157,9 +484,9 @@ class FileOps:
     def get_metadata_dirname(self) -> str:
         return self.config.metadata_dirname
 
-    def get_image(self, filepath: Path) -> np.ndarray:
-        image = cv2.imread(filepath.as_posix())
-        return image
+    def get_image(self, filepath: Path) -> np.ndarray | None:
+        # Decoded once, with the EXIF orientation applied, see image_loader
+        return load_image(filepath)
     # end get_image()
 
     def get_image_files(self, dir_path: Path) -> list[Path]:
@@ -169,6 +496,73 @@ class FileOps:
     def get_metadata_files(self, metadata_path: Path) -> list[Path]:
         return [file for file in metadata_path.iterdir() if file.is_file() and file.suffix == self.config.metadata_extension]
 
+    def get_crop_store(self) -> FaceCropStore | None:
+        # One store for the whole tree, in the metadata directory of root_images_dir. Only one instance may
+        # append to its files, so it is shared until close().
+        if not self.config.use_crop_store:
+            return None
+        with self._embedding_stores_lock:
+            if self._crop_store is None:
+                self._crop_store = FaceCropStore(self.config.root_images_dir / self.config.metadata_dirname, self.config.crop_store_name)
+        return self._crop_store
+    # end get_crop_store()
+
+    def get_scan_manifest_filepath(self) -> Path:
+        # The manifest does not end with the metadata extension, so it is never mistaken for image metadata
+        return self.config.root_images_dir / self.config.metadata_dirname / self.config.scan_manifest_filename
+    # end get_scan_manifest_filepath()
+
+    def get_image_batches(self, num_threads: int = 1, with_stat: bool = True, listing_cache = None) -> DirBatchTraverser:
+        # Every image directory together with its image files from a single listing of each directory
+        metadata_dirname: str = self.config.metadata_dirname
+        return DirBatchTraverser(self.config.root_images_dir,
+                                 match_files=[f'*{ext}' for ext in self.config.image_file_types],
+                                 prune_dir=lambda dir_path: dir_path.name == metadata_dirname,
+                                 with_stat=with_stat,
+                                 listing_cache=listing_cache,
+                                 num_threads=num_threads,
+                                 ordered=False)
+    # end get_image_batches()
+
+    def get_metadata_batches(self, num_threads: int = 1) -> Iterator[DirBatch]:
+        # Every metadata directory together with its metadata files. With the sqlite metadata_backend
+        # these are the paths the metadata files would have, for the images saved in the catalog.
+        if self.config.metadata_backend == 'sqlite':
+            return self.__get_catalog_metadata_batches()
+        return self.__get_json_metadata_batches(num_threads)
+    # end get_metadata_batches()
+
+    def __get_catalog_metadata_batches(self) -> Iterator[DirBatch]:
+        for dir_path, image_paths in self.get_catalog().get_images_by_dir():
+            metadata_files: list[FileInfo] = [FileInfo(self.generate_metadata_filepath(self.config.root_images_dir / image_path), 0, 0)
+                                              for image_path in image_paths]
+            yield DirBatch(self.generate_metadata_dirpath(self.config.root_images_dir / dir_path / '_'), metadata_files)
+    # end __get_catalog_metadata_batches()
+
+    def __get_json_metadata_batches(self, num_threads: int = 1) -> DirBatchTraverser:
+        metadata_dirname: str = self.config.metadata_dirname
+        return DirBatchTraverser(self.config.root_images_dir,
+                                 match_files=[f'*{self.config.metadata_extension}'],
+                                 ignore_hidden={'dirs': False, 'files': False},
+                                 select_dir=lambda dir_path: dir_path.name == metadata_dirname,
+                                 with_stat=False,
+                                 num_threads=num_threads)
+    # end __get_json_metadata_batches()
+
+    def get_metadata_filenames(self, dir_path: Path) -> set[str]:
+        # Names in the metadata directory of dir_path: one listing instead of an exists() call per image
+        if self.config.metadata_backend == 'sqlite':
+            image_names: set[str] = self.get_catalog().get_image_names(dir_path.relative_to(self.config.root_images_dir).as_posix())
+            return set(self.generate_metadata_filename(Path(image_name)) for image_name in image_names)
+        with self._embedding_stores_lock:
+            metadata_writer: MetadataWriter | None = self._metadata_writer
+        pending_names: set[str] = set() if metadata_writer is None else metadata_writer.get_pending_names(dir_path / self.config.metadata_dirname)
+        try:
+            return set(os.listdir(dir_path / self.config.metadata_dirname)) | pending_names
+        except (FileNotFoundError, NotADirectoryError):
+            return pending_names
+    # end get_metadata_filenames()
+
     def make_metadata_dir(self, dir_path: Path) -> Path:
         metadata_path: Path = dir_path / self.config.metadata_dirname
         metadata_path.mkdir(parents=False, exist_ok=True)
@@ -197,31 +591,460 @@ class FileOps:
         return imagepath
     # end get_imagepath_from_metadata()
 
-    def save_faces(self, metadata_filepath: Path, faces: list[dict]) -> int:
+    def save_faces(self,
+                   metadata_filepath: Path,
+                   faces: list[dict],
+                   crop_store: FaceCropStore | None = None,
+                   on_saved: Callable[[], None] | None = None) -> int:
+        # The face crops are moved to crop_store, if given, and the metadata only keeps their crop ids.
+        # With the sqlite metadata_backend, metadata_filepath only names the image and nothing is written
+        # under the metadata directories, see MetadataCatalog.
+        # With use_metadata_writer the JSON file is written in the background, see MetadataWriter, and the
+        # faces must not be modified afterwards. on_saved is called once the metadata is on disk, with the
+        # sqlite metadata_backend once the catalog transaction holding it has committed, and right away
+        # when there is nothing to write.
+        for face in faces:
+            crop: np.ndarray | None = face.pop(CROP_KEY, None)
+            if crop is not None and crop_store is not None:
+                face['crop_id'] = crop_store.add(crop)
+        if self.config.use_face_index:  # before the mmap embedding storage moves the embeddings out of the faces
+            self.index_faces(metadata_filepath, faces)
         if len(faces) > 0:
-            if not metadata_filepath.parent.exists():
-                self.make_metadata_dir(metadata_filepath.parent.parent)
-        
-            json_string: str = json.dumps(faces, indent=4)
+            if self.config.embedding_storage == 'mmap':
+                self.__store_embeddings(metadata_filepath, faces)
+            else:
+                for face in faces:  # embeddings read back from an embedding store are now kept inline
+                    for fingerprint in face.get('embeddings', {}):
+                        face.get('embedding_rows', {}).pop(fingerprint, None)
 
-            with metadata_filepath.open('w') as md_fp:
-                md_fp.write(json_string)
+            if self.config.metadata_backend == 'sqlite':
+                self.get_catalog().save(self.__get_relative_imagepath(metadata_filepath), faces, on_saved)
+            else:
+                self.__write_json_metadata(metadata_filepath, faces, on_saved)
+            return len(faces)
+        if on_saved is not None:
+            on_saved()
         return len(faces)
     # end save_faces()
 
-    def get_saved_faces(self, metadata_filepath: Path) -> list[dict] | None:
+    def __write_json_metadata(self, metadata_filepath: Path, faces: list[dict], on_saved: Callable[[], None] | None = None) -> None:
+        if self.config.use_metadata_writer:
+            self.get_metadata_writer().submit(metadata_filepath, faces, on_saved)
+            return
+        write_files_atomically([(metadata_filepath, self.__serialize_faces(faces))])
+        if on_saved is not None:
+            on_saved()
+        return
+    # end __write_json_metadata()
+
+    def __serialize_faces(self, faces: list[dict]) -> str:
+        if self.config.embedding_storage == 'mmap':
+            return json.dumps(faces, separators=(',', ':'))
+        return json.dumps(faces, indent=4)
+    # end __serialize_faces()
+
+    def __read_json_metadata(self, metadata_filepath: Path) -> list[dict] | None:
+        with self._embedding_stores_lock:
+            metadata_writer: MetadataWriter | None = self._metadata_writer
+        if metadata_writer is not None:
+            faces: list[dict] | None = metadata_writer.get(metadata_filepath)
+            if faces is not None:
+                return faces
         if not metadata_filepath.exists():
             return None
-        with metadata_filepath.open("r") as md_fp:
-            faces = json.load(md_fp)
+        try:
+            with metadata_filepath.open("r") as md_fp:
+                faces = json.load(md_fp)
+        except json.JSONDecodeError:  # only files written before the writes were atomic
+            log.warning(f'Ignoring unreadable metadata file: {metadata_filepath.as_posix()}')
+            return None
+        return faces
+    # end __read_json_metadata()
+
+    def get_metadata_writer(self) -> MetadataWriter:
+        with self._embedding_stores_lock:
+            if self._metadata_writer is None:
+                self._metadata_writer = MetadataWriter(self.__serialize_faces,
+                                                       self.log,
+                                                       self.config.metadata_writer_queue_size,
+                                                       self.config.metadata_writer_group_size)
+        return self._metadata_writer
+    # end get_metadata_writer()
+
+    def index_faces(self, metadata_filepath: Path, faces: list[dict]) -> None:
+        # The faces of the image replace those the index held for it. Faces without the embedding of
+        # the current configuration are left out until it is computed.
+        face_index: FaceIndex = self.get_face_index()
+        image_path: str = self.__get_relative_imagepath(metadata_filepath)
+        fingerprint: str = self.config.embedding_fingerprint()
+        indexed_faces: set[int] = set()
+        for index, face in enumerate(faces):
+            embedding: list[float] | None = face.get('embeddings', {}).get(fingerprint)
+            if embedding is not None:
+                face_index.add(image_path, index, embedding, face.get('name'))
+                indexed_faces.add(index)
+        for index in face_index.get_face_indices(image_path) - indexed_faces:
+            face_index.remove(image_path, index)
+        return
+    # end index_faces()
+
+    def get_face_index(self) -> FaceIndex:
+        # Nearest neighbor index of the embeddings of the current configuration for the whole tree, in the
+        # metadata directory of root_images_dir
+        with self._embedding_stores_lock:
+            if self._face_index is None:
+                self._face_index = FaceIndex(self.config.root_images_dir / self.config.metadata_dirname,
+                                             f'face_index_{self.config.embedding_fingerprint()}',
+                                             self.config.distance_metric,
+                                             self.config.face_index_probes,
+                                             self.config.face_index_train_size,
+                                             self.config.face_index_max_lists)
+        return self._face_index
+    # end get_face_index()
+
+    def remove_face_index(self) -> None:
+        # Deletes the face index files. Without use_face_index nothing keeps the index up to date, so an
+        # index built for a single clustering must not outlive it.
+        face_index: FaceIndex = self.get_face_index()
+        with self._embedding_stores_lock:
+            self._face_index = None
+        face_index.close()
+        face_index.snapshot_filepath.unlink(missing_ok=True)
+        face_index.journal_filepath.unlink(missing_ok=True)
+        return
+    # end remove_face_index()
+
+    def remove_faces(self, metadata_filepath: Path) -> None:
+        # Forgets the faces of an image that was deleted: its metadata, embedding store rows and index entries
+        faces: list[dict] | None = self.get_saved_faces(metadata_filepath, with_embeddings=False)
+        if faces is None:
+            return
+        for face in faces:
+            for fingerprint, row in face.get('embedding_rows', {}).items():
+                self.get_embedding_store(fingerprint).invalidate(row)
+        if self.config.use_face_index:
+            self.get_face_index().remove_image(self.__get_relative_imagepath(metadata_filepath))
+        if self.config.metadata_backend == 'sqlite':
+            self.get_catalog().remove(self.__get_relative_imagepath(metadata_filepath))
+        else:
+            with self._embedding_stores_lock:
+                metadata_writer: MetadataWriter | None = self._metadata_writer
+            if metadata_writer is not None:
+                metadata_writer.flush()  # a pending write would bring the file back
+            metadata_filepath.unlink(missing_ok=True)
+        return
+    # end remove_faces()
+
+    def __get_relative_imagepath(self, metadata_filepath: Path) -> str:
+        return self.get_imagepath_from_metadata(metadata_filepath).relative_to(self.config.root_images_dir).as_posix()
+    # end __get_relative_imagepath()
+
+    def get_catalog(self) -> MetadataCatalog:
+        # One catalog for the whole tree, in the metadata directory of root_images_dir
+        with self._embedding_stores_lock:
+            if self._catalog is None:
+                self._catalog = MetadataCatalog(self.config.root_images_dir / self.config.metadata_dirname / self.config.catalog_filename,
+                                                self.config.catalog_batch_size)
+        return self._catalog
+    # end get_catalog()
+
+    def export_metadata_to_json(self) -> int:
+        # Writes every image of the catalog as a JSON metadata file, the layout of the json metadata_backend
+        image_count: int = 0
+        catalog: MetadataCatalog = self.get_catalog()
+        for _, image_paths in catalog.get_images_by_dir():
+            for image_path in image_paths:
+                faces: list[dict] | None = catalog.get(image_path)
+                if faces is not None and len(faces) > 0:
+                    self.__write_json_metadata(self.generate_metadata_filepath(self.config.root_images_dir / image_path), faces)
+                    image_count += 1
+        self.flush()  # the files are on disk when this returns, even with the metadata writer
+        return image_count
+    # end export_metadata_to_json()
+
+    def import_metadata_from_json(self) -> int:
+        # Adds every JSON metadata file under root_images_dir to the catalog, replacing what it had for those images
+        image_count: int = 0
+        catalog: MetadataCatalog = self.get_catalog()
+        for _, metadata_files in self.__get_json_metadata_batches(self.config.traversal_threads):
+            for metadata_file in metadata_files:
+                faces: list[dict] | None = self.__read_json_metadata(metadata_file.path)
+                if faces is not None and len(faces) > 0:
+                    catalog.save(self.__get_relative_imagepath(metadata_file.path), faces)
+                    image_count += 1
+        catalog.flush()
+        return image_count
+    # end import_metadata_from_json()
+
+    def __store_embeddings(self, metadata_filepath: Path, faces: list[dict]) -> None:
+        # With the mmap embedding storage the metadata only keeps the row of each embedding in the
+        # EmbeddingStore of its fingerprint, under 'embedding_rows'. The rows of the faces this file held
+        # before, e.g. when an image is detected again, are marked as no longer valid.
+        image_path: str = self.__get_relative_imagepath(metadata_filepath)
+        old_rows: set[tuple[str, int]] = set()
+        for old_face in self.get_saved_faces(metadata_filepath, with_embeddings=False) or []:
+            old_rows.update(old_face.get('embedding_rows', {}).items())
+
+        new_rows: set[tuple[str, int]] = set()
+        for face_index, face in enumerate(faces):
+            rows: dict[str, int] = face.setdefault('embedding_rows', {})
+            for fingerprint, embedding in face.pop('embeddings', {}).items():
+                store: EmbeddingStore = self.get_embedding_store(fingerprint)
+                if fingerprint in rows:
+                    stored_embedding: np.ndarray | None = store.get(rows[fingerprint])
+                    if stored_embedding is not None and np.array_equal(stored_embedding, np.asarray(embedding, dtype=store.dtype)):
+                        store.set_name(rows[fingerprint], face.get('name'))
+                        continue  # unchanged, e.g. faces saved again with new names
+                rows[fingerprint] = store.append(image_path, face_index, face['area'], face['confidence'], face.get('name'), embedding)
+            new_rows.update(rows.items())
+
+        for fingerprint, row in old_rows - new_rows:
+            self.get_embedding_store(fingerprint).invalidate(row)
+        return
+    # end __store_embeddings()
+
+    def get_embedding_store(self, fingerprint: str) -> EmbeddingStore:
+        # One store per embedding fingerprint for the whole tree, in the metadata directory of root_images_dir
+        with self._embedding_stores_lock:
+            store: EmbeddingStore | None = self._embedding_stores.get(fingerprint)
+            if store is None:
+                store = EmbeddingStore(self.config.root_images_dir / self.config.metadata_dirname,
+                                       f'embeddings_{fingerprint}',
+                                       self.config.embedding_storage_dtype)
+                self._embedding_stores[fingerprint] = store
+        return store
+    # end get_embedding_store()
+
+    def flush(self) -> None:
+        # Makes the face crops, metadata files, embeddings, catalog entries and face index saved so far
+        # durable. The crops go first, since the metadata refers to them by id.
+        with self._embedding_stores_lock:
+            stores: list[EmbeddingStore] = list(self._embedding_stores.values())
+            catalog: MetadataCatalog | None = self._catalog
+            metadata_writer: MetadataWriter | None = self._metadata_writer
+            face_index: FaceIndex | None = self._face_index
+            crop_store: FaceCropStore | None = self._crop_store
+        if crop_store is not None:
+            crop_store.flush()
+        if metadata_writer is not None:
+            metadata_writer.flush()
+        if face_index is not None:
+            face_index.flush()
+        for store in stores:
+            store.flush()
+        if catalog is not None:
+            catalog.flush()
+        return
+    # end flush()
+
+    def close(self) -> None:
+        with self._embedding_stores_lock:
+            stores: list[EmbeddingStore] = list(self._embedding_stores.values())
+            self._embedding_stores = {}
+            catalog: MetadataCatalog | None = self._catalog
+            self._catalog = None
+            metadata_writer: MetadataWriter | None = self._metadata_writer
+            self._metadata_writer = None
+            face_index: FaceIndex | None = self._face_index
+            self._face_index = None
+            crop_store: FaceCropStore | None = self._crop_store
+            self._crop_store = None
+        if crop_store is not None:
+            crop_store.close()
+        if metadata_writer is not None:
+            metadata_writer.close()
+        if face_index is not None:
+            face_index.close()
+        for store in stores:
+            store.close()
+        if catalog is not None:
+            catalog.close()
+        return
+    # end close()
+
+    def get_saved_faces(self, metadata_filepath: Path, with_embeddings: bool = True) -> list[dict] | None:
+        if self.config.metadata_backend == 'sqlite':
+            faces: list[dict] | None = self.get_catalog().get(self.__get_relative_imagepath(metadata_filepath))
+        else:
+            faces = self.__read_json_metadata(metadata_filepath)
+        if faces is None:
+            return None
+        # Faces saved before embeddings were fingerprinted have a single 'embedding', which can only
+        # have come from the configuration in use at the time, assumed to be the current one
+        fingerprint: str = self.config.embedding_fingerprint()
+        for face in faces:
+            if 'embedding' in face:
+                face.setdefault('embeddings', {}).setdefault(fingerprint, face.pop('embedding'))
+            # Only the embedding of the current configuration is read back from the embedding store
+            if with_embeddings and fingerprint in face.get('embedding_rows', {}) and fingerprint not in face.get('embeddings', {}):
+                embedding: np.ndarray | None = self.get_embedding_store(fingerprint).get(face['embedding_rows'][fingerprint])
+                if embedding is not None:
+                    face.setdefault('embeddings', {})[fingerprint] = embedding.astype(np.float32).tolist()
         return faces
     # end get_saved_faces()
 
+    def get_embedding_fingerprints_filepath(self) -> Path:
+        return self.config.root_images_dir / self.config.metadata_dirname / self.config.embedding_fingerprints_filename
+    # end get_embedding_fingerprints_filepath()
+
+    def get_embedding_fingerprints(self) -> dict[str, dict]:
+        # fingerprint -> {'fields': the configuration it stands for, 'storage': the embedding_storage it was
+        #                 completed with, 'complete': whether every saved face has it}
+        filepath: Path = self.get_embedding_fingerprints_filepath()
+        if not filepath.exists():
+            return {}
+        with filepath.open('r') as fingerprints_fp:
+            return json.load(fingerprints_fp)
+    # end get_embedding_fingerprints()
+
+    def set_embedding_fingerprint(self, complete: bool) -> None:
+        # Records the current embedding fingerprint, written atomically
+        fingerprints: dict[str, dict] = self.get_embedding_fingerprints()
+        fingerprints[self.config.embedding_fingerprint()] = \
+            {'fields': self.config.fingerprint_fields(self.config.embedding_fingerprint_fields),
+             'storage': self.config.embedding_storage,
+             'complete': complete}
+        filepath: Path = self.get_embedding_fingerprints_filepath()
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        temp_filepath: Path = filepath.with_name(filepath.name + '.tmp')
+        with temp_filepath.open('w') as fingerprints_fp:
+            json.dump(fingerprints, fingerprints_fp, indent=4)
+            fingerprints_fp.flush()
+            os.fsync(fingerprints_fp.fileno())
+        os.replace(temp_filepath, filepath)
+        return
+    # end set_embedding_fingerprint()
+
+    def get_cluster_state_filepath(self) -> Path:
+        return self.config.root_images_dir / self.config.metadata_dirname / self.config.cluster_state_filename
+    # end get_cluster_state_filepath()
+
+    def get_cluster_state(self) -> dict | None:
+        # The state of the clustering of the current embedding fingerprint, None if its faces were never
+        # clustered: {'faces': number of faces at the last full clustering, 'changed': faces added since,
+        #             'pending': [image path, face index] of the new faces that matched no one}
+        filepath: Path = self.get_cluster_state_filepath()
+        if not filepath.exists():
+            return None
+        with filepath.open('r') as state_fp:
+            return json.load(state_fp).get(self.config.embedding_fingerprint())
+    # end get_cluster_state()
+
+    def set_cluster_state(self, state: dict) -> None:
+        # Records the clustering state of the current embedding fingerprint, written atomically
+        filepath: Path = self.get_cluster_state_filepath()
+        states: dict[str, dict] = {}
+        if filepath.exists():
+            with filepath.open('r') as state_fp:
+                states = json.load(state_fp)
+        states[self.config.embedding_fingerprint()] = state
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        write_files_atomically([(filepath, json.dumps(states))])
+        return
+    # end set_cluster_state()
+
     def is_hidden(self, path: Path) -> bool:
         return path.name.startswith('.')
     # end is_hidden()
 # end class FileOps
 
+class NoFacesCache:
+    # Record of the images that were processed and have no faces, so that they are not decoded and
+    # run through the detector again on every run. save_faces does not write metadata for those images.
+    #
+    # Each metadata directory holds a small JSON file (config.no_faces_filename) mapping the detector
+    # fingerprint to {image name: [size, mtime_ns]}. With the sqlite metadata_backend the records are kept
+    # in the no_faces table of the catalog instead, so that no image directory gets a metadata directory
+    # for them. An image is only considered faceless while its size and mtime are unchanged and the
+    # detection parameters have the same fingerprint. Directories are loaded on demand and the changes
+    # are written by flush().
+
+    def __init__(self, config: FacesConfigManager, file_ops: FileOps, flush_every: int = 1000) -> None:
+        self.config: FacesConfigManager = config
+        self.file_ops: FileOps = file_ops
+        self.fingerprint: str = config.detector_fingerprint()
+        self.flush_every: int = flush_every
+        self._lock = threading.Lock()
+        self._dirs: dict[Path, dict[str, dict[str, list[int]]]] = {}  # image dir -> {fingerprint: {image name: [size, mtime_ns]}}
+        self._dirty_dirs: set[Path] = set()
+        self._added_since_flush: int = 0
+        self._use_catalog: bool = config.metadata_backend == 'sqlite'
+        self._added_records: list[tuple[str, str, int, int]] = []  # for the catalog, written by flush()
+        return
+    # end __init__()
+
+    def _get_filepath(self, dir_path: Path) -> Path:
+        return dir_path / self.config.metadata_dirname / self.config.no_faces_filename
+    # end _get_filepath()
+
+    def _get_dir(self, dir_path: Path) -> dict[str, dict[str, list[int]]]:
+        # Must be called with the lock held
+        if dir_path not in self._dirs and self._use_catalog:
+            relative_dir: str = dir_path.relative_to(self.config.root_images_dir).as_posix()
+            self._dirs[dir_path] = {self.fingerprint: self.file_ops.get_catalog().get_no_faces(relative_dir, self.fingerprint)}
+        if dir_path not in self._dirs:
+            records: dict = {}
+            try:
+                with self._get_filepath(dir_path).open('r') as cache_fp:
+                    records = json.load(cache_fp)
+            except FileNotFoundError:
+                pass
+            except (OSError, json.JSONDecodeError):
+                log.warning(f'Ignoring unreadable no faces cache in: {dir_path.as_posix()}')
+            self._dirs[dir_path] = records
+        return self._dirs[dir_path]
+    # end _get_dir()
+
+    def contains(self, image_path: Path, size: int, mtime_ns: int) -> bool:
+        with self._lock:
+            images: dict[str, list[int]] = self._get_dir(image_path.parent).get(self.fingerprint, {})
+            return images.get(image_path.name) == [size, mtime_ns]
+    # end contains()
+
+    def add(self, image_path: Path) -> None:
+        try:
+            stat_result = image_path.stat()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            records = self._get_dir(image_path.parent)
+            records.setdefault(self.fingerprint, {})[image_path.name] = [stat_result.st_size, stat_result.st_mtime_ns]
+            if self._use_catalog:
+                self._added_records.append((image_path.relative_to(self.config.root_images_dir).as_posix(),
+                                            self.fingerprint,
+                                            stat_result.st_size,
+                                            stat_result.st_mtime_ns))
+            else:
+                self._dirty_dirs.add(image_path.parent)
+            self._added_since_flush += 1
+            must_flush: bool = self._added_since_flush >= self.flush_every
+        if must_flush:
+            self.flush()
+        return
+    # end add()
+
+    def flush(self) -> None:
+        with self._lock:
+            dirty: dict[Path, str] = {dir_path: json.dumps(self._dirs[dir_path], separators=(',', ':')) for dir_path in self._dirty_dirs}
+            self._dirty_dirs = set()
+            self._dirs = {}  # also releases the directories that were only read
+            self._added_since_flush = 0
+            added_records: list[tuple[str, str, int, int]] = self._added_records
+            self._added_records = []
+        if len(added_records) > 0:
+            self.file_ops.get_catalog().add_no_faces(added_records)
+        for dir_path, json_string in dirty.items():
+            filepath: Path = self._get_filepath(dir_path)
+            if not filepath.parent.exists():
+                self.file_ops.make_metadata_dir(dir_path)
+            temp_filepath: Path = filepath.with_name(filepath.name + '.tmp')
+            with temp_filepath.open('w') as cache_fp:
+                cache_fp.write(json_string)
+            os.replace(temp_filepath, filepath)
+        return
+    # end flush()
+# end class NoFacesCache
+
 class FaceModels:
     def __init__(self, config: FacesConfigManager) -> None:
         self.config = config
@@ -229,6 +1052,8 @@ class FaceModels:
         self.identification_model_name: str = config.identification_model_name
         self.identification_model = config.identification_model
         self.face_detector_model = config.face_detector_model
+        self.cascade_detector_model = None
+        self.embedding_fingerprint: str = config.embedding_fingerprint()
 
         if config.force_early_model_build:
             self.face_detector_model = self.get_face_detector_model()
@@ -238,26 +1063,59 @@ class FaceModels:
 
     def add_embedding(self, face: list):
         global log
-        normalized_face_image, area, confidence = face
+        face_image, area, confidence = face
         start_time = time.time()
-        embedding = self.get_representation(image = normalized_face_image)
+        embedding = self.get_representation(image = self.fit_face_image(face_image))
         end_time = time.time()
         delta_time = end_time - start_time
         log.info(f'Face representation (embedding) generated in {delta_time} seconds.')
-        face_with_embedding: dict = {'name': None, 'area': area, 'confidence': confidence, 'embedding': embedding}
+        face_with_embedding: dict = self.create_face(area, confidence, embedding, face_image)
         # face_with_embedding.update(area)
         return face_with_embedding
 
+    def create_face(self,
+                    area: dict[str, int],
+                    confidence: float,
+                    embedding: list[float],
+                    face_image: np.ndarray | None = None) -> dict:
+        # face_image is the aligned face the embedding was computed from, see fit_face_image(). With
+        # use_crop_store it is kept under CROP_KEY until the face is saved, see FileOps.save_faces, at its
+        # own resolution so that any identification model can use it, only reduced to crop_max_size.
+        face: dict = {'name': None, 'area': area, 'confidence': confidence, 'embeddings': {self.embedding_fingerprint: embedding}}
+        if self.config.use_crop_store and face_image is not None:
+            crop: np.ndarray = face_image
+            factor: float = self.config.crop_max_size / max(crop.shape[:2])
+            if factor < 1.0:
+                channels: int = 1 if crop.ndim == 2 else crop.shape[2]
+                crop_size: tuple[int, int] = (max(int(crop.shape[1] * factor), 1), max(int(crop.shape[0] * factor), 1))
+                crop = cv2.resize(crop, crop_size, interpolation=cv2.INTER_AREA).reshape(crop_size[1], crop_size[0], channels)
+            face[CROP_KEY] = np.clip(np.rint(crop), 0, 255).astype(np.uint8)
+        return face
+    # end create_face()
+
+    def get_embedding(self, face: dict) -> list[float] | None:
+        # The embedding of face for the current configuration, None if it has not been computed yet
+        return face.get('embeddings', {}).get(self.embedding_fingerprint)
+    # end get_embedding()
+
+    def set_embedding(self, face: dict, embedding: list[float]) -> None:
+        # Embeddings of the other configurations are kept
+        face.setdefault('embeddings', {})[self.embedding_fingerprint] = embedding
+    # end set_embedding()
+
     def generate_embeddings(self, faces_found: list):
         global log
         faces: list[dict] = []
         face_count = 0
+        batch_size: int = self.config.embedding_batch_size
         embeddings_start_time = time.time()
-        for face_found in faces_found:
-            log.info(f'Generating embedding for face: {face_count}')
-            face = self.add_embedding(face_found)
-            faces.append(face)
-            face_count += 1
+        for batch_start in range(0, len(faces_found), batch_size):
+            batch = faces_found[batch_start:batch_start + batch_size]
+            log.info(f'Generating embeddings for faces: {face_count} to {face_count + len(batch) - 1}')
+            embeddings = self.get_representations([face_image for face_image, _, _ in batch])  # see fit_face_image()
+            for (face_image, area, confidence), embedding in zip(batch, embeddings):
+                faces.append(self.create_face(area, confidence, embedding, face_image))
+            face_count += len(batch)
         # end for
         end_time = time.time()
         delta_time = end_time - embeddings_start_time
@@ -265,6 +1123,27 @@ class FaceModels:
         return faces
     # end generate_embeddings()
 
+    def fit_face_image(self, face_image: np.ndarray) -> np.ndarray:
+        # The (1, h, w, c) float input of the identification model for an aligned face of any size, as
+        # found by detection or kept in the crop store: resized to fit the target size of the current
+        # model, keeping its aspect ratio, and padded, the same steps as functions.extract_faces.
+        if self.config.grayscale and face_image.ndim == 3 and face_image.shape[2] == 3:
+            face_image = cv2.cvtColor(np.ascontiguousarray(face_image), cv2.COLOR_BGR2GRAY)
+        elif face_image.ndim == 3 and face_image.shape[2] == 1:
+            face_image = face_image[:, :, 0]
+        target_height, target_width = self.config.target_size[0], self.config.target_size[1]
+        factor: float = min(target_height / face_image.shape[0], target_width / face_image.shape[1])
+        face_image = cv2.resize(face_image, (int(face_image.shape[1] * factor), int(face_image.shape[0] * factor)))
+        diff_height, diff_width = target_height - face_image.shape[0], target_width - face_image.shape[1]
+        padding: list[tuple[int, int]] = [(diff_height // 2, diff_height - diff_height // 2), (diff_width // 2, diff_width - diff_width // 2)]
+        face_image = np.pad(face_image, padding + [(0, 0)] * (face_image.ndim - 2), 'constant')
+        if face_image.shape[0:2] != tuple(self.config.target_size):
+            face_image = cv2.resize(face_image, tuple(self.config.target_size))
+        if face_image.ndim == 2:
+            face_image = face_image[:, :, np.newaxis]
+        return (face_image.astype(np.float32) / 255)[np.newaxis]
+    # end fit_face_image()
+
     def get_face_detector_model(self): # Lazy model build
         global log
         if self.face_detector_model is None:
@@ -277,6 +1156,17 @@ class FaceModels:
         return self.face_detector_model
     # end get_face_detector_model()
 
+    def get_cascade_detector_model(self): # Lazy model build
+        global log
+        if self.cascade_detector_model is None and self.config.cascade_detector_name is not None:
+            log.info(f'Cascade face detection model build starting: {self.config.cascade_detector_name}...')
+            start_time = time.time()
+            self.cascade_detector_model = FaceDetector.build_model(self.config.cascade_detector_name)
+            end_time = time.time()
+            log.info(f'Cascade face detection model built in {end_time - start_time} seconds.\n')
+        return self.cascade_detector_model
+    # end get_cascade_detector_model()
+
     def get_representation(self,
                            image: np.ndarray):
         global log
@@ -298,6 +1188,37 @@ class FaceModels:
         return embedding
     # end get_representation()
 
+    def normalize_batch(self, images: np.ndarray) -> np.ndarray:
+        # Vectorized equivalent of calling functions.normalize_input on each face separately.
+        # Facenet is the only normalization that depends on the image statistics, so the
+        # mean and std must be computed per face instead of over the whole batch.
+        if self.config.normalization is None or self.config.normalization == 'base':
+            return images
+        if self.config.normalization == 'Facenet':
+            images = images * 255
+            axes = tuple(range(1, images.ndim))
+            mean = images.mean(axis=axes, keepdims=True)
+            std = images.std(axis=axes, keepdims=True)
+            return (images - mean) / std
+        return functions.normalize_input(img=images, normalization=self.config.normalization)
+    # end normalize_batch()
+
+    def get_representations(self, images: list[np.ndarray]) -> list[list[float]]:
+        # images are aligned faces of any size, fitted to the current model with fit_face_image()
+        if len(images) == 0:
+            return []
+        batch: np.ndarray = np.concatenate([self.fit_face_image(image) for image in images], axis=0)
+        norm_batch = self.normalize_batch(batch)
+
+        self.identification_model = self.get_identification_model()
+        if 'keras' in str(type(self.identification_model)):
+            embeddings = self.identification_model.predict(norm_batch, batch_size=len(norm_batch), verbose=0)
+            return [embedding.tolist() for embedding in embeddings]
+
+        # SFace and Dlib are not keras models and only embed the first image they are given
+        return [self.identification_model.predict(norm_batch[i:i+1])[0].tolist() for i in range(len(norm_batch))]
+    # end get_representations()
+
     def get_identification_model(self): # Lazy model build
         global log
         if self.identification_model is None:
@@ -322,18 +1243,50 @@ class FaceDetection:
         return
     #end __init__()
 
-    def __get_faces(self, filepath: Path):
+    def find_faces(self,
+                   filepath: Path,
+                   image: np.ndarray | None = None,
+                   scale: float = 1.0,
+                   data: bytes | None = None):
+        # image is the already decoded image file, if available, so that it is not decoded again.
+        # It may be a reduced resolution decode, in which case scale maps its coordinates back to the
+        # full resolution image and data holds the undecoded file, if it is still in memory.
+        # The areas returned are always in full resolution coordinates.
         global log
         log.info(f'Finding faces from image: {str(filepath)}\n')
         start_time = time.time()
+
+        if image is None:
+            data = read_image_bytes(filepath)
+            image, scale = decode_for_detection(data, self.config.detection_max_pixels)
+            if image is None:
+                log.info(f'Unable to open image file: {filepath.as_posix()}')
+                return []
         
-        faces_found = functions.extract_faces(
-            img=filepath.as_posix(),
-            target_size=self.config.target_size,
-            detector_backend=self.config.detector_model_name,
-            enforce_detection=self.config.enforce_detection,
-            align=self.config.align,
-            grayscale=self.config.grayscale)
+        candidates: list[dict[str, int]] | None = None
+        if self.config.cascade_detector_name is not None:
+            candidates = self.__screen(image)
+
+        if candidates is None or (self.config.cascade_mode == 'image' and len(candidates) > 0):
+            full_pixels: float = image.shape[0] * image.shape[1] * scale * scale
+            if self.config.tiling_min_pixels > 0 and full_pixels > self.config.tiling_min_pixels:
+                # The small faces tiling is for are lost in a reduced decode, so the tiles are cut from the
+                # full resolution image
+                if scale != 1.0:
+                    full_image: np.ndarray | None = decode_image(read_image_bytes(filepath) if data is None else data)
+                    if full_image is not None:
+                        image, scale = full_image, 1.0
+                faces_found = self.__find_in_tiles(image)
+            else:
+                faces_found = self.__find_in_region(image, {'x': 0, 'y': 0, 'w': image.shape[1], 'h': image.shape[0]})
+        else:
+            faces_found = []
+            for region in self.__merge_regions(candidates, image.shape[1], image.shape[0]):
+                faces_found.extend(self.__find_in_region(image, region))
+            faces_found = self.__remove_duplicates(faces_found)
+
+        if scale != 1.0 and len(faces_found) > 0:
+            faces_found = self.__to_full_resolution(filepath, faces_found, scale, data)
             
         end_time = time.time()
         delta_time = end_time - start_time
@@ -341,10 +1294,237 @@ class FaceDetection:
         log.info(f'Found {len(faces_found)} face(s) in {delta_time} seconds from image {filepath.as_posix()}')
 
         return faces_found
-    # end __get_faces
+    # end find_faces()
+
+    def __find_in_region(self, image: np.ndarray, region: dict[str, int]) -> list:
+        # Faces found in region of image, with their areas relative to the whole image.
+        # Without enforce_detection, extract_faces returns the whole input with confidence 0 when it
+        # finds no face. That is not a face, so it is dropped and the image is recorded as faceless.
+        region_image: np.ndarray = image[region['y']:region['y'] + region['h'], region['x']:region['x'] + region['w']]
+        faces_found: list = []
+        for face_pixels, area, confidence in self.__extract_faces(region_image):
+            if self.__is_whole_image([face_pixels, area, confidence], region['w'], region['h']):
+                continue
+            faces_found.append([face_pixels,
+                                {'x': region['x'] + area['x'], 'y': region['y'] + area['y'], 'w': area['w'], 'h': area['h']},
+                                confidence])
+        return faces_found
+    # end __find_in_region()
 
-    def get_from_file(self, filepath: Path) -> list[dict]:
-        faces_found = self.__get_faces(filepath)
+    def __find_in_tiles(self, image: np.ndarray) -> list:
+        # For images too large to run the detector on at once. At every scale in tile_scales the image is
+        # covered by overlapping tiles of tile_size pixels once scaled, so small faces are found at scale
+        # 1 and large ones, cut by the tiles, at the smaller scales. Each tile is cropped from the image
+        # (a view) and only the crop is resized, so the memory used is bounded by the tile size and not
+        # by the image size. The boxes of all tiles are merged by non maximum suppression.
+        image_height, image_width = image.shape[:2]
+        faces_found: list = []
+        for tile_scale in sorted(self.config.tile_scales, reverse=True):
+            span: int = int(self.config.tile_size / tile_scale)  # tile size in image pixels
+            stride: int = max(int(span * (1 - self.config.tile_overlap)), 1)
+            for y in self.__tile_starts(image_height, span, stride):
+                for x in self.__tile_starts(image_width, span, stride):
+                    tile: np.ndarray = image[y:y + span, x:x + span]
+                    tile_height, tile_width = tile.shape[:2]
+                    if tile_scale != 1.0:
+                        tile = cv2.resize(tile,
+                                          (max(int(tile_width * tile_scale), 1), max(int(tile_height * tile_scale), 1)),
+                                          interpolation=cv2.INTER_AREA)
+                    factor_x: float = tile_width / tile.shape[1]
+                    factor_y: float = tile_height / tile.shape[0]
+                    for face_pixels, area, confidence in self.__find_in_region(tile, {'x': 0, 'y': 0, 'w': tile.shape[1], 'h': tile.shape[0]}):
+                        faces_found.append([face_pixels,
+                                            {'x': x + int(area['x'] * factor_x),
+                                             'y': y + int(area['y'] * factor_y),
+                                             'w': int(area['w'] * factor_x),
+                                             'h': int(area['h'] * factor_y)},
+                                            confidence])
+            if span >= max(image_width, image_height):
+                break  # the whole image fits in one tile, smaller scales would find nothing new
+        if len(faces_found) == 0:
+            return faces_found
+
+        boxes: np.ndarray = clip_boxes(np.array([[face_found[1][key] for key in ('x', 'y', 'w', 'h')] for face_found in faces_found]),
+                                       image_width,
+                                       image_height)
+        scores: np.ndarray = np.array([face_found[2] for face_found in faces_found], dtype=np.float64)
+        kept_faces: list = []
+        for index in non_max_suppression(boxes, scores, self.config.tile_nms_threshold):
+            x, y, w, h = (int(value) for value in boxes[index])
+            if w > 0 and h > 0:
+                kept_faces.append([faces_found[index][0], {'x': x, 'y': y, 'w': w, 'h': h}, faces_found[index][2]])
+        log.info(f'Tiled detection kept {len(kept_faces)} of {len(faces_found)} face(s) found in the tiles.')
+        return kept_faces
+    # end __find_in_tiles()
+
+    def __tile_starts(self, length: int, span: int, stride: int) -> list[int]:
+        # Tile origins along one axis; the last tile is aligned to the end so no border is left out
+        if span >= length:
+            return [0]
+        starts: list[int] = list(range(0, length - span, stride))
+        starts.append(length - span)
+        return starts
+    # end __tile_starts()
+
+    def __screen(self, image: np.ndarray) -> list[dict[str, int]]:
+        # Runs the cheap cascade detector on a downscaled copy of image and returns the candidate face
+        # areas, in image coordinates, with a confidence of at least cascade_min_confidence. Lowering
+        # that threshold, or raising cascade_region_margin, trades speed for recall.
+        image_height, image_width = image.shape[:2]
+        factor: float = min(1.0, (self.config.cascade_max_pixels / (image_width * image_height)) ** 0.5)
+        small_image: np.ndarray = image
+        if factor < 1.0:
+            small_size: tuple[int, int] = (max(int(image_width * factor), 1), max(int(image_height * factor), 1))
+            small_image = cv2.resize(image, small_size, interpolation=cv2.INTER_AREA)
+        detections = FaceDetector.detect_faces(self.models.get_cascade_detector_model(),
+                                               self.config.cascade_detector_name,
+                                               small_image,
+                                               align=False)
+        candidates: list[dict[str, int]] = []
+        for _, (x, y, w, h), confidence in detections:
+            if confidence is not None and confidence < self.config.cascade_min_confidence:
+                continue
+            candidates.append({'x': int(x / factor), 'y': int(y / factor), 'w': int(w / factor), 'h': int(h / factor)})
+        log.info(f'Cascade detector {self.config.cascade_detector_name} found {len(candidates)} candidate face(s).')
+        return candidates
+    # end __screen()
+
+    def __merge_regions(self, candidates: list[dict[str, int]], image_width: int, image_height: int) -> list[dict[str, int]]:
+        # Expands every candidate by cascade_region_margin, so the expensive detector sees the whole face
+        # and some context, and merges the regions that overlap so no face is split between two regions
+        regions: list[dict[str, int]] = []
+        for area in candidates:
+            margin_x: int = int(area['w'] * self.config.cascade_region_margin)
+            margin_y: int = int(area['h'] * self.config.cascade_region_margin)
+            regions.append(self.__clip_area({'x': area['x'] - margin_x,
+                                             'y': area['y'] - margin_y,
+                                             'w': area['w'] + 2 * margin_x,
+                                             'h': area['h'] + 2 * margin_y},
+                                            image_width,
+                                            image_height))
+        merged: bool = True
+        while merged:
+            merged = False
+            for i in range(len(regions)):
+                for j in range(i + 1, len(regions)):
+                    a, b = regions[i], regions[j]
+                    if a['x'] < b['x'] + b['w'] and b['x'] < a['x'] + a['w'] and a['y'] < b['y'] + b['h'] and b['y'] < a['y'] + a['h']:
+                        x1, y1 = min(a['x'], b['x']), min(a['y'], b['y'])
+                        x2, y2 = max(a['x'] + a['w'], b['x'] + b['w']), max(a['y'] + a['h'], b['y'] + b['h'])
+                        regions[i] = {'x': x1, 'y': y1, 'w': x2 - x1, 'h': y2 - y1}
+                        del regions[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return [region for region in regions if region['w'] > 0 and region['h'] > 0]
+    # end __merge_regions()
+
+    def __remove_duplicates(self, faces_found: list, max_overlap: float = 0.5) -> list:
+        # Regions are disjoint, but a face on the border of one may also be found, cut, in another.
+        # Keeps the most confident of the faces whose areas overlap by more than max_overlap (IoU).
+        kept: list = []
+        for face_found in sorted(faces_found, key=lambda face_found: face_found[2], reverse=True):
+            a = face_found[1]
+            is_duplicate: bool = False
+            for kept_face in kept:
+                b = kept_face[1]
+                overlap_w: int = min(a['x'] + a['w'], b['x'] + b['w']) - max(a['x'], b['x'])
+                overlap_h: int = min(a['y'] + a['h'], b['y'] + b['h']) - max(a['y'], b['y'])
+                if overlap_w <= 0 or overlap_h <= 0:
+                    continue
+                intersection: int = overlap_w * overlap_h
+                union: int = a['w'] * a['h'] + b['w'] * b['h'] - intersection
+                if union > 0 and intersection / union > max_overlap:
+                    is_duplicate = True
+                    break
+            if not is_duplicate:
+                kept.append(face_found)
+        return kept
+    # end __remove_duplicates()
+
+    def __extract_faces(self, image: np.ndarray, detector_backend: str | None = None, align: bool | None = None) -> list:
+        # [face image, area, confidence] of every face found, as functions.extract_faces but with the
+        # aligned face image left at the resolution it has in image. It is only fitted to the input of the
+        # identification model when embedding, see FaceModels.fit_face_image, so that the same image can
+        # be kept in the crop store for any model.
+        detector_backend = self.config.detector_model_name if detector_backend is None else detector_backend
+        face_objs = FaceDetector.detect_faces(FaceDetector.build_model(detector_backend),
+                                              detector_backend,
+                                              image,
+                                              self.config.align if align is None else align)
+        if len(face_objs) == 0:
+            if self.config.enforce_detection:
+                raise ValueError('Face could not be detected. Please confirm that the picture is a face photo '
+                                 'or consider to set enforce_detection param to False.')
+            face_objs = [(image, [0, 0, image.shape[1], image.shape[0]], 0)]
+        return [[face_image, {'x': int(x), 'y': int(y), 'w': int(w), 'h': int(h)}, confidence]
+                for face_image, (x, y, w, h), confidence in face_objs
+                if face_image.shape[0] > 0 and face_image.shape[1] > 0]
+    # end __extract_faces()
+
+    def __to_full_resolution(self, filepath: Path, faces_found: list, scale: float, data: bytes | None) -> list:
+        # Maps the areas found in the reduced image to the full resolution image. With
+        # detection_refine_faces the full image is decoded, only for images that have faces, and each
+        # face is detected and aligned again in a region around its area, so that the embeddings are
+        # computed from full resolution pixels. Faces the detector misses in their region keep the
+        # crop of the reduced image.
+        full_image: np.ndarray | None = None
+        if self.config.detection_refine_faces:
+            full_image = decode_image(read_image_bytes(filepath) if data is None else data)
+            if full_image is None:
+                log.info(f'Unable to decode full resolution image file: {filepath.as_posix()}')
+
+        refined_faces: list = []
+        for face_pixels, area, confidence in faces_found:
+            full_area: dict[str, int] = {'x': int(round(area['x'] * scale)),
+                                         'y': int(round(area['y'] * scale)),
+                                         'w': int(round(area['w'] * scale)),
+                                         'h': int(round(area['h'] * scale))}
+            if full_image is not None:
+                refined_face = self.__refine_face(full_image, full_area)
+                if refined_face is not None:
+                    refined_faces.append(refined_face)
+                    continue
+                full_area = self.__clip_area(full_area, full_image.shape[1], full_image.shape[0])
+            refined_faces.append([face_pixels, full_area, confidence])
+        return refined_faces
+    # end __to_full_resolution()
+
+    def __refine_face(self, full_image: np.ndarray, area: dict[str, int]) -> list | None:
+        image_height, image_width = full_image.shape[:2]
+        margin_x: int = int(area['w'] * self.config.detection_refine_margin)
+        margin_y: int = int(area['h'] * self.config.detection_refine_margin)
+        region: dict[str, int] = self.__clip_area({'x': area['x'] - margin_x,
+                                                   'y': area['y'] - margin_y,
+                                                   'w': area['w'] + 2 * margin_x,
+                                                   'h': area['h'] + 2 * margin_y},
+                                                  image_width,
+                                                  image_height)
+        if region['w'] <= 0 or region['h'] <= 0:
+            return None
+        faces_found = self.__find_in_region(full_image, region)
+        if len(faces_found) == 0:
+            return None
+        return max(faces_found, key=lambda face_found: face_found[2])
+    # end __refine_face()
+
+    def __clip_area(self, area: dict[str, int], image_width: int, image_height: int) -> dict[str, int]:
+        x, y, w, h = (int(value) for value in clip_boxes(np.array([[area['x'], area['y'], area['w'], area['h']]]), image_width, image_height)[0])
+        return {'x': x, 'y': y, 'w': w, 'h': h}
+    # end __clip_area()
+
+    def __is_whole_image(self, face_found: list, image_width: int, image_height: int) -> bool:
+        _, area, confidence = face_found
+        return confidence == 0 and area == {'x': 0, 'y': 0, 'w': image_width, 'h': image_height}
+    # end __is_whole_image()
+
+    def get_from_file(self,
+                      filepath: Path,
+                      image: np.ndarray | None = None,
+                      scale: float = 1.0,
+                      data: bytes | None = None) -> list[dict]:
+        faces_found = self.find_faces(filepath, image, scale, data)
         faces = []
         if len(faces_found) > 0:
             faces = self.models.generate_embeddings(faces_found)
@@ -353,28 +1533,157 @@ class FaceDetection:
 
 # end class FaceDetection
 
+class EmbeddingScheduler:
+    # Sits between FaceDetection.find_faces and FaceModels and collects the face crops of many
+    # images into fixed size batches, so that the identification model runs on full batches even
+    # when most images have only one or two faces. A batch is flushed when it holds
+    # config.embedding_batch_size faces or when its oldest face has waited more than
+    # config.embedding_batch_max_wait seconds. Once every face of an image has its embedding,
+    # on_image_done(key, faces) is called, e.g. with FileOps.save_faces and the metadata filepath as key.
+    #
+    # The deadline is checked on every submit() and poll() call; close() flushes whatever is pending.
+
+    def __init__(self,
+                 config: FacesConfigManager,
+                 face_models: FaceModels,
+                 on_image_done: Callable[[Any, list[dict]], None]) -> None:
+        self.config: FacesConfigManager = config
+        self.models: FaceModels = face_models
+        self.on_image_done: Callable[[Any, list[dict]], None] = on_image_done
+        self._lock = threading.Lock()
+        self._next_image_id: int = 0
+        self._images: dict[int, tuple[Any, list[dict | None]]] = {}  # image id -> (key, faces so far)
+        self._pending: list[tuple[int, int, list, float]] = []  # (image id, face index, face found, submit time)
+        return
+    # end __init__()
+
+    def submit(self, key: Any, faces_found: list) -> None:
+        if len(faces_found) == 0:
+            self.on_image_done(key, [])
+            return
+        now = time.time()
+        with self._lock:
+            image_id = self._next_image_id
+            self._next_image_id += 1
+            self._images[image_id] = (key, [None] * len(faces_found))
+            for face_index, face_found in enumerate(faces_found):
+                self._pending.append((image_id, face_index, face_found, now))
+        self.poll()
+        return
+    # end submit()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+    # end pending_count()
+
+    def poll(self) -> None:
+        # Runs every full batch and, if the deadline of the oldest pending face has passed, the partial batch
+        batch_size: int = self.config.embedding_batch_size
+        while True:
+            with self._lock:
+                if len(self._pending) == 0:
+                    return
+                is_full = len(self._pending) >= batch_size
+                is_due = (time.time() - self._pending[0][3]) >= self.config.embedding_batch_max_wait
+                if not (is_full or is_due):
+                    return
+                batch = self._pending[:batch_size]
+                del self._pending[:batch_size]
+            self._run_batch(batch)
+    # end poll()
+
+    def flush(self) -> None:
+        batch_size: int = self.config.embedding_batch_size
+        while True:
+            with self._lock:
+                if len(self._pending) == 0:
+                    return
+                batch = self._pending[:batch_size]
+                del self._pending[:batch_size]
+            self._run_batch(batch)
+    # end flush()
+
+    def close(self) -> None:
+        self.flush()
+        return
+    # end close()
+
+    def _run_batch(self, batch: list[tuple[int, int, list, float]]) -> None:
+        global log
+        start_time = time.time()
+        embeddings = self.models.get_representations([face_found[0] for _, _, face_found, _ in batch])
+        log.info(f'Embeddings for a batch of {len(batch)} face(s) generated in {time.time() - start_time} seconds.')
+
+        completed: list[tuple[Any, list[dict]]] = []
+        with self._lock:
+            for (image_id, face_index, face_found, _), embedding in zip(batch, embeddings):
+                face_image, area, confidence = face_found
+                key, faces = self._images[image_id]
+                faces[face_index] = self.models.create_face(area, confidence, embedding, face_image)
+                if all(face is not None for face in faces):
+                    completed.append((key, faces))
+                    del self._images[image_id]
+        for key, faces in completed:
+            self.on_image_done(key, faces)
+        return
+    # end _run_batch()
+# end class EmbeddingScheduler
+
 class FaceIdentification:
     def __init__(self, config: FacesConfigManager, face_models: FaceModels) -> None:
         self.config: FacesConfigManager = config
         self.models: FaceModels = face_models
         return
 
+    def prepare(self, embeddings: np.ndarray | list) -> PreparedEmbeddings:
+        # Embeddings ready for get_distances() with the configured distance_metric. A gallery compared
+        # many times should be prepared once and kept.
+        return prepare_embeddings(embeddings, self.config.distance_metric)
+    # end prepare()
+
+    def get_distances(self,
+                      queries: PreparedEmbeddings | np.ndarray | list,
+                      gallery: PreparedEmbeddings | np.ndarray | list) -> np.ndarray:
+        # (queries, gallery) float32 distance matrix, see distances.py
+        if not isinstance(queries, PreparedEmbeddings):
+            queries = self.prepare(queries)
+        if not isinstance(gallery, PreparedEmbeddings):
+            gallery = self.prepare(gallery)
+        return pairwise_distances(queries, gallery, self.config.distance_block_size)
+    # end get_distances()
+
+    def get_matches(self,
+                    queries: PreparedEmbeddings | np.ndarray | list,
+                    gallery: PreparedEmbeddings | np.ndarray | list) -> np.ndarray:
+        # (queries, gallery) boolean matrix, True where the faces are the same person
+        return self.get_distances(queries, gallery) <= self.config.distance_threshold
+    # end get_matches()
+
+    def get_nearest(self,
+                    queries: PreparedEmbeddings | np.ndarray | list,
+                    gallery: PreparedEmbeddings | np.ndarray,
+                    k: int,
+                    valid: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        # Exact k nearest gallery rows of every query that compare() would match, nearest first: (queries, k)
+        # indices and distances, -1 and inf past the last match. The gallery may be a memory map, e.g.
+        # EmbeddingStore.load() with valid set to its records['valid'] == 1, and is streamed, see top_k().
+        if not isinstance(queries, PreparedEmbeddings):
+            queries = self.prepare(queries)
+        return top_k(queries,
+                     gallery,
+                     k,
+                     self.config.distance_block_size,
+                     self.config.distance_threads,
+                     valid,
+                     self.config.distance_threshold)
+    # end get_nearest()
+
     def compare(self, face1: dict, face2: dict) -> bool:
-        embedding1 = face1['embedding']
-        embedding2 = face2['embedding']
-        distance_metric = self.config.distance_metric
-        if distance_metric == "cosine":
-            dist = distance.findCosineDistance(embedding1, embedding2)
-        elif distance_metric == "euclidean":
-            dist = distance.findEuclideanDistance(embedding1, embedding2)
-        elif distance_metric == "euclidean_l2":
-            dist = distance.findEuclideanDistance(
-                distance.l2_normalize(embedding1), distance.l2_normalize(embedding2)
-            )
-        else:
-            raise ValueError("Invalid distance_metric passed - ", distance_metric)
-        
-        return dist >= self.config.distance_threshold
+        # True when both faces are the same person
+        embedding1 = self.models.get_embedding(face1)
+        embedding2 = self.models.get_embedding(face2)
+        return bool(self.get_matches([embedding1], [embedding2])[0, 0])
     # end compare()
 
 # end class FaceIdentification
@@ -387,8 +1696,12 @@ class FaceFunctions:
         self.face_identification = FaceIdentification(config, self.face_models)
 
     def get_from_area(self, image: np.ndarray, area: dict[str, int]) -> np.ndarray:
-        x, y, w, h = area['x'], area['y'], area['w'], area['h']
-        return image[y:y+h, x:x+w]
+        # image is the decoded image the faces were found in. The area is clipped to the image, since
+        # negative coordinates would otherwise wrap around. The crop is a view, not a copy.
+        image_height, image_width = image.shape[:2]
+        x1, y1 = max(area['x'], 0), max(area['y'], 0)
+        x2, y2 = min(area['x'] + area['w'], image_width), min(area['y'] + area['h'], image_height)
+        return image[y1:y2, x1:x2]
     # end get_from_area()
 
     def __mark_face(self, 
@@ -425,13 +1738,49 @@ class FaceFunctions:
             cv2.destroyWindow('Image')
         return
 
-    def detect(self, filepath: Path):
-        faces = self.face_detection.get_from_file(filepath)
+    def detect(self,
+               filepath: Path,
+               image: np.ndarray | None = None,
+               scale: float = 1.0,
+               data: bytes | None = None):
+        faces = self.face_detection.get_from_file(filepath, image, scale, data)
         return faces
 
-    def identify(self, filepath: Path) -> str:
-        metadata_dir = self.config.metadata_dirname
-        metadata_extension = self.config.metadata_extension
-        name: str = str("")
-        return name
+    def find_faces(self,
+                   filepath: Path,
+                   image: np.ndarray | None = None,
+                   scale: float = 1.0,
+                   data: bytes | None = None):
+        return self.face_detection.find_faces(filepath, image, scale, data)
+
+    def create_embedding_scheduler(self, on_image_done: Callable[[Any, list[dict]], None]) -> EmbeddingScheduler:
+        return EmbeddingScheduler(self.config, self.face_models, on_image_done)
+
+    def identify(self, filepath: Path, face_index: FaceIndex) -> list[str | None]:
+        # The name of every face detected in filepath, in the order of detect(), None when no named
+        # face is near enough, see identify_faces()
+        return self.identify_faces(self.detect(filepath), face_index)
+    # end identify()
+
+    def identify_faces(self, faces: list[dict], face_index: FaceIndex) -> list[str | None]:
+        # Each face gets the name most frequent among its face_index_neighbors nearest faces within
+        # distance_threshold, ties going to the nearest; None when none of them has a name. With
+        # face_index_exact the neighbors are searched exhaustively instead of in the nearest lists.
+        names: list[str | None] = [None] * len(faces)
+        embedded: list[int] = [index for index, face in enumerate(faces) if self.face_models.get_embedding(face) is not None]
+        if len(embedded) == 0:
+            return names
+        neighbors = face_index.search([self.face_models.get_embedding(faces[index]) for index in embedded],
+                                      self.config.face_index_neighbors,
+                                      exact=self.config.face_index_exact,
+                                      num_threads=self.config.distance_threads)
+        for index, face_neighbors in zip(embedded, neighbors):
+            votes: dict[str, int] = {}
+            for _, _, name, distance in face_neighbors:  # nearest first
+                if name is not None and distance <= self.config.distance_threshold:
+                    votes[name] = votes.get(name, 0) + 1
+            if len(votes) > 0:
+                names[index] = max(votes, key=votes.get)  # on a tie, the name seen first, i.e. the nearest
+        return names
+    # end identify_faces()
 # end class FaceFunctions
@@ -1,12 +1,11 @@
 from typing import Callable
-from PIL import Image
-from io import BytesIO
 from pathlib import Path
 from pywebio.input import input
 from pywebio.output import put_image, clear, put_buttons, put_text
 from pywebio.platform.tornado import start_server
 from pywebio.session import hold
 from traverser import Traverser
+from image_loader import read_image_bytes
 from global_logger import GlobalLogger
 
 class NameStorer:
@@ -35,28 +34,20 @@ class ImageNavigator:
         self.on_name: Callable[[str], None] = on_name
         self.current_image_path: Path = Path()
 
-    def pil_to_bytes(self, image: Image.Image, format: str = 'JPEG') -> bytes:
-        with BytesIO() as buffer:
-            image.save(buffer, format=format)
-            return buffer.getvalue()
-
     def display_image(self) -> None:
         self.log.debug(f'Displaying: {self.current_image_path.as_posix()}')
-        image: Image.Image = Image.open(self.current_image_path.as_posix())
-        assert image is not None, 'Unable to open image file'
+        # The file is sent to the browser as is, which decodes it and applies its EXIF orientation,
+        # instead of decoding and re-encoding it here
+        image_bytes: bytes | None = read_image_bytes(self.current_image_path)
+        assert image_bytes is not None, 'Unable to open image file'
         ext = (self.current_image_path.suffix).lower()
         self.log.debug(f'File extension: {ext}')
-        fmt=''
         if ext in ['.jpg', '.jpeg']:
             ext = 'jpg'
-            fmt = 'JPEG'
         elif ext in ['.png']:
             ext = 'png'
-            fmt = 'PNG'
         else:
             assert False, f'ERROR: Invalid file type: {ext}'
-        # image_base64 = self.image_path_to_base64(self.current_image_path, fmt)
-        image_bytes = self.pil_to_bytes(image, format=fmt)
         put_image(image_bytes, format=ext)
     # end display_image()
 
@@ -0,0 +1,212 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import struct
+import math
+import numpy as np
+import cv2
+
+# Every image is read from disk with a single read and decoded once with OpenCV. The decoded
+# array (BGR, uint8) is then handed to detection, cropping and display, so no later step opens
+# the file again. IMREAD_COLOR applies the EXIF orientation of JPEG files, so face areas are
+# always relative to the image as it is displayed.
+#
+# For detection, JPEG files can be decoded at 1/2, 1/4 or 1/8 of their size with libjpeg DCT scaling
+# (IMREAD_REDUCED_*), which skips most of the decoding work and memory instead of resizing afterwards.
+
+REDUCED_COLOR_FLAGS: dict[int, int] = {1: cv2.IMREAD_COLOR,
+                                       2: cv2.IMREAD_REDUCED_COLOR_2,
+                                       4: cv2.IMREAD_REDUCED_COLOR_4,
+                                       8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def read_image_bytes(filepath: Path) -> bytes | None:
+    try:
+        with filepath.open('rb') as image_fp:
+            return image_fp.read()
+    except OSError:
+        return None
+# end read_image_bytes()
+
+def is_jpeg(data: bytes) -> bool:
+    return data[:2] == b'\xff\xd8'
+# end is_jpeg()
+
+def get_image_size(data: bytes) -> tuple[int, int] | None:
+    # Width and height as stored in the JPEG or PNG header, before EXIF orientation, without decoding
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return width, height
+    if not is_jpeg(data):
+        return None
+    offset: int = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker: int = data[offset + 1]
+        if marker == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:  # markers without a length
+            offset += 2
+            continue
+        segment_length: int = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):  # start of frame
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + segment_length
+    return None
+# end get_image_size()
+
+def choose_reduction(width: int, height: int, max_pixels: int) -> int:
+    # Largest DCT scale (1, 2, 4 or 8) that keeps the image at or above max_pixels
+    reduction: int = 1
+    if max_pixels <= 0:
+        return reduction
+    for candidate in (2, 4, 8):
+        if math.ceil(width / candidate) * math.ceil(height / candidate) < max_pixels:
+            break
+        reduction = candidate
+    return reduction
+# end choose_reduction()
+
+def decode_image(data: bytes, reduction: int = 1) -> np.ndarray | None:
+    # reduction is only honoured for JPEG files, where libjpeg scales while decoding
+    if data is None or len(data) == 0:
+        return None
+    flag: int = REDUCED_COLOR_FLAGS[reduction] if is_jpeg(data) else cv2.IMREAD_COLOR
+    try:
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    except cv2.error:
+        image = None
+    return image
+# end decode_image()
+
+def decode_for_detection(data: bytes, max_pixels: int) -> tuple[np.ndarray | None, float]:
+    # Returns the image decoded at the smallest DCT scale that still has max_pixels, and the factor
+    # that maps coordinates in that image back to the full resolution image
+    size: tuple[int, int] | None = get_image_size(data) if data is not None and is_jpeg(data) else None
+    if size is None:
+        return decode_image(data), 1.0
+    width, height = size
+    reduction: int = choose_reduction(width, height, max_pixels)
+    image = decode_image(data, reduction)
+    if image is None or reduction == 1:
+        return image, 1.0
+    # The EXIF orientation may have swapped the axes, the longest sides still correspond
+    return image, max(width, height) / max(image.shape[:2])
+# end decode_for_detection()
+
+def load_image(filepath: Path) -> np.ndarray | None:
+    # Returns None when the file cannot be read or is not a decodable image
+    return decode_image(read_image_bytes(filepath))
+# end load_image()
+
+def load_for_detection(filepath: Path, max_pixels: int, keep_data: bool) -> tuple[np.ndarray | None, float, bytes | None]:
+    # The image decoded for detection, its scale (see decode_for_detection) and, if keep_data, the file
+    # bytes so that the faces can be refined at full resolution without reading the file again
+    data = read_image_bytes(filepath)
+    image, scale = decode_for_detection(data, max_pixels)
+    if image is None or scale == 1.0 or not keep_data:
+        data = None
+    return image, scale, data
+# end load_for_detection()
+
+class ImagePrefetcher:
+    # USAGE: for (filepath, key), (image, scale, data) in ImagePrefetcher(items, max_pixels, keep_data, 2, 512 << 20):
+    #
+    #        Decodes the next images on num_threads background threads while the caller runs inference
+    #        on the current one; OpenCV releases the GIL while decoding. Items are (filepath, key) and
+    #        are yielded in order with the result of load_for_detection(). Images held ahead of the
+    #        caller are limited by max_bytes of decoded pixels (plus kept file bytes), not by count,
+    #        since decoded sizes vary by two orders of magnitude. The size of an image is only known once
+    #        it is decoded, so images still decoding are counted at the average size seen so far. At
+    #        least one image is always in flight, however large.
+
+    def __init__(self,
+                 items: Iterable[tuple[Path, Any]],
+                 max_pixels: int,
+                 keep_data: bool,
+                 num_threads: int,
+                 max_bytes: int) -> None:
+        self.items: Iterator[tuple[Path, Any]] = iter(items)
+        self.max_pixels: int = max_pixels
+        self.keep_data: bool = keep_data
+        self.num_threads: int = num_threads
+        self.max_bytes: int = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='prefetch')
+        self._in_flight: deque[tuple[tuple[Path, Any], Future]] = deque()
+        self._items_exhausted: bool = False
+        self._decoded_bytes: int = 0  # decoded and not yet consumed
+        self._decoded_count: int = 0
+        self._total_bytes: int = 0  # everything decoded so far, for the average size
+        self._total_count: int = 0
+        self._lock = threading.Lock()  # the counters are updated by the decoding threads
+        return
+    # end __init__()
+
+    def _nbytes(self, result: tuple[np.ndarray | None, float, bytes | None]) -> int:
+        image, _, data = result
+        return (0 if image is None else image.nbytes) + (0 if data is None else len(data))
+    # end _nbytes()
+
+    def _on_decoded(self, future: Future) -> None:
+        nbytes: int = 0 if future.cancelled() or future.exception() is not None else self._nbytes(future.result())
+        with self._lock:
+            self._decoded_bytes += nbytes
+            self._decoded_count += 1
+            self._total_bytes += nbytes
+            self._total_count += 1
+    # end _on_decoded()
+
+    def _is_full(self) -> bool:
+        with self._lock:
+            decoding_count: int = len(self._in_flight) - self._decoded_count
+            average: int = self._total_bytes // self._total_count if self._total_count > 0 else 0
+            buffered_bytes: int = self._decoded_bytes + decoding_count * average
+        return decoding_count >= self.num_threads or buffered_bytes >= self.max_bytes
+    # end _is_full()
+
+    def _fill(self) -> None:
+        while not self._items_exhausted:
+            if len(self._in_flight) > 0 and self._is_full():
+                return
+            try:
+                item: tuple[Path, Any] = next(self.items)
+            except StopIteration:
+                self._items_exhausted = True
+                return
+            future: Future = self._executor.submit(load_for_detection, item[0], self.max_pixels, self.keep_data)
+            future.add_done_callback(self._on_decoded)
+            self._in_flight.append((item, future))
+        return
+    # end _fill()
+
+    def __iter__(self) -> Iterator[tuple[tuple[Path, Any], tuple[np.ndarray | None, float, bytes | None]]]:
+        try:
+            self._fill()
+            while len(self._in_flight) > 0:
+                item, future = self._in_flight[0]
+                result = future.result()
+                with self._lock:
+                    self._in_flight.popleft()
+                    self._decoded_bytes -= self._nbytes(result)
+                    self._decoded_count -= 1
+                self._fill()
+                yield item, result
+        finally:
+            self.close()
+        return
+    # end __iter__()
+
+    def close(self) -> None:
+        for _, future in self._in_flight:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        return
+    # end close()
+# end class ImagePrefetcher
@@ -0,0 +1,168 @@
+from pathlib import Path
+from typing import Any, Iterator
+import tempfile
+import unittest
+import numpy as np
+import cv2
+from image_loader import get_image_size, choose_reduction, decode_for_detection, ImagePrefetcher
+
+class TestDecodeForDetection(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(5)
+        self.image: np.ndarray = rng.integers(0, 256, size=(600, 800, 3), dtype=np.uint8)
+        self.jpeg: bytes = cv2.imencode('.jpg', self.image)[1].tobytes()
+        self.png: bytes = cv2.imencode('.png', self.image)[1].tobytes()
+        return
+    # end setUp()
+
+    def test_get_image_size(self) -> None:
+        self.assertEqual(get_image_size(self.jpeg), (800, 600))
+        self.assertEqual(get_image_size(self.png), (800, 600))
+        self.assertIsNone(get_image_size(b'not an image'))
+        self.assertIsNone(get_image_size(self.jpeg[:20]))  # cut before the start of frame
+        return
+    # end test_get_image_size()
+
+    def test_choose_reduction(self) -> None:
+        self.assertEqual(choose_reduction(800, 600, 0), 1)
+        self.assertEqual(choose_reduction(800, 600, 800 * 600), 1)
+        self.assertEqual(choose_reduction(800, 600, 400 * 300), 2)
+        self.assertEqual(choose_reduction(800, 600, 200 * 150), 4)
+        self.assertEqual(choose_reduction(800, 600, 1), 8)
+        return
+    # end test_choose_reduction()
+
+    def test_scale(self) -> None:
+        for max_pixels, shape, scale in [(0, (600, 800), 1.0),
+                                         (800 * 600, (600, 800), 1.0),
+                                         (400 * 300, (300, 400), 2.0),
+                                         (200 * 150, (150, 200), 4.0),
+                                         (1, (75, 100), 8.0)]:
+            with self.subTest(max_pixels=max_pixels):
+                image, image_scale = decode_for_detection(self.jpeg, max_pixels)
+                self.assertEqual(image.shape[:2], shape)
+                self.assertEqual(image_scale, scale)
+        return
+    # end test_scale()
+
+    def test_not_reduced(self) -> None:
+        # Only JPEG files are decoded at a reduced size
+        image, scale = decode_for_detection(self.png, 1)
+        np.testing.assert_array_equal(image, self.image)
+        self.assertEqual(scale, 1.0)
+        self.assertEqual(decode_for_detection(b'not an image', 1), (None, 1.0))
+        self.assertEqual(decode_for_detection(None, 1), (None, 1.0))
+        return
+    # end test_not_reduced()
+
+    def test_rotated(self) -> None:
+        # An EXIF orientation of 90 degrees swaps the axes of the decoded image, the scale is still right
+        exif: bytes = (b'Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08\x00\x01'
+                       b'\x01\x12\x00\x03\x00\x00\x00\x01\x00\x06\x00\x00\x00\x00\x00\x00')
+        app1: bytes = b'\xff\xe1' + (len(exif) + 2).to_bytes(2, 'big') + exif
+        image, scale = decode_for_detection(self.jpeg[:2] + app1 + self.jpeg[2:], 200 * 150)
+        self.assertEqual(image.shape[:2], (200, 150))
+        self.assertEqual(scale, 4.0)
+        return
+    # end test_rotated()
+# end class TestDecodeForDetection
+
+class TestImagePrefetcher(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.image_dir = Path(self.temp_dir.name)
+        self.image_paths: list[Path] = []
+        for i in range(12):
+            image: np.ndarray = np.full((60, 80, 3), i * 20, dtype=np.uint8)
+            image_path: Path = self.image_dir / f'{i}.jpg'
+            cv2.imwrite(str(image_path), image)
+            self.image_paths.append(image_path)
+        self.image_nbytes: int = 60 * 80 * 3
+        self.taken: int = 0
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    def items(self) -> Iterator[tuple[Path, Any]]:
+        # Counts the items taken by the prefetcher
+        for i, image_path in enumerate(self.image_paths):
+            self.taken += 1
+            yield image_path, i
+        return
+    # end items()
+
+    def test_in_order(self) -> None:
+        self.image_paths.insert(5, self.image_dir / 'missing.jpg')
+        results: list = list(ImagePrefetcher(self.items(), 0, False, 4, 1 << 30))
+        self.assertEqual([item for item, _ in results], [(image_path, i) for i, image_path in enumerate(self.image_paths)])
+        for (image_path, _), (image, scale, data) in results:
+            if image_path.name == 'missing.jpg':
+                self.assertIsNone(image)
+            else:
+                self.assertEqual(image.shape, (60, 80, 3))
+                self.assertEqual(int(image[0, 0, 0]), int(image_path.stem) * 20)
+            self.assertEqual(scale, 1.0)
+            self.assertIsNone(data)
+        return
+    # end test_in_order()
+
+    def test_keep_data(self) -> None:
+        # The file bytes are only kept when the image was decoded at a reduced size
+        for (image_path, _), (image, scale, data) in ImagePrefetcher(self.items(), 1, True, 2, 1 << 30):
+            self.assertEqual(image.shape, (8, 10, 3))
+            self.assertEqual(scale, 8.0)
+            self.assertEqual(data, image_path.read_bytes())
+        for _, (image, scale, data) in ImagePrefetcher(self.items(), 0, True, 2, 1 << 30):
+            self.assertIsNone(data)
+        return
+    # end test_keep_data()
+
+    def test_byte_budget(self) -> None:
+        # With no budget left, a single image is in flight, whatever the number of threads
+        ahead: list[int] = []
+        for i, _ in enumerate(ImagePrefetcher(self.items(), 0, False, 1, 1)):
+            ahead.append(self.taken - (i + 1))
+        self.assertEqual(ahead, [1] * (len(self.image_paths) - 1) + [0])
+
+        # Once the average size is known, images ahead of the caller stay within the budget. The first
+        # images are taken before any is decoded, up to the number of threads.
+        self.taken = 0
+        ahead = []
+        for i, _ in enumerate(ImagePrefetcher(self.items(), 0, False, 4, 2 * self.image_nbytes)):
+            ahead.append(self.taken - (i + 1))
+        self.assertLessEqual(max(ahead), 4)
+        self.assertLessEqual(max(ahead[4:]), 2)
+        return
+    # end test_byte_budget()
+
+    def test_close(self) -> None:
+        # Leaving the loop early stops the decoding threads and takes no more items
+        prefetcher = ImagePrefetcher(self.items(), 0, False, 2, self.image_nbytes)
+        iterator = iter(prefetcher)
+        (image_path, _), (image, _, _) = next(iterator)
+        self.assertEqual(image_path, self.image_paths[0])
+        self.assertLessEqual(self.taken, 4)
+        iterator.close()
+        self.assertTrue(prefetcher._executor._shutdown)
+        taken: int = self.taken
+        for _, future in prefetcher._in_flight:
+            self.assertTrue(future.done())  # decoded or cancelled, none left running
+        self.assertEqual(self.taken, taken)
+
+        # Closed before iterating, nothing is decoded
+        self.taken = 0
+        prefetcher = ImagePrefetcher(self.items(), 0, False, 2, 1 << 30)
+        prefetcher.close()
+        self.assertEqual(self.taken, 0)
+        return
+    # end test_close()
+# end class TestImagePrefetcher
+
+if __name__ == '__main__':
+    unittest.main()
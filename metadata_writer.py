@@ -0,0 +1,160 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+from typing import Callable
+import copy
+import logging
+import os
+import queue
+import threading
+
+_STOP = object()  # tells the writer thread to exit
+
+def write_files_atomically(files: list[tuple[Path, str]]) -> None:
+    # Every file is written to a temporary file next to it and renamed over it once synced, so a crash
+    # leaves either the previous file or the new one, never a truncated one. The fsyncs of a group are
+    # issued together, then the renames, then one fsync per directory to make the renames durable.
+    # On an error the temporary files not renamed yet are removed.
+    temp_filepaths: list[Path] = []
+    renamed_count: int = 0
+    try:
+        for filepath, string in files:
+            filepath.parent.mkdir(parents=False, exist_ok=True)
+            temp_filepath: Path = filepath.with_name(filepath.name + '.tmp')
+            temp_filepaths.append(temp_filepath)
+            with temp_filepath.open('w') as temp_fp:
+                temp_fp.write(string)
+                temp_fp.flush()
+                os.fsync(temp_fp.fileno())
+        for (filepath, _), temp_filepath in zip(files, temp_filepaths):
+            os.replace(temp_filepath, filepath)
+            renamed_count += 1
+    except BaseException:
+        for temp_filepath in temp_filepaths[renamed_count:]:
+            temp_filepath.unlink(missing_ok=True)
+        raise
+    for dir_path in set(filepath.parent for filepath, _ in files):
+        dir_fd: int = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    return
+# end write_files_atomically()
+
+class MetadataWriter:
+    # USAGE: writer = MetadataWriter(lambda faces: json.dumps(faces), log)
+    #        writer.submit(metadata_filepath, faces, on_saved) for each image, writer.flush() to wait until
+    #        everything submitted is on disk and writer.close() at the end.
+    #
+    #        Writes the metadata files on a background thread, so that serializing and syncing them does not
+    #        hold up detection. submit() only blocks when queue_size files are already waiting. The thread
+    #        takes everything queued, up to group_size files, and writes it with write_files_atomically().
+    #        When a group fails, its files are written one by one, so one unwritable file does not fail
+    #        the others.
+    #        on_saved, if given, is called on the writer thread once the file is durable, so records that
+    #        must not get ahead of the metadata (the scan manifest) can be updated from it. It is not
+    #        called when the file could not be written.
+    #
+    #        The faces must not be modified after submit(). Until they are written, get() returns a copy.
+
+    def __init__(self,
+                 serialize: Callable[[list[dict]], str],
+                 log: logging.Logger,
+                 queue_size: int = 256,
+                 group_size: int = 64) -> None:
+        self.serialize: Callable[[list[dict]], str] = serialize
+        self.log: logging.Logger = log
+        self.group_size: int = group_size
+        self.error_count: int = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._pending: dict[Path, list[dict]] = {}  # submitted and not yet written, the latest faces per file
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='metadata_writer', daemon=True)
+        self._thread.start()
+        return
+    # end __init__()
+
+    def submit(self, metadata_filepath: Path, faces: list[dict], on_saved: Callable[[], None] | None = None) -> None:
+        with self._lock:
+            self._pending[metadata_filepath] = faces
+        self._queue.put((metadata_filepath, faces, on_saved))
+        return
+    # end submit()
+
+    def get(self, metadata_filepath: Path) -> list[dict] | None:
+        # The faces waiting to be written to metadata_filepath, None if there are none
+        with self._lock:
+            faces: list[dict] | None = self._pending.get(metadata_filepath)
+        return None if faces is None else copy.deepcopy(faces)
+    # end get()
+
+    def get_pending_names(self, metadata_dirpath: Path) -> set[str]:
+        # Names of the files of metadata_dirpath waiting to be written
+        with self._lock:
+            return set(filepath.name for filepath in self._pending if filepath.parent == metadata_dirpath)
+    # end get_pending_names()
+
+    def _run(self) -> None:
+        while True:
+            items: list = [self._queue.get()]
+            while len(items) < self.group_size and items[-1] is not _STOP:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            must_stop: bool = items[-1] is _STOP
+            if must_stop:
+                items.pop()
+            self._write(items)
+            for _ in range(len(items) + (1 if must_stop else 0)):
+                self._queue.task_done()
+            if must_stop:
+                return
+    # end _run()
+
+    def _write(self, items: list[tuple[Path, list[dict], Callable[[], None] | None]]) -> None:
+        # A file submitted several times in the group is only written with its latest faces
+        latest: dict[Path, list[dict]] = {}
+        for metadata_filepath, faces, _ in items:
+            latest[metadata_filepath] = faces
+        written: set[Path] = set()
+        try:
+            write_files_atomically([(metadata_filepath, self.serialize(faces)) for metadata_filepath, faces in latest.items()])
+            written.update(latest)
+        except Exception:
+            if len(latest) == 1:
+                self.log.exception(f'Failed to write metadata file {next(iter(latest)).as_posix()}.')
+            else:
+                for metadata_filepath, faces in latest.items():
+                    try:
+                        write_files_atomically([(metadata_filepath, self.serialize(faces))])
+                        written.add(metadata_filepath)
+                    except Exception:
+                        self.log.exception(f'Failed to write metadata file {metadata_filepath.as_posix()}.')
+        with self._lock:
+            self.error_count += len(latest) - len(written)
+            for metadata_filepath, faces in latest.items():
+                if self._pending.get(metadata_filepath) is faces:  # not submitted again since
+                    del self._pending[metadata_filepath]
+        for metadata_filepath, _, on_saved in items:
+            if on_saved is None or metadata_filepath not in written:
+                continue
+            try:
+                on_saved()
+            except Exception:
+                self.log.exception('Metadata writer callback failed.')
+        return
+    # end _write()
+
+    def flush(self) -> None:
+        # Barrier: returns once everything submitted before the call is on disk
+        self._queue.join()
+        return
+    # end flush()
+
+    def close(self) -> None:
+        self._queue.put(_STOP)
+        self._thread.join()
+        return
+    # end close()
+# end class MetadataWriter
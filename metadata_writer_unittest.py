@@ -0,0 +1,75 @@
+from pathlib import Path
+import json
+import logging
+import tempfile
+import threading
+import unittest
+from metadata_writer import MetadataWriter, write_files_atomically
+
+class TestMetadataWriter(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir_path = Path(self.temp_dir.name)
+        self.log = logging.getLogger('metadata_writer_unittest')
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    def test_write_files_atomically(self) -> None:
+        files = [(self.dir_path / 'a.json', '[1]'), (self.dir_path / 'b.json', '[2]')]
+        write_files_atomically(files)
+        self.assertEqual([filepath.read_text() for filepath, _ in files], ['[1]', '[2]'])
+        self.assertEqual(sorted(path.name for path in self.dir_path.iterdir()), ['a.json', 'b.json'])
+        return
+    # end test_write_files_atomically()
+
+    def test_write_files_atomically_removes_temp_files(self) -> None:
+        (self.dir_path / 'c.json').mkdir()  # cannot be replaced by a file
+        files = [(self.dir_path / 'a.json', '[1]'), (self.dir_path / 'c.json', '[3]')]
+        with self.assertRaises(OSError):
+            write_files_atomically(files)
+        self.assertEqual(sorted(path.name for path in self.dir_path.iterdir()), ['a.json', 'c.json'])
+        return
+    # end test_write_files_atomically_removes_temp_files()
+
+    def test_flush_and_close(self) -> None:
+        writer = MetadataWriter(json.dumps, self.log, queue_size=4, group_size=3)
+        saved: list[str] = []
+        for index in range(10):
+            filepath: Path = self.dir_path / f'{index}.json'
+            writer.submit(filepath, [{'index': index}], lambda filepath=filepath: saved.append(filepath.name))
+            self.assertEqual(writer.get(filepath) or json.loads(filepath.read_text()), [{'index': index}])
+        writer.flush()
+        self.assertEqual(saved, [f'{index}.json' for index in range(10)])  # in order, every file on disk
+        self.assertEqual(writer.get_pending_names(self.dir_path), set())
+        writer.submit(self.dir_path / '0.json', [{'index': 10}])
+        writer.close()  # writes what is still queued
+        self.assertEqual(json.loads((self.dir_path / '0.json').read_text()), [{'index': 10}])
+        return
+    # end test_flush_and_close()
+
+    def test_failed_file_does_not_fail_its_group(self) -> None:
+        writer = MetadataWriter(json.dumps, self.log, group_size=8)
+        (self.dir_path / 'bad.json').mkdir()
+        saved: list[str] = []
+        blocker = threading.Event()
+        writer.submit(self.dir_path / 'first.json', [], lambda: blocker.wait())  # the others queue up meanwhile
+        for name in ['a.json', 'bad.json', 'b.json']:
+            writer.submit(self.dir_path / name, [{'name': name}], lambda name=name: saved.append(name))
+        blocker.set()
+        writer.flush()
+        writer.close()
+        self.assertEqual(saved, ['a.json', 'b.json'])
+        self.assertEqual(writer.error_count, 1)
+        self.assertEqual(sorted(path.name for path in self.dir_path.iterdir()), ['a.json', 'b.json', 'bad.json', 'first.json'])
+        return
+    # end test_failed_file_does_not_fail_its_group()
+# end class TestMetadataWriter
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from typing import Any, Callable, Iterable
+import logging
+import queue
+import threading
+
+_END = object()  # end of stream marker passed between stages
+
+class PipelineStage:
+    # A pipeline stage runs process(item, emit) on its own group of threads. process may call
+    # emit(result) any number of times to hand results to the next stage. When the input queue
+    # stays empty for idle_timeout seconds on_idle(emit) is called, and once the upstream stages
+    # are done and every item of this stage has been processed on_close(emit) is called, so a
+    # stage can flush whatever it has buffered (e.g. an EmbeddingScheduler).
+
+    def __init__(self,
+                 name: str,
+                 process: Callable[[Any, Callable[[Any], None]], None],
+                 concurrency: int,
+                 queue_size: int,
+                 on_idle: Callable[[Callable[[Any], None]], None] | None,
+                 on_close: Callable[[Callable[[Any], None]], None] | None,
+                 idle_timeout: float,
+                 log: logging.Logger) -> None:
+        assert concurrency > 0, f'Stage {name} must have at least one thread'
+        assert queue_size > 0, f'Stage {name} must have a bounded queue of at least one item'
+        self.name: str = name
+        self.process: Callable[[Any, Callable[[Any], None]], None] = process
+        self.concurrency: int = concurrency
+        self.on_idle = on_idle
+        self.on_close = on_close
+        self.idle_timeout: float = idle_timeout
+        self.log: logging.Logger = log
+        self.input_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.next_stage: PipelineStage | None = None
+        self.processed_count: int = 0
+        self.error_count: int = 0
+        self._threads: list[threading.Thread] = []
+        self._running: int = 0
+        self._lock = threading.Lock()
+        return
+    # end __init__()
+
+    def emit(self, item: Any) -> None:
+        if self.next_stage is not None:
+            self.next_stage.input_queue.put(item)
+        return
+    # end emit()
+
+    def start(self) -> None:
+        self._running = self.concurrency
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._run, name=f'{self.name}_{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return
+    # end start()
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        return
+    # end join()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                item = self.input_queue.get(timeout=self.idle_timeout if self.on_idle is not None else None)
+            except queue.Empty:
+                self._call(self.on_idle, 'on_idle')
+                continue
+            if item is _END:
+                break
+            try:
+                self.process(item, self.emit)
+            except Exception:
+                with self._lock:
+                    self.error_count += 1
+                self.log.exception(f'Pipeline stage {self.name} failed to process an item.')
+            with self._lock:
+                self.processed_count += 1
+
+        with self._lock:
+            self._running -= 1
+            is_last_thread = self._running == 0
+        if is_last_thread:
+            self._call(self.on_close, 'on_close')
+            if self.next_stage is not None:
+                for _ in range(self.next_stage.concurrency):
+                    self.next_stage.input_queue.put(_END)
+        return
+    # end _run()
+
+    def _call(self, callback: Callable[[Callable[[Any], None]], None] | None, callback_name: str) -> None:
+        if callback is None:
+            return
+        try:
+            callback(self.emit)
+        except Exception:
+            with self._lock:
+                self.error_count += 1
+            self.log.exception(f'Pipeline stage {self.name} failed in {callback_name}.')
+        return
+    # end _call()
+# end class PipelineStage
+
+class Pipeline:
+    # USAGE: pipeline = Pipeline(queue_size=8)
+    #        pipeline.add_stage('decode', decode_fn, concurrency=4)
+    #        pipeline.add_stage('detect', detect_fn)
+    #        pipeline.run(source_iterable)
+    #
+    #        Stages are connected by bounded queues, so a slow stage blocks the stages upstream of it
+    #        and the number of items in flight (e.g. decoded images) never exceeds the queue sizes plus
+    #        the number of threads. The source iterable is consumed in the calling thread, so traversal
+    #        overlaps with every other stage. run() returns once every stage has drained.
+
+    def __init__(self, queue_size: int = 8, log: logging.Logger | None = None) -> None:
+        self.queue_size: int = queue_size
+        self.log: logging.Logger = logging.getLogger('pipeline') if log is None else log
+        self.stages: list[PipelineStage] = []
+        return
+    # end __init__()
+
+    def add_stage(self,
+                  name: str,
+                  process: Callable[[Any, Callable[[Any], None]], None],
+                  concurrency: int = 1,
+                  queue_size: int | None = None,
+                  on_idle: Callable[[Callable[[Any], None]], None] | None = None,
+                  on_close: Callable[[Callable[[Any], None]], None] | None = None,
+                  idle_timeout: float = 1.0) -> PipelineStage:
+        stage = PipelineStage(name,
+                              process,
+                              concurrency,
+                              self.queue_size if queue_size is None else queue_size,
+                              on_idle,
+                              on_close,
+                              idle_timeout,
+                              self.log)
+        if len(self.stages) > 0:
+            self.stages[-1].next_stage = stage
+        self.stages.append(stage)
+        return stage
+    # end add_stage()
+
+    def run(self, source: Iterable[Any]) -> None:
+        assert len(self.stages) > 0, 'Pipeline has no stages'
+        for stage in self.stages:
+            stage.start()
+
+        first_stage: PipelineStage = self.stages[0]
+        try:
+            for item in source:
+                first_stage.input_queue.put(item)
+        finally:
+            for _ in range(first_stage.concurrency):
+                first_stage.input_queue.put(_END)
+            for stage in self.stages:
+                stage.join()
+
+        for stage in self.stages:
+            self.log.info(f'Pipeline stage {stage.name}: {stage.processed_count} item(s) processed, {stage.error_count} error(s).')
+        return
+    # end run()
+# end class Pipeline
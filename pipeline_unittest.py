@@ -0,0 +1,203 @@
+from typing import Any, Callable, Iterable
+import logging
+import threading
+import time
+import unittest
+from pipeline import Pipeline
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.log = logging.getLogger('pipeline_unittest')
+        return
+    # end setUp()
+
+    def run_pipeline(self, pipeline: Pipeline, source: Iterable[Any]) -> None:
+        # Runs the pipeline in another thread, so a pipeline that never drains fails the test instead of hanging it
+        errors: list[Exception] = []
+        def run() -> None:
+            try:
+                pipeline.run(source)
+            except Exception as e:
+                errors.append(e)
+            return
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=10.0)
+        self.assertFalse(thread.is_alive(), 'The pipeline did not drain')
+        if len(errors) > 0:
+            raise errors[0]
+        return
+    # end run_pipeline()
+
+    @staticmethod
+    def collect(results: list[Any], lock: threading.Lock) -> Callable[[Any, Callable[[Any], None]], None]:
+        def process(item: Any, emit: Callable[[Any], None]) -> None:
+            with lock:
+                results.append(item)
+            return
+        return process
+    # end collect()
+
+    def test_order_and_concurrency(self) -> None:
+        results: list[int] = []
+        lock = threading.Lock()
+        def square(item: int, emit: Callable[[Any], None]) -> None:
+            time.sleep(0.001 * (item % 3))  # finish out of order
+            emit(item * item)
+            return
+        def split(item: int, emit: Callable[[Any], None]) -> None:
+            emit(item)
+            emit(-item)
+            return
+
+        # A single thread per stage keeps the order of the source
+        pipeline = Pipeline(queue_size=2, log=self.log)
+        pipeline.add_stage('square', square)
+        pipeline.add_stage('split', split)
+        pipeline.add_stage('collect', self.collect(results, lock))
+        self.run_pipeline(pipeline, range(50))
+        self.assertEqual(results, [value for item in range(50) for value in (item * item, -item * item)])
+
+        # Several threads lose the order but neither lose nor duplicate items
+        results.clear()
+        pipeline = Pipeline(queue_size=2, log=self.log)
+        pipeline.add_stage('square', square, concurrency=4)
+        pipeline.add_stage('split', split, concurrency=3, queue_size=1)
+        pipeline.add_stage('collect', self.collect(results, lock), concurrency=2)
+        self.run_pipeline(pipeline, range(200))
+        self.assertEqual(sorted(results), sorted(value for item in range(200) for value in (item * item, -item * item)))
+        self.assertEqual([stage.processed_count for stage in pipeline.stages], [200, 200, 400])
+        return
+    # end test_order_and_concurrency()
+
+    def test_in_flight_bounded(self) -> None:
+        # A slow last stage blocks the stages upstream, so the items in flight never exceed the queue
+        # sizes plus the number of threads
+        in_flight: list[int] = [0]
+        max_in_flight: list[int] = [0]
+        lock = threading.Lock()
+        def produce(item: int, emit: Callable[[Any], None]) -> None:
+            with lock:
+                in_flight[0] += 1
+                max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            emit(item)
+            return
+        def consume(item: int, emit: Callable[[Any], None]) -> None:
+            time.sleep(0.002)
+            with lock:
+                in_flight[0] -= 1
+            return
+
+        pipeline = Pipeline(queue_size=3, log=self.log)
+        pipeline.add_stage('produce', produce, concurrency=2)
+        pipeline.add_stage('consume', consume)
+        self.run_pipeline(pipeline, range(60))
+        self.assertEqual(in_flight[0], 0)
+        self.assertLessEqual(max_in_flight[0], 3 + 2 + 1)  # the consume queue, the producing threads and consume
+        return
+    # end test_in_flight_bounded()
+
+    def test_on_idle_and_on_close(self) -> None:
+        # A batching stage emits its batch when idle and flushes the rest when closed, once, after its last item
+        results: list[Any] = []
+        lock = threading.Lock()
+        batch: list[int] = []
+        calls: list[str] = []
+        def add(item: int, emit: Callable[[Any], None]) -> None:
+            batch.append(item)
+            return
+        def flush(emit: Callable[[Any], None]) -> None:
+            if len(batch) > 0:
+                emit(list(batch))
+                batch.clear()
+            return
+        def on_idle(emit: Callable[[Any], None]) -> None:
+            calls.append('idle')
+            flush(emit)
+            return
+        def on_close(emit: Callable[[Any], None]) -> None:
+            calls.append('close')
+            flush(emit)
+            return
+        def source() -> Iterable[int]:
+            yield from range(3)
+            time.sleep(0.2)  # long enough for the stage to go idle
+            yield from range(3, 5)
+            return
+
+        pipeline = Pipeline(log=self.log)
+        pipeline.add_stage('batch', add, on_idle=on_idle, on_close=on_close, idle_timeout=0.05)
+        pipeline.add_stage('collect', self.collect(results, lock))
+        self.run_pipeline(pipeline, source())
+        self.assertEqual(results, [[0, 1, 2], [3, 4]])
+        self.assertIn('idle', calls)
+        self.assertEqual(calls[-1], 'close')
+        self.assertEqual(calls.count('close'), 1)
+        return
+    # end test_on_idle_and_on_close()
+
+    def test_on_close_with_several_threads(self) -> None:
+        # on_close runs once, after every thread of the stage is done
+        processed: list[int] = []
+        lock = threading.Lock()
+        closed_after: list[int] = []
+        def process(item: int, emit: Callable[[Any], None]) -> None:
+            time.sleep(0.001)
+            with lock:
+                processed.append(item)
+            return
+        def on_close(emit: Callable[[Any], None]) -> None:
+            closed_after.append(len(processed))
+            return
+
+        pipeline = Pipeline(queue_size=2, log=self.log)
+        pipeline.add_stage('process', process, concurrency=4, on_close=on_close)
+        self.run_pipeline(pipeline, range(40))
+        self.assertEqual(closed_after, [40])
+        return
+    # end test_on_close_with_several_threads()
+
+    def test_stage_exception(self) -> None:
+        # An item that fails is counted and logged, the other items still flow through the bounded queues
+        results: list[int] = []
+        lock = threading.Lock()
+        def fail_on_multiples_of_7(item: int, emit: Callable[[Any], None]) -> None:
+            if item % 7 == 0:
+                raise ValueError(f'bad item {item}')
+            emit(item)
+            return
+        def fail_on_close(emit: Callable[[Any], None]) -> None:
+            raise RuntimeError('failed to flush')
+
+        pipeline = Pipeline(queue_size=1, log=self.log)
+        pipeline.add_stage('check', fail_on_multiples_of_7, concurrency=2, on_close=fail_on_close)
+        pipeline.add_stage('collect', self.collect(results, lock))
+        with self.assertLogs(self.log, 'ERROR'):
+            self.run_pipeline(pipeline, range(50))
+        self.assertEqual(sorted(results), [item for item in range(50) if item % 7 != 0])
+        self.assertEqual(pipeline.stages[0].error_count, 8 + 1)  # 0, 7, ..., 49 and on_close
+        self.assertEqual(pipeline.stages[0].processed_count, 50)
+        return
+    # end test_stage_exception()
+
+    def test_source_exception(self) -> None:
+        # A source that fails still ends every stage, and the exception reaches the caller of run()
+        results: list[int] = []
+        lock = threading.Lock()
+        def source() -> Iterable[int]:
+            yield from range(10)
+            raise OSError('traversal failed')
+
+        pipeline = Pipeline(queue_size=1, log=self.log)
+        pipeline.add_stage('forward', lambda item, emit: emit(item), concurrency=3)
+        pipeline.add_stage('collect', self.collect(results, lock))
+        with self.assertRaises(OSError):
+            self.run_pipeline(pipeline, source())
+        self.assertEqual(sorted(results), list(range(10)))
+        return
+    # end test_source_exception()
+# end class TestPipeline
+
+if __name__ == '__main__':
+    unittest.main()
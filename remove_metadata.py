@@ -6,9 +6,10 @@ def is_hidden(path: Path) -> bool:
     return path.name.startswith('.')
 # end is_hidden()
 
-def remove_metadata(root_dir: Path, dirnames_to_delete: list[str] = ['.faces']) -> None:
+def remove_metadata(root_dir: Path, dirnames_to_delete: list[str] = ['.faces'], num_threads: int = 1) -> None:
 
-    dir_traverser = DirTraverser(root_dir, ignore_hidden=False)
+    # With num_threads > 1 sibling directories are listed concurrently, useful on network storage
+    dir_traverser = DirTraverser(root_dir, ignore_hidden=False, num_threads=num_threads, ordered=False)
     for dir_path in dir_traverser:
         if dir_path.name in dirnames_to_delete:
             if is_hidden(dir_path):
@@ -0,0 +1,188 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+from traverser import FileInfo
+
+class ScanManifest:
+    # Persistent record of the image tree as of the last run: the modification time and the
+    # subdirectories of every directory, and the size and modification time of every image.
+    #
+    # It is used as the listing_cache of a DirBatchTraverser: a directory whose mtime has not changed
+    # since the last run has the same entries, so it is neither listed nor yielded and its recorded
+    # subdirectories are traversed directly. Within a changed directory, needs_processing() tells which
+    # images were added or modified.
+    #
+    # A directory is only committed to the manifest once every image that needed processing in it has
+    # been handed to image_done(), so a crash never marks unprocessed images as done. The mtime recorded
+    # is the one read before the directory was listed, so anything changing during the run is picked up
+    # by the next run. save() writes the manifest atomically (temporary file, fsync, rename).
+    #
+    # Adding, removing, renaming or atomically replacing an image changes the mtime of its directory.
+    # An image rewritten in place does not, so it is only picked up once its directory changes.
+
+    VERSION: int = 1
+
+    def __init__(self,
+                 root_dir: Path,
+                 manifest_filepath: Path,
+                 log: logging.Logger,
+                 save_interval: float = 300.0) -> None:
+        self.root_dir: Path = root_dir
+        self.manifest_filepath: Path = manifest_filepath
+        self.log: logging.Logger = log
+        self.save_interval: float = save_interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirs: dict[str, dict] = {}  # relative dir path -> {'mtime_ns', 'subdirs', 'images': {name: [size, mtime_ns]}}
+        self._listed: dict[str, tuple[int, list[str]]] = {}  # dirs listed in this run -> (mtime_ns, subdirs)
+        self._pending: dict[str, tuple[dict, set[str]]] = {}  # dirs with images in flight -> (entry, image names)
+        self._seen: set[str] = set()  # dirs reached in this run, listed or not
+        self._last_save_time: float = time.time()
+        self.load()
+        return
+    # end __init__()
+
+    def _relative(self, dir_path: Path) -> str:
+        return dir_path.relative_to(self.root_dir).as_posix()
+    # end _relative()
+
+    def load(self) -> None:
+        if not self.manifest_filepath.exists():
+            self.log.info(f'No scan manifest found at {self.manifest_filepath.as_posix()}, scanning the whole tree.')
+            return
+        try:
+            with gzip.open(self.manifest_filepath, 'rt') as manifest_fp:
+                manifest: dict = json.load(manifest_fp)
+        except (OSError, EOFError, json.JSONDecodeError):
+            self.log.warning(f'Unreadable scan manifest {self.manifest_filepath.as_posix()}, scanning the whole tree.')
+            return
+        if manifest.get('version') == self.VERSION:
+            self._dirs = manifest['dirs']
+        return
+    # end load()
+
+    def save(self) -> None:
+        with self._save_lock:
+            with self._lock:
+                manifest_string: str = json.dumps({'version': self.VERSION, 'dirs': self._dirs}, separators=(',', ':'))
+                self._last_save_time = time.time()
+            self.manifest_filepath.parent.mkdir(parents=True, exist_ok=True)
+            temp_filepath: Path = self.manifest_filepath.with_name(self.manifest_filepath.name + '.tmp')
+            with temp_filepath.open('wb') as raw_fp:
+                with gzip.GzipFile(fileobj=raw_fp, mode='wb', compresslevel=1) as manifest_fp:
+                    manifest_fp.write(manifest_string.encode('utf-8'))
+                raw_fp.flush()
+                os.fsync(raw_fp.fileno())
+            os.replace(temp_filepath, self.manifest_filepath)
+        return
+    # end save()
+
+    def close(self, traversal_completed: bool = True) -> None:
+        # Drops the directories that no longer exist, which is only known after a complete traversal
+        if traversal_completed:
+            with self._lock:
+                self._dirs = {relative_dir: entry for relative_dir, entry in self._dirs.items() if relative_dir in self._seen}
+        self.save()
+        return
+    # end close()
+
+    def get_subdirs(self, dir_path: Path) -> list[str] | None:
+        # Listing cache protocol of DirBatchTraverser, called before dir_path is listed
+        try:
+            mtime_ns: int = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        relative_dir: str = self._relative(dir_path)
+        with self._lock:
+            self._seen.add(relative_dir)
+            entry: dict | None = self._dirs.get(relative_dir)
+            if entry is not None and entry['mtime_ns'] == mtime_ns:
+                return entry['subdirs']
+            self._listed[relative_dir] = (mtime_ns, [])
+        return None
+    # end get_subdirs()
+
+    def put_subdirs(self, dir_path: Path, subdir_names: list[str]) -> None:
+        # Listing cache protocol of DirBatchTraverser, called after dir_path is listed
+        relative_dir: str = self._relative(dir_path)
+        with self._lock:
+            mtime_ns, _ = self._listed.get(relative_dir, (-1, []))
+            self._listed[relative_dir] = (mtime_ns, subdir_names)
+        return
+    # end put_subdirs()
+
+    def needs_processing(self, dir_path: Path, image_file: FileInfo, has_metadata: bool) -> bool:
+        with self._lock:
+            entry: dict | None = self._dirs.get(self._relative(dir_path))
+            recorded: list[int] | None = None if entry is None else entry['images'].get(image_file.path.name)
+        if recorded is None:
+            return not has_metadata  # images processed before the manifest existed are kept
+        return recorded != [image_file.size, image_file.mtime_ns]
+    # end needs_processing()
+
+    def begin_dir(self, dir_path: Path, image_files: list[FileInfo], images_to_process: list[Path]) -> None:
+        # Called once the images of dir_path that need processing are known
+        relative_dir: str = self._relative(dir_path)
+        with self._lock:
+            mtime_ns, subdirs = self._listed.pop(relative_dir, (-1, []))
+            entry: dict = {'mtime_ns': mtime_ns,
+                           'subdirs': subdirs,
+                           'images': {image_file.path.name: [image_file.size, image_file.mtime_ns] for image_file in image_files}}
+            pending_names: set[str] = set(image_path.name for image_path in images_to_process)
+            if len(pending_names) == 0:
+                self._dirs[relative_dir] = entry
+            else:
+                self._pending[relative_dir] = (entry, pending_names)
+        self._save_if_due()
+        return
+    # end begin_dir()
+
+    def begin_watched_images(self, dir_path: Path, ready_paths: list[Path], image_files: list[FileInfo]) -> None:
+        # For the watch mode, which learns of changed images of dir_path without listing it. ready_paths
+        # are the changed images, image_files those of them that still exist and are about to be
+        # processed. Only they are recorded, next to the images already recorded as done: other images of
+        # the directory may still be changing, so they are left to the next traversal, which lists the
+        # directory again since it gets no mtime here.
+        relative_dir: str = self._relative(dir_path)
+        with self._lock:
+            recorded: dict | None = self._dirs.get(relative_dir)
+            images: dict[str, list[int]] = {} if recorded is None else dict(recorded['images'])
+            for image_path in ready_paths:
+                images.pop(image_path.name, None)
+            images.update({image_file.path.name: [image_file.size, image_file.mtime_ns] for image_file in image_files})
+            entry: dict = {'mtime_ns': -1, 'subdirs': [] if recorded is None else recorded['subdirs'], 'images': images}
+            pending_names: set[str] = set(image_file.path.name for image_file in image_files)
+            if len(pending_names) == 0:
+                self._dirs[relative_dir] = entry
+            else:
+                self._pending[relative_dir] = (entry, pending_names)
+        self._save_if_due()
+        return
+    # end begin_watched_images()
+
+    def image_done(self, image_path: Path) -> None:
+        relative_dir: str = self._relative(image_path.parent)
+        with self._lock:
+            if relative_dir not in self._pending:
+                return
+            entry, pending_names = self._pending[relative_dir]
+            pending_names.discard(image_path.name)
+            if len(pending_names) == 0:
+                self._dirs[relative_dir] = entry
+                del self._pending[relative_dir]
+        self._save_if_due()
+        return
+    # end image_done()
+
+    def _save_if_due(self) -> None:
+        if time.time() - self._last_save_time >= self.save_interval:
+            self.save()
+        return
+    # end _save_if_due()
+# end class ScanManifest
@@ -0,0 +1,162 @@
+from pathlib import Path
+import logging
+import os
+import tempfile
+import unittest
+from traverser import DirBatchTraverser, FileInfo
+from scan_manifest import ScanManifest
+
+class TestScanManifest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root_dir = Path(self.temp_dir.name) / 'images'
+        (self.root_dir / 'sub').mkdir(parents=True)
+        for image_path in [self.root_dir / 'a.jpg', self.root_dir / 'sub' / 'b.jpg', self.root_dir / 'sub' / 'c.jpg']:
+            image_path.write_bytes(b'image')
+        self.manifest_filepath = Path(self.temp_dir.name) / 'manifest.json.gz'
+        self.log = logging.getLogger('scan_manifest_unittest')
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    def open_manifest(self) -> ScanManifest:
+        return ScanManifest(self.root_dir, self.manifest_filepath, self.log)
+    # end open_manifest()
+
+    def traverse(self, manifest: ScanManifest, has_metadata: bool = False) -> dict[Path, list[Path]]:
+        # A run of detect_faces_loop without detection: the images that need processing by directory,
+        # every one of them done at once. Directories not listed are not in the result.
+        to_process: dict[Path, list[Path]] = {}
+        for dir_path, image_files in DirBatchTraverser(self.root_dir, match_files=['*.jpg'], listing_cache=manifest):
+            images: list[Path] = [image_file.path for image_file in image_files
+                                  if manifest.needs_processing(dir_path, image_file, has_metadata)]
+            manifest.begin_dir(dir_path, image_files, images)
+            to_process[dir_path] = images
+            for image_path in images:
+                manifest.image_done(image_path)
+        manifest.close()
+        return to_process
+    # end traverse()
+
+    @staticmethod
+    def file_info(image_path: Path) -> FileInfo:
+        stat_result = image_path.stat()
+        return FileInfo(image_path, stat_result.st_size, stat_result.st_mtime_ns)
+    # end file_info()
+
+    @staticmethod
+    def touch(path: Path, seconds: int) -> None:
+        # Moves the modification time, so a change is seen whatever the resolution of the file system
+        stat_result = path.stat()
+        os.utime(path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + seconds * 1_000_000_000))
+        return
+    # end touch()
+
+    def test_first_and_unchanged_runs(self) -> None:
+        to_process: dict[Path, list[Path]] = self.traverse(self.open_manifest())
+        self.assertEqual(to_process[self.root_dir], [self.root_dir / 'a.jpg'])
+        self.assertEqual(sorted(to_process[self.root_dir / 'sub']), [self.root_dir / 'sub' / 'b.jpg', self.root_dir / 'sub' / 'c.jpg'])
+        self.assertTrue(self.manifest_filepath.exists())
+
+        # Unchanged directories are neither listed nor yielded, their recorded subdirectories are traversed
+        manifest: ScanManifest = self.open_manifest()
+        self.assertEqual(manifest.get_subdirs(self.root_dir), ['sub'])
+        self.assertEqual(self.traverse(self.open_manifest()), {})
+        return
+    # end test_first_and_unchanged_runs()
+
+    def test_changed_directory(self) -> None:
+        sub_dir: Path = self.root_dir / 'sub'
+        self.traverse(self.open_manifest())
+        (sub_dir / 'b.jpg').write_bytes(b'modified image')
+        self.touch(sub_dir / 'b.jpg', 10)
+        (sub_dir / 'd.jpg').write_bytes(b'new image')
+        self.touch(sub_dir, 10)  # the directory mtime changes anyway, made certain here
+        (sub_dir / 'deeper').mkdir()
+        (sub_dir / 'deeper' / 'e.jpg').write_bytes(b'image')
+        self.touch(sub_dir, 20)
+
+        to_process: dict[Path, list[Path]] = self.traverse(self.open_manifest())
+        self.assertEqual(sorted(to_process[sub_dir]), [sub_dir / 'b.jpg', sub_dir / 'd.jpg'])
+        self.assertEqual(to_process[sub_dir / 'deeper'], [sub_dir / 'deeper' / 'e.jpg'])
+        self.assertNotIn(self.root_dir, to_process)
+        self.assertEqual(self.traverse(self.open_manifest()), {})
+        return
+    # end test_changed_directory()
+
+    def test_images_with_metadata_before_the_manifest(self) -> None:
+        # Images processed before the manifest existed have metadata and are kept
+        to_process: dict[Path, list[Path]] = self.traverse(self.open_manifest(), has_metadata=True)
+        self.assertEqual(sum(len(images) for images in to_process.values()), 0)
+        return
+    # end test_images_with_metadata_before_the_manifest()
+
+    def test_directory_committed_once_done(self) -> None:
+        # A crash before every image of a directory is done leaves the directory out of the manifest
+        manifest: ScanManifest = self.open_manifest()
+        sub_dir: Path = self.root_dir / 'sub'
+        for dir_path, image_files in DirBatchTraverser(self.root_dir, match_files=['*.jpg'], listing_cache=manifest):
+            manifest.begin_dir(dir_path, image_files, [image_file.path for image_file in image_files])
+        manifest.image_done(self.root_dir / 'a.jpg')
+        manifest.image_done(sub_dir / 'b.jpg')
+        manifest.save()  # as a periodic save before the crash, c.jpg is not done
+
+        to_process: dict[Path, list[Path]] = self.traverse(self.open_manifest())
+        self.assertNotIn(self.root_dir, to_process)
+        self.assertEqual(sorted(to_process[sub_dir]), [sub_dir / 'b.jpg', sub_dir / 'c.jpg'])
+        return
+    # end test_directory_committed_once_done()
+
+    def test_unreadable_manifest(self) -> None:
+        self.traverse(self.open_manifest())
+        self.manifest_filepath.write_bytes(self.manifest_filepath.read_bytes()[:20])  # cut short
+        with self.assertLogs(self.log, 'WARNING'):
+            manifest: ScanManifest = self.open_manifest()
+        to_process: dict[Path, list[Path]] = self.traverse(manifest)
+        self.assertEqual(sum(len(images) for images in to_process.values()), 3)  # the whole tree again
+        self.assertEqual(self.traverse(self.open_manifest()), {})
+        return
+    # end test_unreadable_manifest()
+
+    def test_removed_directory(self) -> None:
+        self.traverse(self.open_manifest())
+        (self.root_dir / 'sub' / 'b.jpg').unlink()
+        (self.root_dir / 'sub' / 'c.jpg').unlink()
+        (self.root_dir / 'sub').rmdir()
+        self.traverse(self.open_manifest())
+        manifest: ScanManifest = self.open_manifest()
+        self.assertNotIn('sub', manifest._dirs)
+        self.assertIn('.', manifest._dirs)
+        return
+    # end test_removed_directory()
+
+    def test_watched_images(self) -> None:
+        sub_dir: Path = self.root_dir / 'sub'
+        self.traverse(self.open_manifest())
+
+        # b.jpg is ready and processed, d.jpg and e.jpg are still in the debouncer when the daemon stops
+        (sub_dir / 'b.jpg').write_bytes(b'modified image')
+        (sub_dir / 'd.jpg').write_bytes(b'new image')
+        (sub_dir / 'e.jpg').write_bytes(b'still copying')
+        manifest: ScanManifest = self.open_manifest()
+        manifest.begin_watched_images(sub_dir, [sub_dir / 'b.jpg', sub_dir / 'd.jpg'], [self.file_info(sub_dir / 'b.jpg')])
+        manifest.image_done(sub_dir / 'b.jpg')
+        (sub_dir / 'c.jpg').unlink()
+        manifest.begin_watched_images(sub_dir, [sub_dir / 'c.jpg'], [])  # deleted
+        manifest.close(traversal_completed=False)
+
+        to_process: dict[Path, list[Path]] = self.traverse(self.open_manifest())
+        self.assertEqual(sorted(to_process[sub_dir]), [sub_dir / 'd.jpg', sub_dir / 'e.jpg'])
+        self.assertNotIn(self.root_dir, to_process)  # unchanged, not even listed
+        self.assertEqual(self.traverse(self.open_manifest()), {})
+        return
+    # end test_watched_images()
+# end class TestScanManifest
+
+if __name__ == '__main__':
+    unittest.main()
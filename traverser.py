@@ -1,6 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import Pattern, Iterator, Generator
+from typing import Pattern, Iterator, Generator, Callable, NamedTuple
 from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import queue
 import copy
 import re
 import fnmatch
@@ -328,6 +332,19 @@ class Traverser:
     #       
     #        match['dirs'] and match_files are each a list of single glob expressions such as ['*.jpg', '*.jpeg'].
     #        Files or directories that match any of glob patterns in the list will be matched
+    #
+    #        Each directory is listed only once with os.scandir, which gets the entry types from the
+    #        directory listing itself instead of calling stat on every entry. The files of a directory
+    #        are collected during that same listing when the instance is a file iterator.
+    #
+    #        The tree is traversed breadth first by default. depth_first=True traverses it depth first,
+    #        which keeps the queue of pending directories small on deep trees.
+    #
+    #        num_threads > 1 lists pending directories concurrently on a thread pool, which hides the
+    #        listing latency of network filesystems. Each directory is submitted for listing as soon as
+    #        its parent has been listed. With ordered=True the directories are emitted in the same order
+    #        as with a single thread, otherwise they are emitted as soon as their listing completes.
+    #        Call close() to release the threads if the traversal is abandoned before the end.
 
     def __init__(self,
                  root_dir: Path,
@@ -337,7 +354,11 @@ class Traverser:
                  ignore_list: dict[str, list[str]] = {'dirs': ['.DS_Store', '.Trash'], 'files': ['.DS_Store']},
                  is_dir_iterator: bool = True,
                  is_file_iterator: bool = True,
+                 depth_first: bool = False,
+                 num_threads: int = 1,
+                 ordered: bool = True
                  ) -> None:
+        assert num_threads > 0, 'num_threads must be a positive integer'
         self.__saved_root_dir: Path = root_dir
         self.__saved_match_dirs: list[str] = match_dirs
         self.__saved_match_files: list[str] = match_files
@@ -345,6 +366,10 @@ class Traverser:
         self.__saved_ignore_list: dict[str, list[str]] = ignore_list
         self.__saved_is_dir_iterator: bool = is_dir_iterator
         self.__saved_is_file_iterator: bool = is_file_iterator
+        self.__saved_depth_first: bool = depth_first
+        self.__saved_num_threads: int = num_threads
+        self.__saved_ordered: bool = ordered
+        self._executor: ThreadPoolExecutor | None = None
         # self._is_iterator: dict[str, bool] = {'dirs': is_dir_iterator, 'files': is_file_iterator}
         # self.__saved_is_iterator: dict[str, bool] = self._is_iterator
 
@@ -355,9 +380,18 @@ class Traverser:
         self._is_dir_iterator: bool = self.__saved_is_dir_iterator
         self._is_file_iterator: bool = self.__saved_is_file_iterator
         # self._is_iterator: dict[str,bool] = self.__saved_is_iterator
-        self._directories: list[Path] = [self.__saved_root_dir]
+        self._depth_first: bool = self.__saved_depth_first
+        self._ordered: bool = self.__saved_ordered
+        self.close()
+        if self.__saved_num_threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.__saved_num_threads,
+                                                thread_name_prefix='traverser')
+        self._directories: deque = deque()  # paths, or (path, listing future) tuples when ordered and parallel
+        self._completed_scans: queue.SimpleQueue = queue.SimpleQueue()  # (path, listing future) when unordered
+        self._outstanding_scans: int = 0
         self._current_dir: Path = Path()
-        self._files_in_current_dir: list[Path] = []
+        self._files_in_current_dir: deque[Path] = deque()
+        self._entries_in_current_dir: list[os.DirEntry] = []
         self._files_indicator:bool = False
         self._ignore_dirs: list[str] = self.__saved_ignore_list['dirs']
         self._ignore_files: list[str] = self.__saved_ignore_list['files']
@@ -370,6 +404,9 @@ class Traverser:
         self._match_dirs: Pattern[str] = match_dir_pattern
         self._match_files: Pattern[str] = match_file_pattern
 
+        if self._is_wanted_dir(self.__saved_root_dir.name):
+            self._push_dirs([self.__saved_root_dir])
+
         if self._is_file_iterator and not self._is_dir_iterator:
             self._get_next_dir() # Initialize file iterator
     # end reset()
@@ -384,43 +421,121 @@ class Traverser:
         return regex
     # end __make_pattern()
 
+    def _is_wanted_dir(self, dir_name: str) -> bool:
+        if dir_name in self._ignore_dirs or (self._ignore_hidden_dirs and dir_name.startswith('.')):
+            return False
+        return self._match_dirs.match(string=dir_name) is not None
+    # end _is_wanted_dir()
+
+    def _is_wanted_file(self, file_name: str) -> bool:
+        if file_name in self._ignore_files or (self._ignore_hidden_files and file_name.startswith('.')):
+            return False
+        return self._match_files.match(string=file_name) is not None
+    # end _is_wanted_file()
+
+    def _keep_subdir(self, dir_path: Path) -> bool:
+        # Subclasses override this to prune whole subtrees before they are listed
+        return True
+    # end _keep_subdir()
+
+    def _wants_files(self, dir_path: Path) -> bool:
+        # Subclasses override this to collect the files of only some directories
+        return self._is_file_iterator
+    # end _wants_files()
+
+    def _scan_dir(self, dir_path: Path, with_files: bool | None = None) -> tuple[list[Path], list[os.DirEntry]] | None:
+        # Lists dir_path once and returns its wanted subdirectories and, if with_files, its wanted files.
+        # Returns None if the directory disappeared, to handle changes to directory structure during traversal.
+        if with_files is None:
+            with_files = self._wants_files(dir_path)
+        subdirs: list[Path] = []
+        files: list[os.DirEntry] = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if self._is_wanted_dir(entry.name) and self._keep_subdir(dir_path / entry.name):
+                            subdirs.append(dir_path / entry.name)
+                    elif with_files and entry.is_file() and self._is_wanted_file(entry.name):
+                        files.append(entry)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return subdirs, files
+    # end _scan_dir()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    # end close()
+
+    def _submit_scan(self, dir_path: Path) -> tuple[Path, Future]:
+        assert self._executor is not None
+        future: Future = self._executor.submit(self._scan_dir, dir_path)
+        if not self._ordered:
+            self._outstanding_scans += 1
+            future.add_done_callback(lambda done: self._completed_scans.put((dir_path, done)))
+        return dir_path, future
+    # end _submit_scan()
+
+    def _push_dirs(self, dirs: list[Path]) -> None:
+        # dirs have already been checked with _is_wanted_dir
+        if self._executor is not None:
+            scans = [self._submit_scan(dir_path) for dir_path in dirs]
+            if not self._ordered:
+                return
+            dirs = scans
+        if self._depth_first:
+            self._directories.extend(reversed(dirs))  # the first subdirectory ends up on top of the stack
+        else:
+            self._directories.extend(dirs)
+    # end _push_dirs()
+
+    def _pop_listing(self) -> tuple[Path, tuple[list[Path], list[os.DirEntry]] | None] | None:
+        # Returns the next directory and its listing, or None once the whole tree has been listed
+        if self._executor is not None and not self._ordered:
+            if self._outstanding_scans == 0:
+                return None
+            dir_path, future = self._completed_scans.get()
+            self._outstanding_scans -= 1
+            return dir_path, future.result()
+
+        if len(self._directories) == 0:
+            return None
+        next_dir = self._directories.pop() if self._depth_first else self._directories.popleft()
+        if self._executor is not None:
+            dir_path, future = next_dir
+            return dir_path, future.result()
+        return next_dir, self._scan_dir(next_dir)
+    # end _pop_listing()
+
     def _get_next_dir(self) -> Path:
-        while len(self._directories) > 0:
-            self._current_dir = self._directories.pop(0)
-            
-            if not self._current_dir.exists():  # Handle changes to directory structure during traversal
+        while True:
+            next_listing = self._pop_listing()
+            if next_listing is None:
+                break
+            self._current_dir, listing = next_listing
+            if listing is None:
                 continue
-            dir_name : str = self._current_dir.name
-            if dir_name in self._ignore_dirs or \
-                           (self._ignore_hidden_dirs and dir_name.startswith('.')):
-                continue
-
-            if self._match_dirs.match(string=dir_name):
-                dirs_at_this_level: list[Path] = []
-                for path in self._current_dir.iterdir():
-                    if path.is_dir() and (path.name not in self._ignore_dirs) and \
-                       ((self._ignore_hidden_dirs and not (path.name).startswith('.')) or (not self._ignore_hidden_dirs)):
-                        self._directories.append(path)
-                        
-                self._files_indicator = False
-                return self._current_dir
+            subdirs, files = listing
+            self._push_dirs(subdirs)
+
+            self._entries_in_current_dir: list[os.DirEntry] = files
+            self._files_in_current_dir = deque(self._current_dir / entry.name for entry in files)
+            self._files_indicator = self._wants_files(self._current_dir)
+            return self._current_dir
+        self.close()
         return Path()
     # end _get_next_dir()
 
     def _get_next_file(self)-> Path:
         if not self._files_indicator:
-
-            must_append: bool = False
-            for path in self._current_dir.iterdir():
-                must_append = path.is_file()
-                must_append = must_append and (path.name not in self._ignore_files)
-                must_append = must_append and (self._match_files.match(string=path.name) is not None)
-                must_append = must_append and ((self._ignore_hidden_files and not path.name.startswith('.')) or (not self._ignore_hidden_files))
-                if must_append:
-                    self._files_in_current_dir.append(path)
+            listing = self._scan_dir(self._current_dir, with_files=True)
+            files: list[os.DirEntry] = [] if listing is None else listing[1]
+            self._files_in_current_dir = deque(self._current_dir / entry.name for entry in files)
             self._files_indicator = True
         if len(self._files_in_current_dir) > 0:
-            return self._files_in_current_dir.pop(0)
+            return self._files_in_current_dir.popleft()
         else: # No files found in current dir
             return Path()
     # end _get_next_file()
@@ -491,7 +606,10 @@ class SimpleTraverser(Traverser):
                  match_list: list[str] = ['*'],
                  ignore_list: list[str] =['.DS_Store', '.Trash'],
                  is_dir_iterator: bool = True,
-                 is_file_iterator: bool = True
+                 is_file_iterator: bool = True,
+                 depth_first: bool = False,
+                 num_threads: int = 1,
+                 ordered: bool = True
             ) -> None:
     
         ignore_hidden_both: dict[str, bool] = {'dirs': ignore_hidden, 'files': ignore_hidden}
@@ -499,7 +617,7 @@ class SimpleTraverser(Traverser):
         match_files: list[str] = match_list
         ignore_dict_list: dict[str, list[str]] = {'dirs': ignore_list, 'files': ignore_list}
         
-        super().__init__(root_dir, match_dirs, match_files, ignore_hidden_both, ignore_dict_list, is_dir_iterator, is_file_iterator)
+        super().__init__(root_dir, match_dirs, match_files, ignore_hidden_both, ignore_dict_list, is_dir_iterator, is_file_iterator, depth_first, num_threads, ordered)
     # end __init__()
 # end class SimpleTraverser()
 
@@ -508,14 +626,20 @@ class DirTraverser(SimpleTraverser):
                  root_dir: Path,
                  ignore_hidden: bool = True,
                  match_list: list[str] = ['*'],
-                 ignore_list: list[str] =['.DS_Store', '.Trash']
+                 ignore_list: list[str] =['.DS_Store', '.Trash'],
+                 depth_first: bool = False,
+                 num_threads: int = 1,
+                 ordered: bool = True
             ) -> None:
         super().__init__(root_dir,
                         ignore_hidden,
                         match_list,
                         ignore_list,
                         is_dir_iterator=True,
-                        is_file_iterator=False)
+                        is_file_iterator=False,
+                        depth_first=depth_first,
+                        num_threads=num_threads,
+                        ordered=ordered)
      # end __init__()
 # end class DirTraverser()
 
@@ -524,13 +648,133 @@ class FileTraverser(SimpleTraverser):
                  root_dir: Path,
                  ignore_hidden: bool = True,
                  match_list: list[str] = ['*'],
-                 ignore_list: list[str] =['.DS_Store', '.Trash']
+                 ignore_list: list[str] =['.DS_Store', '.Trash'],
+                 depth_first: bool = False,
+                 num_threads: int = 1,
+                 ordered: bool = True
             ) -> None:
         super().__init__(root_dir,
                         ignore_hidden,
                         match_list,
                         ignore_list,
                         is_dir_iterator=False,
-                        is_file_iterator=True)
+                        is_file_iterator=True,
+                        depth_first=depth_first,
+                        num_threads=num_threads,
+                        ordered=ordered)
      # end __init__()
-# end class FileTraverser()
\ No newline at end of file
+# end class FileTraverser()
+
+class FileInfo(NamedTuple):
+    path: Path
+    size: int
+    mtime_ns: int
+# end class FileInfo
+
+class DirBatch(NamedTuple):
+    dir_path: Path
+    files: list[FileInfo]
+# end class DirBatch
+
+class DirBatchTraverser(Traverser):
+    # USAGE: for dir_path, files in DirBatchTraverser(root_dir, match_files=['*.jpg']):
+    #
+    #        Yields each directory together with its matching files, with their size and modification
+    #        time, from a single listing of the directory. The file stat calls run on the listing
+    #        threads when num_threads > 1. with_stat=False leaves size and mtime_ns at 0.
+    #
+    #        prune_dir(dir_path) returning True skips that directory and its whole subtree without
+    #        listing it. select_dir(dir_path) returning False still traverses the directory but does not
+    #        yield it, e.g. to only yield metadata directories.
+    #
+    #        listing_cache is an optional object with get_subdirs(dir_path) -> list[str] | None and
+    #        put_subdirs(dir_path, subdir_names) methods, called from the listing threads. When
+    #        get_subdirs returns the names of the subdirectories of an unchanged directory, that directory
+    #        is not listed nor yielded and its cached subdirectories are traversed. After every real
+    #        listing put_subdirs receives the names of the subdirectories found. See ScanManifest.
+
+    def __init__(self,
+                 root_dir: Path,
+                 match_dirs: list[str] = ['*'],
+                 match_files: list[str] = ['*'],
+                 ignore_hidden: dict[str, bool] = {'dirs': True, 'files': True},
+                 ignore_list: dict[str, list[str]] = {'dirs': ['.DS_Store', '.Trash'], 'files': ['.DS_Store']},
+                 prune_dir: Callable[[Path], bool] | None = None,
+                 select_dir: Callable[[Path], bool] | None = None,
+                 with_stat: bool = True,
+                 listing_cache = None,
+                 depth_first: bool = False,
+                 num_threads: int = 1,
+                 ordered: bool = True
+            ) -> None:
+        self._prune_dir: Callable[[Path], bool] | None = prune_dir
+        self._select_dir: Callable[[Path], bool] | None = select_dir
+        self._with_stat: bool = with_stat
+        self._listing_cache = listing_cache
+        self._cached_dirs: set[Path] = set()  # unchanged directories that must not be yielded
+        super().__init__(root_dir,
+                         match_dirs,
+                         match_files,
+                         ignore_hidden,
+                         ignore_list,
+                         is_dir_iterator=True,
+                         is_file_iterator=True,
+                         depth_first=depth_first,
+                         num_threads=num_threads,
+                         ordered=ordered)
+    # end __init__()
+
+    def _keep_subdir(self, dir_path: Path) -> bool:
+        return self._prune_dir is None or not self._prune_dir(dir_path)
+    # end _keep_subdir()
+
+    def _wants_files(self, dir_path: Path) -> bool:
+        return self._select_dir is None or self._select_dir(dir_path)
+    # end _wants_files()
+
+    def _scan_dir(self, dir_path: Path, with_files: bool | None = None) -> tuple[list[Path], list[os.DirEntry]] | None:
+        if self._listing_cache is not None:
+            subdir_names: list[str] | None = self._listing_cache.get_subdirs(dir_path)
+            if subdir_names is not None:
+                self._cached_dirs.add(dir_path)
+                subdirs: list[Path] = [dir_path / name for name in subdir_names
+                                       if self._is_wanted_dir(name) and self._keep_subdir(dir_path / name)]
+                return subdirs, []
+
+        listing = super()._scan_dir(dir_path, with_files)
+        if listing is not None and self._listing_cache is not None:
+            self._listing_cache.put_subdirs(dir_path, [subdir.name for subdir in listing[0]])
+        if listing is not None and self._with_stat:
+            subdirs, files = listing
+            stat_files: list[os.DirEntry] = []
+            for entry in files:
+                try:
+                    entry.stat()  # cached by the DirEntry, so it runs on the listing thread
+                    stat_files.append(entry)
+                except FileNotFoundError:
+                    pass
+            listing = (subdirs, stat_files)
+        return listing
+    # end _scan_dir()
+
+    def __next__(self) -> DirBatch:
+        while True:
+            dir_path: Path = self._get_next_dir()
+            if dir_path == Path():
+                raise StopIteration
+            if dir_path in self._cached_dirs:
+                self._cached_dirs.discard(dir_path)
+                continue
+            if self._wants_files(dir_path):
+                break
+        files: list[FileInfo] = []
+        for entry in self._entries_in_current_dir:
+            if self._with_stat:
+                stat_result = entry.stat()
+                files.append(FileInfo(dir_path / entry.name, stat_result.st_size, stat_result.st_mtime_ns))
+            else:
+                files.append(FileInfo(dir_path / entry.name, 0, 0))
+        self._files_in_current_dir.clear()
+        return DirBatch(dir_path, files)
+    # end __next__()
+# end class DirBatchTraverser()
@@ -1,8 +1,8 @@
 from pathlib import Path
 import unittest
-from traverser import DirTraverser, FileTraverser, Traverser
+from traverser import DirTraverser, FileTraverser, Traverser, DirBatchTraverser
 import logging
-from global_logger import GlobalLogger
+from global_logger_pool import GlobalLogger
 
 class TestTraverser(unittest.TestCase):
 
@@ -128,6 +128,103 @@ class TestTraverser(unittest.TestCase):
         return
     # end test_traverse_only_files()
 
+    def test_dirtraverser_depth_first(self) -> None:
+        traverser = DirTraverser(self.root_dir, ignore_hidden=False, depth_first=True)
+        actual_dirs = list(traverser)
+
+        expected_dirs = set([self.root_dir, self.root_dir / 'dir1', self.root_dir / 'dir2', self.root_dir / 'dir2' / 'dir2_1', self.root_dir / 'dir2' / 'dir2_2', self.root_dir / '.dir3', self.root_dir / '.dir4', self.root_dir / 'dir2' / '.dir2_3'])
+        self.assertEqual(expected_dirs, set(actual_dirs))
+        self.assertEqual(len(expected_dirs), len(actual_dirs))
+
+        # every subdirectory of dir2 must be emitted right after dir2, before any of dir2's siblings
+        dir2_index = actual_dirs.index(self.root_dir / 'dir2')
+        dir2_subtree = set(actual_dirs[dir2_index:dir2_index + 4])
+        self.assertEqual(set([self.root_dir / 'dir2', self.root_dir / 'dir2' / 'dir2_1', self.root_dir / 'dir2' / 'dir2_2', self.root_dir / 'dir2' / '.dir2_3']), dir2_subtree)
+        return
+    # end test_dirtraverser_depth_first()
+
+    def test_filetraverser_depth_first_ignore_hidden(self) -> None:
+        traverser = FileTraverser(self.root_dir, depth_first=True)
+        actual_files = set(traverser)
+
+        expected_files = set([self.root_dir / 'dir1' / 'file1_1', self.root_dir / 'dir1' / 'file1_2', self.root_dir / 'dir1' / 'file_1_3', self.root_dir / 'dir2' / 'dir2_1' / 'file2_1'])
+        self.assertEqual(expected_files, actual_files)
+        return
+    # end test_filetraverser_depth_first_ignore_hidden()
+
+    def test_next_file_on_dir_iterator(self) -> None:
+        traverser = DirTraverser(self.root_dir, ignore_hidden=True)
+        actual_files = set()
+        dir_path = traverser.next_dir()
+        while dir_path != Path():
+            file_path = traverser.next_file()
+            while file_path != Path():
+                actual_files.add(file_path)
+                file_path = traverser.next_file()
+            dir_path = traverser.next_dir()
+
+        expected_files = set([self.root_dir / 'dir1' / 'file1_1', self.root_dir / 'dir1' / 'file1_2', self.root_dir / 'dir1' / 'file_1_3', self.root_dir / 'dir2' / 'dir2_1' / 'file2_1'])
+        self.assertEqual(expected_files, actual_files)
+        return
+    # end test_next_file_on_dir_iterator()
+
+    def test_dirtraverser_parallel_ordered(self) -> None:
+        expected_dirs = list(DirTraverser(self.root_dir, ignore_hidden=False))
+        traverser = DirTraverser(self.root_dir, ignore_hidden=False, num_threads=4, ordered=True)
+        actual_dirs = list(traverser)
+        self.assertEqual(expected_dirs, actual_dirs)
+        return
+    # end test_dirtraverser_parallel_ordered()
+
+    def test_dirtraverser_parallel_unordered(self) -> None:
+        traverser = DirTraverser(self.root_dir, ignore_hidden=True, num_threads=4, ordered=False)
+        actual_dirs = list(traverser)
+
+        expected_dirs = set([self.root_dir, self.root_dir / 'dir1', self.root_dir / 'dir2', self.root_dir / 'dir2' / 'dir2_1', self.root_dir / 'dir2' / 'dir2_2'])
+        self.assertEqual(expected_dirs, set(actual_dirs))
+        self.assertEqual(len(expected_dirs), len(actual_dirs))
+        return
+    # end test_dirtraverser_parallel_unordered()
+
+    def test_traverse_all_parallel(self) -> None:
+        traverser = Traverser(self.root_dir, ignore_hidden={'dirs': False, 'files': False}, num_threads=3, ordered=False)
+        actual_files = set()
+        for file in traverser:
+            actual_files.add(file)
+
+        expected_files = set([self.root_dir / 'dir1' / 'file1_1', self.root_dir / 'dir1' / 'file1_2', self.root_dir / 'dir1' / 'file_1_3', self.root_dir / 'dir1' / '.file1_4', self.root_dir / 'dir1' / '.file1_5', self.root_dir / 'dir2' / 'dir2_1' / 'file2_1', self.root_dir / '.dir4' / '.file4_1'])
+        expected_dirs = set([self.root_dir, self.root_dir / 'dir1', self.root_dir / 'dir2', self.root_dir / 'dir2' / 'dir2_1', self.root_dir / 'dir2' / 'dir2_2', self.root_dir / '.dir3', self.root_dir / '.dir4', self.root_dir / 'dir2' / '.dir2_3'])
+        self.assertEqual(expected_dirs | expected_files, actual_files)
+        return
+    # end test_traverse_all_parallel()
+
+    def test_dirbatchtraverser(self) -> None:
+        traverser = DirBatchTraverser(self.root_dir, match_files=['file1_*', 'file2_*'])
+        actual_batches = {dir_path: files for dir_path, files in traverser}
+
+        expected_dirs = set([self.root_dir, self.root_dir / 'dir1', self.root_dir / 'dir2', self.root_dir / 'dir2' / 'dir2_1', self.root_dir / 'dir2' / 'dir2_2'])
+        self.assertEqual(expected_dirs, set(actual_batches))
+        self.assertEqual(set([self.root_dir / 'dir1' / 'file1_1', self.root_dir / 'dir1' / 'file1_2']), set(file.path for file in actual_batches[self.root_dir / 'dir1']))
+        self.assertEqual([self.root_dir / 'dir2' / 'dir2_1' / 'file2_1'], [file.path for file in actual_batches[self.root_dir / 'dir2' / 'dir2_1']])
+        for file in actual_batches[self.root_dir / 'dir1']:
+            self.assertEqual(file.path.stat().st_size, file.size)
+            self.assertEqual(file.path.stat().st_mtime_ns, file.mtime_ns)
+        return
+    # end test_dirbatchtraverser()
+
+    def test_dirbatchtraverser_prune_and_select(self) -> None:
+        traverser = DirBatchTraverser(self.root_dir,
+                                      ignore_hidden={'dirs': False, 'files': False},
+                                      prune_dir=lambda dir_path: dir_path.name == 'dir2',
+                                      select_dir=lambda dir_path: dir_path.name.startswith('.'),
+                                      num_threads=2)
+        actual_batches = {dir_path: set(file.path for file in files) for dir_path, files in traverser}
+
+        expected_batches = {self.root_dir / '.dir3': set(), self.root_dir / '.dir4': set([self.root_dir / '.dir4' / '.file4_1'])}
+        self.assertEqual(expected_batches, actual_batches)
+        return
+    # end test_dirbatchtraverser_prune_and_select()
+
 # end class TestTraverser
 
 if __name__ == '__main__':
@@ -7,6 +7,8 @@ import numpy as np
 import networkx as nx
 import pickle
 from global_logger import configure_logger
+from image_loader import load_image
+from boxes import boxes_are_inside, clip_boxes
 
 debug = False
 visualization_on = True
@@ -128,43 +130,19 @@ def box_is_inside(image_width: int, image_height: int, bx: int, by: int, bw: int
     if debug:
         print('iwidth: ' + str(image_width) + ' iheight: ' + str(image_height) + ' X1: ' + str(bx) + ' Y1: ' + str(by) + ' X2: ' + str(bx+bw) + ' Y2: ' + str(by+bh))
         pass
-    is_inside = True
-    is_inside = is_inside and (bx >= 0)
-    is_inside = is_inside and (by >= 0)
-    is_inside = is_inside and ((bx + bw) <= image_width)
-    is_inside = is_inside and ((by + bh) <= image_height)
+    is_inside = bool(boxes_are_inside(np.array([[bx, by, bw, bh]]), image_width, image_height)[0])
     return is_inside
 # end box_is_inside
 
 def make_box_corrections(image_width: int, image_height: int, bx: int, by: int, bw: int, bh: int) -> tuple[int, int, int, int]:
-    x, y, w, h = bx, by, bw, bh
+    # Single box version of boxes.clip_boxes
+    x, y, w, h = (int(value) for value in clip_boxes(np.array([[bx, by, bw, bh]]), image_width, image_height)[0])
 
-    is_outside: bool = False
-
-    if bx < 0:
-        is_outside = True
-        x = 0
-        w = w + bx
-    
-    if by < 0:
-        is_outside = True
-        y = 0
-        h = h + bh
-
-    x2, y2 = x + w, y + h
-
-    if (x2 > image_width):
-        is_outside = True
-        w = w - (x2 - image_width)
-
-    if (y2 > image_height):
-        is_outside = True
-        h = h - (y2 - image_height)
+    is_outside: bool = (x, y, w, h) != (bx, by, bw, bh)
 
     if is_outside:
         print('Face coordinates outside of image: iwidth: ' + str(image_width) + ' iheight: ' + str(image_height) + ' X: ' + str(bx) + ' Y: ' + str(by) + ' W: ' + str(bw) + ' H: ' + str(bh))
         print('Corrected to:                                             ' + ' X: ' + str(x) + ' Y: ' + str(y) + ' W: ' + str(w) + ' H: ' + str(h))
-        # x2, y2 = x + w, y + h
 
     return (x, y, w, h)
 # end make_box_corrections
@@ -183,7 +161,7 @@ def write_image_file(image: np.ndarray,
 
 def read_image_file(image_filename: Path,
                     exception_on_read_fail = False) -> np.ndarray:
-    image = cv2.imread(image_filename.as_posix())
+    image = load_image(image_filename)
     if image is None:
         if exception_on_read_fail:
             raise FileExistsError('Unable to read file: ' + str(image_filename))
@@ -0,0 +1,188 @@
+# Copyright (c) Raul Diaz 2023, licensed per terms in LICENSE file in https://github.com/radzfoto/find_faces
+from pathlib import Path
+from typing import Callable, Iterable
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from traverser import DirTraverser, DirBatchTraverser
+
+class WatchEvents:
+    # Result of one wait on a watcher: the files that changed and whether events were lost,
+    # in which case the caller must rescan the whole tree
+    def __init__(self, paths: list[Path] | None = None, overflow: bool = False) -> None:
+        self.paths: list[Path] = [] if paths is None else paths
+        self.overflow: bool = overflow
+    # end __init__()
+# end class WatchEvents
+
+class InotifyWatcher:
+    # Watches every non hidden directory under root_dir with Linux inotify through libc, so no extra
+    # package is needed. Reports files that were closed after writing, moved into or out of a watched
+    # directory or deleted; the caller tells them apart by whether they still exist. New directories are
+    # watched as they appear and the files they already contain are reported, since a bulk copy may have
+    # written them before the watch was added.
+    # Raises OSError if inotify is not available or the watch limit is reached.
+
+    IN_CLOSE_WRITE: int = 0x00000008
+    IN_MOVED_FROM: int = 0x00000040
+    IN_MOVED_TO: int = 0x00000080
+    IN_CREATE: int = 0x00000100
+    IN_DELETE: int = 0x00000200
+    IN_Q_OVERFLOW: int = 0x00004000
+    IN_IGNORED: int = 0x00008000
+    IN_ISDIR: int = 0x40000000
+    IN_NONBLOCK: int = os.O_NONBLOCK
+    IN_CLOEXEC: int = 0o2000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root_dir: Path, log: logging.Logger) -> None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.root_dir: Path = root_dir
+        self.log: logging.Logger = log
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd: int = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches: dict[int, Path] = {}
+        for dir_path in DirTraverser(root_dir, ignore_hidden=True):
+            self._add_watch(dir_path)
+        self.log.info(f'Watching {len(self._watches)} directories under {root_dir.as_posix()} with inotify.')
+        return
+    # end __init__()
+
+    def _add_watch(self, dir_path: Path) -> None:
+        mask: int = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        wd: int = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), mask)
+        if wd < 0:
+            error: int = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):  # removed before it could be watched
+                return
+            raise OSError(error, f'inotify_add_watch failed for {dir_path.as_posix()}')
+        self._watches[wd] = dir_path
+        return
+    # end _add_watch()
+
+    def wait(self, timeout: float) -> WatchEvents:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        events = WatchEvents()
+        if len(readable) == 0:
+            return events
+        try:
+            buffer: bytes = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return events
+
+        offset: int = 0
+        while offset + self.EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.EVENT_HEADER.size
+            name: str = os.fsdecode(buffer[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+
+            if mask & self.IN_Q_OVERFLOW:
+                events.overflow = True
+                continue
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            dir_path: Path | None = self._watches.get(wd)
+            if dir_path is None or name.startswith('.'):
+                continue
+            path: Path = dir_path / name
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    for new_dir in DirTraverser(path, ignore_hidden=True):
+                        self._add_watch(new_dir)
+                    events.paths.extend(file for file in self._files_in_tree(path))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE):
+                events.paths.append(path)
+        return events
+    # end wait()
+
+    def _files_in_tree(self, dir_path: Path) -> Iterable[Path]:
+        for _, files in DirBatchTraverser(dir_path, with_stat=False):
+            for file in files:
+                yield file.path
+    # end _files_in_tree()
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        return
+    # end close()
+# end class InotifyWatcher
+
+class PollingWatcher:
+    # Portable fallback: lists the tree every poll_interval seconds and reports the image files whose
+    # size or modification time changed, or that disappeared, since the previous listing.
+
+    def __init__(self,
+                 list_files: Callable[[], DirBatchTraverser],
+                 poll_interval: float,
+                 log: logging.Logger) -> None:
+        self.list_files: Callable[[], DirBatchTraverser] = list_files
+        self.poll_interval: float = poll_interval
+        self.log: logging.Logger = log
+        self._snapshot: dict[Path, tuple[int, int]] = self._take_snapshot()
+        self._next_poll_time: float = time.time() + poll_interval
+        self.log.info(f'Polling {len(self._snapshot)} files every {poll_interval} seconds.')
+        return
+    # end __init__()
+
+    def _take_snapshot(self) -> dict[Path, tuple[int, int]]:
+        return {file.path: (file.size, file.mtime_ns) for _, files in self.list_files() for file in files}
+    # end _take_snapshot()
+
+    def wait(self, timeout: float) -> WatchEvents:
+        now: float = time.time()
+        if now < self._next_poll_time:
+            time.sleep(min(timeout, self._next_poll_time - now))
+            return WatchEvents()
+        snapshot = self._take_snapshot()
+        changed: list[Path] = [path for path, identity in snapshot.items() if self._snapshot.get(path) != identity]
+        changed.extend(path for path in self._snapshot if path not in snapshot)
+        self._snapshot = snapshot
+        self._next_poll_time = time.time() + self.poll_interval
+        return WatchEvents(changed)
+    # end wait()
+
+    def close(self) -> None:
+        return
+    # end close()
+# end class PollingWatcher
+
+class Debouncer:
+    # Holds changed paths until no new event arrived for them during quiet_period seconds, so a file
+    # being copied, or a bulk copy writing the same file several times, is only processed once
+    def __init__(self, quiet_period: float) -> None:
+        self.quiet_period: float = quiet_period
+        self._last_event_time: dict[Path, float] = {}
+    # end __init__()
+
+    def add(self, paths: list[Path]) -> None:
+        now: float = time.time()
+        for path in paths:
+            self._last_event_time[path] = now
+    # end add()
+
+    def pop_ready(self) -> list[Path]:
+        deadline: float = time.time() - self.quiet_period
+        ready: list[Path] = [path for path, event_time in self._last_event_time.items() if event_time <= deadline]
+        for path in ready:
+            del self._last_event_time[path]
+        return ready
+    # end pop_ready()
+
+    def pending_count(self) -> int:
+        return len(self._last_event_time)
+    # end pending_count()
+# end class Debouncer
@@ -0,0 +1,136 @@
+from pathlib import Path
+from unittest import mock
+import logging
+import os
+import tempfile
+import unittest
+from traverser import DirBatchTraverser
+from watcher import Debouncer, PollingWatcher, InotifyWatcher
+
+class TestDebouncer(unittest.TestCase):
+
+    def test_pop_ready(self) -> None:
+        debouncer = Debouncer(2.0)
+        with mock.patch('watcher.time.time', return_value=100.0):
+            debouncer.add([Path('a.jpg'), Path('b.jpg')])
+        with mock.patch('watcher.time.time', return_value=101.0):
+            debouncer.add([Path('b.jpg')])  # written again, waits for another quiet period
+            self.assertEqual(debouncer.pop_ready(), [])
+        with mock.patch('watcher.time.time', return_value=102.0):
+            self.assertEqual(debouncer.pop_ready(), [Path('a.jpg')])
+            self.assertEqual(debouncer.pending_count(), 1)
+        with mock.patch('watcher.time.time', return_value=103.0):
+            self.assertEqual(debouncer.pop_ready(), [Path('b.jpg')])
+            self.assertEqual(debouncer.pop_ready(), [])
+        self.assertEqual(debouncer.pending_count(), 0)
+        return
+    # end test_pop_ready()
+
+    def test_zero_quiet_period(self) -> None:
+        debouncer = Debouncer(0.0)
+        debouncer.add([Path('a.jpg'), Path('a.jpg')])
+        self.assertEqual(debouncer.pop_ready(), [Path('a.jpg')])
+        return
+    # end test_zero_quiet_period()
+# end class TestDebouncer
+
+class TestPollingWatcher(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root_dir = Path(self.temp_dir.name)
+        (self.root_dir / 'sub').mkdir()
+        (self.root_dir / 'a.jpg').write_bytes(b'a')
+        (self.root_dir / 'sub' / 'b.jpg').write_bytes(b'b')
+        (self.root_dir / 'notes.txt').write_bytes(b'not an image')
+        self.log = logging.getLogger('watcher_unittest')
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    def list_files(self) -> DirBatchTraverser:
+        return DirBatchTraverser(self.root_dir, match_files=['*.jpg'])
+    # end list_files()
+
+    def test_changes(self) -> None:
+        watcher = PollingWatcher(self.list_files, 0.0, self.log)
+        self.assertEqual(watcher.wait(timeout=0.0).paths, [])  # nothing changed since the first listing
+
+        (self.root_dir / 'sub' / 'c.jpg').write_bytes(b'c')  # added
+        (self.root_dir / 'a.jpg').write_bytes(b'aa')  # modified
+        (self.root_dir / 'sub' / 'b.jpg').unlink()  # deleted
+        (self.root_dir / 'other.txt').write_bytes(b'not watched')
+        events = watcher.wait(timeout=0.0)
+        self.assertFalse(events.overflow)
+        self.assertEqual(sorted(events.paths),
+                         sorted([self.root_dir / 'a.jpg', self.root_dir / 'sub' / 'b.jpg', self.root_dir / 'sub' / 'c.jpg']))
+        self.assertEqual(watcher.wait(timeout=0.0).paths, [])
+
+        # Same size, another modification time
+        stat_result = os.stat(self.root_dir / 'a.jpg')
+        os.utime(self.root_dir / 'a.jpg', ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1_000_000_000))
+        self.assertEqual(watcher.wait(timeout=0.0).paths, [self.root_dir / 'a.jpg'])
+        watcher.close()
+        return
+    # end test_changes()
+
+    def test_waits_for_poll_interval(self) -> None:
+        watcher = PollingWatcher(self.list_files, 3600.0, self.log)
+        (self.root_dir / 'c.jpg').write_bytes(b'c')
+        self.assertEqual(watcher.wait(timeout=0.01).paths, [])  # not polled yet
+        with mock.patch('watcher.time.time', return_value=watcher._next_poll_time):
+            self.assertEqual(watcher.wait(timeout=0.01).paths, [self.root_dir / 'c.jpg'])
+        watcher.close()
+        return
+    # end test_waits_for_poll_interval()
+# end class TestPollingWatcher
+
+class TestInotifyWatcher(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root_dir = Path(self.temp_dir.name)
+        try:
+            self.watcher = InotifyWatcher(self.root_dir, logging.getLogger('watcher_unittest'))
+        except OSError as e:
+            self.temp_dir.cleanup()
+            self.skipTest(f'inotify is not available: {e}')
+        return
+    # end setUp()
+
+    def tearDown(self) -> None:
+        self.watcher.close()
+        self.temp_dir.cleanup()
+        return
+    # end tearDown()
+
+    def wait_for(self, count: int) -> set[Path]:
+        # The paths of the events, until count distinct paths were reported or nothing more arrives
+        paths: set[Path] = set()
+        for _ in range(20):
+            paths.update(self.watcher.wait(timeout=0.1).paths)
+            if len(paths) >= count:
+                break
+        return paths
+    # end wait_for()
+
+    def test_new_files_and_dirs(self) -> None:
+        (self.root_dir / 'a.jpg').write_bytes(b'a')
+        self.assertIn(self.root_dir / 'a.jpg', self.wait_for(1))
+
+        (self.root_dir / 'new').mkdir()
+        (self.root_dir / 'new' / 'b.jpg').write_bytes(b'b')
+        self.assertIn(self.root_dir / 'new' / 'b.jpg', self.wait_for(1))
+
+        (self.root_dir / 'a.jpg').unlink()
+        self.assertIn(self.root_dir / 'a.jpg', self.wait_for(1))
+        return
+    # end test_new_files_and_dirs()
+# end class TestInotifyWatcher
+
+if __name__ == '__main__':
+    unittest.main()